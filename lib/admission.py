@@ -0,0 +1,107 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """Request rejected by admission control"""
+
+    def __init__(self,message,retry_after:float=1):
+        super(AdmissionRejected, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket: `rate` tokens per second, up to `burst` tokens. Not thread safe"""
+
+    __slots__ = ['rate','burst','tokens','updated']
+
+    def __init__(self,rate:float,burst:float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self,now:float):
+        if now > self.updated:
+            self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self,cost:float) -> float:
+        """ Seconds until `cost` tokens available (0 - available now) """
+        if self.tokens >= cost:
+            return 0
+        return (cost - self.tokens) / self.rate if self.rate else float('inf')
+
+
+class AdmissionController:
+    """Per-client and per-endpoint rate limits with cost weights and per-endpoint concurrency limit
+
+    Args:
+        client_rate (tuple): (tokens per second, burst) for every client
+        endpoint_rates (dict): endpoint => (tokens per second, burst) shared by all clients
+        costs (dict): endpoint => tokens per request (default 1)
+        concurrency (dict): endpoint => max requests in progress
+        max_clients (int): max client buckets kept in memory (least recently used are dropped)
+    """
+
+    def __init__(self,client_rate:tuple=None,endpoint_rates:dict=None,costs:dict=None,concurrency:dict=None,max_clients:int=10000):
+        self.client_rate = client_rate
+        self.endpoint_rates = endpoint_rates or {}
+        self.costs = costs or {}
+        self.max_clients = max_clients
+        self._clients = OrderedDict()
+        self._endpoints = {e:TokenBucket(*r) for e,r in self.endpoint_rates.items()}
+        self._concurrency = {e:threading.BoundedSemaphore(n) for e,n in (concurrency or {}).items()}
+        self._lock = threading.Lock()
+        self.stats = {'admitted':0,'rate_limited':0,'concurrency_limited':0}
+
+    def _client_bucket(self,client:str) -> TokenBucket:
+        bucket = self._clients.get(client)
+        if bucket is None:
+            bucket = self._clients[client] = TokenBucket(*self.client_rate)
+            if len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client)
+        return bucket
+
+    def acquire(self,client:str,endpoint:str):
+        """Admit request or raise AdmissionRejected. Admitted request should call release()
+
+        Raises:
+            AdmissionRejected: on rate or concurrency limit
+        """
+        cost = self.costs.get(endpoint,1)
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            if self.client_rate:
+                buckets.append(self._client_bucket(client))
+            if endpoint in self._endpoints:
+                buckets.append(self._endpoints[endpoint])
+            for bucket in buckets:
+                bucket.refill(now)
+            wait_time = max([b.wait_time(cost) for b in buckets] or [0])
+            if wait_time:
+                self.stats['rate_limited'] += 1
+                raise AdmissionRejected("Rate limit exceeded",wait_time)
+            for bucket in buckets:
+                bucket.tokens -= cost
+        semaphore = self._concurrency.get(endpoint)
+        if semaphore is not None and not semaphore.acquire(blocking=False):
+            with self._lock:
+                for bucket in buckets:
+                    bucket.tokens = min(bucket.burst,bucket.tokens + cost)
+                self.stats['concurrency_limited'] += 1
+            raise AdmissionRejected("Too many concurrent requests")
+        with self._lock:
+            self.stats['admitted'] += 1
+
+    def release(self,endpoint:str):
+        semaphore = self._concurrency.get(endpoint)
+        if semaphore is not None:
+            semaphore.release()
@@ -0,0 +1,266 @@
+"""Audit time range analytics over datetime and dictionary encoded username columns
+
+    python lib/audit_analytics.py users-audit.db [--bucket day] [--top 10] [--max-size 100000] [--benchmark]
+    python lib/audit_analytics.py audit-export ...   # directory written by audit_export.py
+
+Computations are vectorized with NumPy when it is installed, otherwise (or with use_numpy=False)
+pure Python path over the same columns is used.
+"""
+import sys
+import json
+import math
+import time
+import array
+import bisect
+import logging
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+DAY = 86400
+
+COLUMNS_QUERY = ("SELECT datetime, username FROM audit "
+                 "UNION ALL SELECT datetime, username FROM audit_archive "
+                 "ORDER BY 1")
+
+
+class AuditColumns:
+    """Sorted int64 datetime column and uint32 username codes with dictionary"""
+
+    def __init__(self,datetime,username,usernames:list,reader=None):
+        self.datetime = datetime
+        self.username = username
+        self.usernames = usernames
+        self._reader = reader
+
+    @classmethod
+    def from_database(cls,connection,chunk_size:int=100000):
+        """Load columns of audit and audit_archive from sqlite connection in chunks
+        """
+        datetimes, codes, dictionary = array.array('q'), array.array('I'), {}
+        cursor = connection.execute(COLUMNS_QUERY)
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            datetimes.extend(int(r[0]) for r in chunk)
+            codes.extend(dictionary.setdefault(r[1],len(dictionary)) for r in chunk)
+        return cls(datetimes,codes,list(dictionary))
+
+    @classmethod
+    def from_export(cls,path:str):
+        """Memory mapped columns of audit_export directory, close() when done"""
+        from audit_export import ColumnarAuditReader
+        reader = ColumnarAuditReader(path)
+        return cls(reader.datetime.values,reader.username.values,reader.usernames,reader)
+
+    def __len__(self):
+        return len(self.datetime)
+
+    def range(self,start:int=None,end:int=None) -> tuple:
+        """ Row indexes [first,last) with start <= datetime < end """
+        first = 0 if start is None else bisect.bisect_left(self.datetime,start)
+        last = len(self.datetime) if end is None else bisect.bisect_left(self.datetime,end)
+        return first, last
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+def _use_numpy(use_numpy) -> bool:
+    if use_numpy and numpy is None:
+        raise ImportError("numpy is not installed")
+    return numpy is not None if use_numpy is None else bool(use_numpy)
+
+
+def _np_columns(columns:AuditColumns,first:int,last:int) -> tuple:
+    """ Zero copy numpy views of rows [first,last) """
+    if not len(columns):
+        return numpy.zeros(0,dtype=numpy.int64), numpy.zeros(0,dtype=numpy.uint32)
+    datetime = numpy.frombuffer(columns.datetime,dtype=numpy.int64)[first:last]
+    username = numpy.frombuffer(columns.username,dtype=numpy.uint32)[first:last]
+    return datetime, username
+
+
+def _nearest_rank(sorted_values,percentiles) -> dict:
+    n = len(sorted_values)
+    if not n:
+        return {p:None for p in percentiles}
+    return {p:int(sorted_values[min(n,max(1,math.ceil(p / 100 * n))) - 1]) for p in percentiles}
+
+
+def histogram(columns:AuditColumns,bucket_size:int=DAY,start:int=None,end:int=None,use_numpy=None) -> list:
+    """Audit count per time bucket (aligned to multiples of bucket_size), empty buckets skipped
+
+    Returns:
+        list: (bucket start, count) ordered by time
+    """
+    first, last = columns.range(start,end)
+    if first == last:
+        return []
+    if _use_numpy(use_numpy):
+        datetime, _ = _np_columns(columns,first,last)
+        origin = int(datetime[0]) // bucket_size * bucket_size
+        counts = numpy.bincount((datetime - origin) // bucket_size)
+        buckets = numpy.nonzero(counts)[0]
+        return [(origin + int(b) * bucket_size,int(counts[b])) for b in buckets]
+    counts = {}
+    for value in columns.datetime[first:last]:
+        bucket = value // bucket_size * bucket_size
+        counts[bucket] = counts.get(bucket,0) + 1
+    return sorted(counts.items())
+
+
+def per_user_counts(columns:AuditColumns,start:int=None,end:int=None,top:int=None,use_numpy=None) -> list:
+    """Audit count per username
+
+    Returns:
+        list: (username, count) ordered by count desc
+    """
+    first, last = columns.range(start,end)
+    if _use_numpy(use_numpy):
+        _, username = _np_columns(columns,first,last)
+        counts = numpy.bincount(username,minlength=len(columns.usernames))
+        codes = numpy.nonzero(counts)[0]
+        codes = codes[numpy.argsort(-counts[codes],kind='stable')]
+        ret = [(columns.usernames[c],int(counts[c])) for c in codes]
+    else:
+        counts = Counter(columns.username[first:last])
+        ret = [(columns.usernames[c],n) for c,n in sorted(counts.items(),key=lambda i: (-i[1],i[0]))]
+    return ret if top is None else ret[:top]
+
+
+def gap_percentiles(columns:AuditColumns,percentiles=(50,90,99),per_user:bool=False,
+                    start:int=None,end:int=None,use_numpy=None) -> dict:
+    """Percentiles (nearest rank) of seconds between consecutive audits
+
+    Args:
+        per_user (bool): gaps between audits of the same user, otherwise between any audits
+
+    Returns:
+        dict: percentile -> gap seconds (None if no gaps)
+    """
+    first, last = columns.range(start,end)
+    if _use_numpy(use_numpy):
+        datetime, username = _np_columns(columns,first,last)
+        if per_user:
+            order = numpy.lexsort((datetime,username))
+            datetime, username = datetime[order], username[order]
+            gaps = numpy.diff(datetime)[username[1:] == username[:-1]]
+        else:
+            gaps = numpy.diff(datetime)
+        return _nearest_rank(numpy.sort(gaps),percentiles)
+    datetime = columns.datetime[first:last]
+    if per_user:
+        gaps, seen = [], {}
+        for code,value in zip(columns.username[first:last],datetime):
+            if code in seen:
+                gaps.append(value - seen[code])
+            seen[code] = value
+    else:
+        gaps = [b - a for a,b in zip(datetime,datetime[1:])]
+    return _nearest_rank(sorted(gaps),percentiles)
+
+
+def retention_projection(columns:AuditColumns,window_days:int=30,retain_days=(7,30,90),max_size:int=None,use_numpy=None) -> dict:
+    """Project audit volume from last window_days of data: rows rotate(max_size=...) should keep
+       to retain N days, and days of history kept with given max_size
+
+    Returns:
+        dict: daily_rate, peak_daily, rows_for_days {days: rows}, days_kept (if max_size given)
+    """
+    ret = {'window_days':window_days,'daily_rate':0.0,'peak_daily':0,'rows_for_days':{d:0 for d in retain_days}}
+    if not len(columns):
+        if max_size is not None:
+            ret['days_kept'] = None
+        return ret
+    end = int(columns.datetime[-1]) + 1
+    start = max(end - window_days * DAY,int(columns.datetime[0]))
+    daily = histogram(columns,DAY,start,end,use_numpy)
+    days = max(1.0,(end - start) / DAY)
+    ret['daily_rate'] = sum(c for _,c in daily) / days
+    ret['peak_daily'] = max(c for _,c in daily)
+    ret['rows_for_days'] = {d:math.ceil(ret['daily_rate'] * d) for d in retain_days}
+    if max_size is not None:
+        ret['days_kept'] = max_size / ret['daily_rate'] if ret['daily_rate'] else None
+    return ret
+
+
+def report(columns:AuditColumns,bucket_size:int=DAY,top:int=10,max_size:int=None,use_numpy=None) -> dict:
+    return {
+        'rows':len(columns),
+        'usernames':len(columns.usernames),
+        'histogram':histogram(columns,bucket_size,use_numpy=use_numpy),
+        'top_users':per_user_counts(columns,top=top,use_numpy=use_numpy),
+        'gaps':gap_percentiles(columns,use_numpy=use_numpy),
+        'user_gaps':gap_percentiles(columns,per_user=True,use_numpy=use_numpy),
+        'retention':retention_projection(columns,max_size=max_size,use_numpy=use_numpy),
+    }
+
+
+def benchmark(columns:AuditColumns,repeat:int=3) -> dict:
+    """Best of `repeat` run time of every computation with pure Python and NumPy paths
+
+    Returns:
+        dict: name -> {python, numpy (None if not installed), speedup} seconds
+    """
+    computations = {
+        'histogram':lambda np_: histogram(columns,3600,use_numpy=np_),
+        'per_user_counts':lambda np_: per_user_counts(columns,use_numpy=np_),
+        'gap_percentiles':lambda np_: gap_percentiles(columns,use_numpy=np_),
+        'user_gap_percentiles':lambda np_: gap_percentiles(columns,per_user=True,use_numpy=np_),
+    }
+
+    def best(func):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    ret = {}
+    for name,func in computations.items():
+        python_time = best(lambda: func(False))
+        numpy_time = best(lambda: func(True)) if numpy is not None else None
+        ret[name] = {'python':python_time,'numpy':numpy_time,
+            'speedup':python_time / numpy_time if numpy_time else None}
+    return ret
+
+
+if __name__ == '__main__':
+    import os
+    import argparse
+    import sqlite3
+
+    parser = argparse.ArgumentParser(description="Audit analytics")
+    parser.add_argument('source',help="sqlite database or audit_export directory")
+    parser.add_argument('--bucket',choices=['hour','day'],default='day')
+    parser.add_argument('--top',type=int,default=10)
+    parser.add_argument('--max-size',type=int,help="project days kept by rotate(max_size)")
+    parser.add_argument('--python',action='store_true',help="do not use numpy")
+    parser.add_argument('--benchmark',action='store_true',help="compare pure Python and numpy run time")
+    args = parser.parse_args()
+    if os.path.isdir(args.source):
+        columns = AuditColumns.from_export(args.source)
+    else:
+        columns = AuditColumns.from_database(sqlite3.connect(args.source))
+    with columns:
+        if args.benchmark:
+            ret = benchmark(columns)
+        else:
+            ret = report(columns,{'hour':3600,'day':DAY}[args.bucket],args.top,args.max_size,False if args.python else None)
+    json.dump(ret,sys.stdout,indent=2)
+    print()
@@ -0,0 +1,227 @@
+"""Column-oriented export of audit and audit_archive tables
+
+Export directory layout (arrays in native byte order, recorded in meta.json):
+    datetime.i64   - packed int64 timestamps, sorted
+    username.u32   - uint32 codes of username dictionary
+    username.dict  - dictionary: uint64 offsets + string heap (see StringHeap)
+    message.off    - uint64 offsets (rows + 1) into message.heap
+    message.heap   - utf-8 messages
+    uuid.off/.heap - uuids, same as message
+    archived.u8    - 1 if row comes from audit_archive
+    meta.json      - rows count, time range, stats
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import array
+import heapq
+import bisect
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+# Tables merged by datetime, archived flag of their rows. Rows are read in datetime index order,
+# so export does not sort whole tables
+EXPORT_TABLES = (('audit_archive',1),('audit',0))
+DATETIME_INDEX = "CREATE INDEX IF NOT EXISTS {table}_datetime ON {table} (datetime)"
+EXPORT_QUERY = "SELECT datetime, username, message, uuid, {archived} FROM {table} ORDER BY datetime"
+
+# Files written by export, meta.json excluded
+EXPORT_FILES = ('datetime.i64','username.u32','archived.u8','message.off','message.heap',
+                'uuid.off','uuid.heap','username.dict.off','username.dict.heap')
+
+
+class StringHeapWriter:
+    """Appends strings to heap file and offsets to offsets file"""
+
+    def __init__(self,path:str):
+        self._heap = open(path + '.heap','wb')
+        self._offsets = open(path + '.off','wb')
+        self._position = 0
+        array.array('Q',[0]).tofile(self._offsets)
+
+    def write(self,values:list):
+        offsets = array.array('Q')
+        for value in values:
+            data = (value or '').encode()
+            self._heap.write(data)
+            self._position += len(data)
+            offsets.append(self._position)
+        offsets.tofile(self._offsets)
+
+    def close(self) -> int:
+        self._heap.close()
+        self._offsets.close()
+        return self._position
+
+
+def _ordered_rows(connection):
+    """ Rows of all export tables ordered by datetime, merged from one cursor per table """
+    cursors = []
+    for table,archived in EXPORT_TABLES:
+        connection.execute(DATETIME_INDEX.format(table=table))
+        cursors.append(connection.execute(EXPORT_QUERY.format(table=table,archived=archived)))
+    return heapq.merge(*cursors,key=lambda row: row[0])
+
+
+def export_audits(connection,path:str,chunk_size:int=10000) -> dict:
+    """Stream audit and audit_archive rows into column files. Memory used is bounded by chunk_size
+       and usernames dictionary
+
+    Note:
+        datetime index is created for tables without it
+
+    Args:
+        connection: sqlite connection (e.g. SqLiteBackend.connection)
+        path (str): export directory
+        chunk_size (int): rows fetched per step
+
+    Returns:
+        dict: export stats (rows, bytes, duration, mb_per_sec)
+    """
+    started = time.monotonic()
+    os.makedirs(path,exist_ok=True)
+    dictionary = {}
+    rows = 0
+    min_datetime = max_datetime = None
+    messages = StringHeapWriter(os.path.join(path,'message'))
+    uuids = StringHeapWriter(os.path.join(path,'uuid'))
+    with open(os.path.join(path,'datetime.i64'),'wb') as datetimes, \
+         open(os.path.join(path,'username.u32'),'wb') as usernames, \
+         open(os.path.join(path,'archived.u8'),'wb') as archived:
+        ordered = _ordered_rows(connection)
+        while True:
+            chunk = list(itertools.islice(ordered,chunk_size))
+            if not chunk:
+                break
+            array.array('q',[int(r[0]) for r in chunk]).tofile(datetimes)
+            array.array('I',[dictionary.setdefault(r[1],len(dictionary)) for r in chunk]).tofile(usernames)
+            array.array('B',[r[4] for r in chunk]).tofile(archived)
+            messages.write([r[2] for r in chunk])
+            uuids.write([r[3] for r in chunk])
+            if min_datetime is None:
+                min_datetime = int(chunk[0][0])
+            max_datetime = int(chunk[-1][0])
+            rows += len(chunk)
+    messages.close()
+    uuids.close()
+    names = StringHeapWriter(os.path.join(path,'username.dict'))
+    names.write(list(dictionary))
+    names.close()
+
+    size = sum(os.path.getsize(os.path.join(path,f)) for f in EXPORT_FILES)
+    duration = time.monotonic() - started
+    stats = {
+        'rows':rows,
+        'usernames':len(dictionary),
+        'min_datetime':min_datetime,
+        'max_datetime':max_datetime,
+        'byteorder':sys.byteorder,
+        'bytes':size,
+        'duration':duration,
+        'mb_per_sec':size / duration / 1e6 if duration else 0,
+    }
+    with open(os.path.join(path,'meta.json'),'w') as meta:
+        json.dump(stats,meta)
+    logger.debug("[EXPORT] %s",stats)
+    return stats
+
+
+class _MappedArray:
+    """Read only memory mapped array file"""
+
+    def __init__(self,filename:str,typecode:str):
+        self._file = open(filename,'rb')
+        if os.path.getsize(filename):
+            self._mmap = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+            self.values = memoryview(self._mmap).cast(typecode)
+        else:
+            self._mmap = None
+            self.values = array.array(typecode)
+
+    def close(self):
+        if self._mmap is not None:
+            self.values.release()
+            self._mmap.close()
+        self._file.close()
+
+
+class _MappedHeap:
+    def __init__(self,path:str):
+        self._offsets = _MappedArray(path + '.off','Q')
+        self._heap = open(path + '.heap','rb')
+        size = os.path.getsize(path + '.heap')
+        self._mmap = mmap.mmap(self._heap.fileno(),0,access=mmap.ACCESS_READ) if size else b''
+
+    def __getitem__(self,index:int) -> str:
+        offsets = self._offsets.values
+        return self._mmap[offsets[index]:offsets[index + 1]].decode()
+
+    def __len__(self):
+        return len(self._offsets.values) - 1
+
+    def close(self):
+        self._offsets.close()
+        if self._mmap:
+            self._mmap.close()
+        self._heap.close()
+
+
+class ColumnarAuditReader:
+    """Memory mapped reader of exported audits. Only pages touched by scan are loaded"""
+
+    def __init__(self,path:str):
+        with open(os.path.join(path,'meta.json')) as meta:
+            self.meta = json.load(meta)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError(f"Export byte order {self.meta['byteorder']} is not supported")
+        self.datetime = _MappedArray(os.path.join(path,'datetime.i64'),'q')
+        self.username = _MappedArray(os.path.join(path,'username.u32'),'I')
+        self.archived = _MappedArray(os.path.join(path,'archived.u8'),'B')
+        self.message = _MappedHeap(os.path.join(path,'message'))
+        self.uuid = _MappedHeap(os.path.join(path,'uuid'))
+        names = _MappedHeap(os.path.join(path,'username.dict'))
+        self.usernames = [names[i] for i in range(len(names))]
+        names.close()
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def range(self,start:int=None,end:int=None) -> tuple:
+        """ Row indexes [first,last) with start <= datetime < end """
+        values = self.datetime.values
+        first = 0 if start is None else bisect.bisect_left(values,start)
+        last = len(values) if end is None else bisect.bisect_left(values,end)
+        return first, last
+
+    def scan(self,start:int=None,end:int=None):
+        """Yield audits with start <= datetime < end as dicts"""
+        first, last = self.range(start,end)
+        for i in range(first,last):
+            yield {
+                'uuid':self.uuid[i],
+                'username':self.usernames[self.username.values[i]],
+                'message':self.message[i],
+                'datetime':self.datetime.values[i],
+                'archived':bool(self.archived.values[i]),
+            }
+
+    def close(self):
+        for column in (self.datetime,self.username,self.archived,self.message,self.uuid):
+            column.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+if __name__ == '__main__':
+    # python lib/audit_export.py users-audit.db audit-export
+    import sqlite3
+    stats = export_audits(sqlite3.connect(sys.argv[1]),sys.argv[2])
+    print(f"[+]Exported {stats['rows']} audits, {stats['bytes']} bytes in {stats['duration']:.3f}s ({stats['mb_per_sec']:.1f} MB/s)")
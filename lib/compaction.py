@@ -0,0 +1,107 @@
+"""Compaction of soft deleted users
+
+    python lib/compaction.py users-audit.db <retention_days> [batch_size] [incremental|full]
+
+Users deleted more than retention ago are moved to users_deleted table in batches,
+every batch with audits of purged users in the same transaction. Changes recorded
+before retention are pruned from change log.
+"""
+import time
+import logging
+
+from db import DatabaseManager, BackendError
+from model.user import User
+from model.audit import Audit
+
+logger = logging.getLogger(__name__)
+
+
+def compact_batch(older_than:int,batch_size:int=500) -> list:
+    """Move one batch of users deleted before older_than to users_deleted and audit it
+
+    Returns:
+        list: moved usernames
+    """
+    backend = DatabaseManager.get_write_backend()
+    if not hasattr(backend,'archive_deleted'):
+        raise BackendError("Compaction not supported by backend")
+    with backend.transaction():
+        moved = backend.archive_deleted(User._db_table,'username',older_than,batch_size)
+        audits = [Audit.create(**{'message':f"user {username} purged",'username':str(username)}) for username in moved]
+        for audit in audits:
+            audit.validate()
+        backend.save_many(audits)
+    if moved:
+        DatabaseManager.touch(User._db_table)
+        DatabaseManager.touch(Audit._db_table)
+    return moved
+
+
+def prune_changes(older_than:int,batch_size:int=500) -> int:
+    """Delete changes recorded before older_than in batches
+
+    Returns:
+        int: deleted changes, 0 if backend has no change log
+    """
+    backend = DatabaseManager.get_write_backend()
+    if not hasattr(backend,'prune_changes'):
+        return 0
+    pruned = 0
+    while True:
+        count = backend.prune_changes(older_than,batch_size)
+        pruned += count
+        if count < batch_size:
+            return pruned
+
+
+def compact_deleted_users(retention:float,batch_size:int=500,vacuum:str=None,pause:float=0) -> dict:
+    """Move users deleted more than retention seconds ago in batches, prune change log, then optionally vacuum
+
+    Args:
+        retention (float): seconds deleted users are kept in users table
+        batch_size (int): users moved per transaction
+        vacuum (str): None, incremental or full
+        pause (float): seconds between batches to let other writers in
+
+    Returns:
+        dict: rows, batches, changes_pruned, bytes_reclaimed, duration
+    """
+    started = time.monotonic()
+    older_than = int(time.time() - retention)
+    rows = batches = 0
+    while True:
+        moved = compact_batch(older_than,batch_size)
+        if not moved:
+            break
+        rows += len(moved)
+        batches += 1
+        logger.info("[COMPACTION] Batch %s: %s users moved",batches,len(moved))
+        if len(moved) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    # Deletion time of users left is in retention window, so their last changes are kept
+    changes_pruned = prune_changes(older_than,batch_size)
+    bytes_reclaimed = 0
+    if vacuum:
+        backend = DatabaseManager.get_write_backend()
+        if not hasattr(backend,'vacuum'):
+            raise BackendError("Vacuum not supported by backend")
+        bytes_reclaimed = backend.vacuum(vacuum)
+    stats = {'rows':rows,'batches':batches,'changes_pruned':changes_pruned,'bytes_reclaimed':bytes_reclaimed,
+        'duration':time.monotonic() - started}
+    logger.info("[COMPACTION] %s",stats)
+    return stats
+
+
+if __name__ == '__main__':
+    import sys
+    from db.sqlite import SqLiteBackend
+
+    logging.basicConfig(level=logging.INFO)
+    DatabaseManager.register_backend(SqLiteBackend(sys.argv[1]))
+    stats = compact_deleted_users(float(sys.argv[2]) * 86400,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 500,
+        sys.argv[4] if len(sys.argv) > 4 else None)
+    print(f"[+]Compacted {sys.argv[1]}: {stats['rows']} users in {stats['batches']} batches, "
+        f"{stats['bytes_reclaimed']} bytes reclaimed in {stats['duration']:.3f}s")
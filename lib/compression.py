@@ -0,0 +1,115 @@
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ZlibStream:
+    """Incremental gzip/deflate compressor"""
+
+    def __init__(self,level:int,wbits:int):
+        self._compressor = zlib.compressobj(level,zlib.DEFLATED,wbits)
+
+    def compress(self,data:bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliStream:
+    """Incremental brotli compressor"""
+
+    def __init__(self,level:int):
+        self._compressor = brotli.Compressor(quality=min(level,11))
+
+    def compress(self,data:bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdStream:
+    """Incremental zstd compressor"""
+
+    def __init__(self,level:int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self,data:bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+""" Supported encodings in server preference order """
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS['zstd'] = lambda level: ZstdStream(level)
+if brotli is not None:
+    ENCODINGS['br'] = lambda level: BrotliStream(level)
+ENCODINGS['gzip'] = lambda level: ZlibStream(level,31)
+ENCODINGS['deflate'] = lambda level: ZlibStream(level,15)
+
+
+def negotiate(accept_encoding:str):
+    """Select supported encoding accepted by client
+
+    Args:
+        accept_encoding (str): Accept-Encoding header
+
+    Returns:
+        str: encoding name or None for identity
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        accepted[name.strip().lower()] = q
+    candidates = [e for e in ENCODINGS if accepted.get(e,accepted.get('*',0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates,key=lambda e: accepted.get(e,accepted.get('*',0)))
+
+
+def compress(encoding:str,data:bytes,level:int=6) -> bytes:
+    stream = ENCODINGS[encoding](level)
+    return stream.compress(data) + stream.finish()
+
+
+def compress_stream(encoding:str,chunks,level:int=6):
+    """Compress iterable of chunks. Every chunk is flushed, so streamed events are not delayed"""
+    stream = ENCODINGS[encoding](level)
+    for chunk in chunks:
+        if isinstance(chunk,str):
+            chunk = chunk.encode()
+        yield stream.compress(chunk) + stream.flush()
+    yield stream.finish()
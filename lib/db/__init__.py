@@ -1,3 +1,4 @@
 
 from .backend import DbBackend,DbObject,BackendError, BackendErrorNotFound
 from .manager import DatabaseManager,ObjectManager
+from .registry import create_backend,register_driver
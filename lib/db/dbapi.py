@@ -0,0 +1,295 @@
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+from . import DbBackend,DbObject,BackendError, BackendErrorNotFound
+
+logger = logging.getLogger(__name__)
+
+# Max keys in one IN (...) clause
+BULK_CHUNK_SIZE = 500
+
+PLACEHOLDERS = {'qmark':'?','format':'%s','pyformat':'%s'}
+
+
+class ConnectionPool:
+    """Fixed size pool of DB-API connections. Connections are opened on demand
+       and pool is recreated in forked process
+    """
+
+    def __init__(self,connect,size:int=5,timeout:float=5.0):
+        """
+        Args:
+            connect (callable): returns new DB-API connection
+            size (int): max open connections
+            timeout (float): seconds to wait for free connection
+        """
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._pid = os.getpid()
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise BackendError(f"No free database connection in {self.timeout}s")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self,connection,discard:bool=False):
+        """Return connection to pool. Broken connection is closed instead"""
+        if discard:
+            try:
+                connection.close()
+            except Exception as ex:
+                logger.debug("[DBAPI] Close failed: %s",ex)
+        else:
+            self._idle.put(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        discard = False
+        try:
+            yield connection
+        except BaseException:
+            discard = not _rollback(connection)
+            raise
+        finally:
+            self.release(connection,discard)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _rollback(connection) -> bool:
+    try:
+        connection.rollback()
+        return True
+    except Exception:
+        return False
+
+
+class DbApiBackend(DbBackend):
+    """Backend for PostgreSQL/MySQL compatible servers using any DB-API 2.0 driver
+       (psycopg2, pymysql, sqlite3 for local runs and tests)
+
+    Note:
+        Statements use only portable SQL (no upserts, no DELETE ... LIMIT).
+        Change feed, audit rollups and table versions (ETag/Last-Modified) are not supported by this backend
+    """
+
+    def __init__(self,module,pool_size:int=5,pool_timeout:float=5.0,select_for_update:bool=True,**connect_args):
+        """
+        Args:
+            module: DB-API module
+            pool_size (int): max open connections
+            pool_timeout (float): seconds to wait for free connection
+            select_for_update (bool): lock rows selected for bulk update (not supported by sqlite)
+            connect_args: passed to module.connect
+        """
+        self.module = module
+        self.select_for_update = select_for_update
+        self.placeholder = PLACEHOLDERS[module.paramstyle]
+        self.pool = ConnectionPool(lambda: module.connect(**connect_args),pool_size,pool_timeout)
+        self._local = threading.local()
+
+    def close(self):
+        self.pool.close()
+
+    @contextmanager
+    def _cursor(self):
+        """Cursor of current transaction or of pooled connection committed on exit"""
+        connection = getattr(self._local,'connection',None)
+        try:
+            if connection is not None:
+                yield connection.cursor()
+                return
+            with self.pool.connection() as connection:
+                yield connection.cursor()
+                connection.commit()
+        except self.module.Error as ex:
+            raise BackendError(str(ex))
+
+    @contextmanager
+    def transaction(self):
+        """Writes inside context are committed once on exit or rolled back on exception
+        """
+        if getattr(self._local,'connection',None) is not None:
+            # Nested transaction is a part of outer one
+            yield
+            return
+        try:
+            with self.pool.connection() as connection:
+                self._local.connection = connection
+                try:
+                    yield
+                finally:
+                    self._local.connection = None
+                connection.commit()
+        except self.module.Error as ex:
+            raise BackendError(str(ex))
+
+    def _where(self,where_clause:dict) -> tuple:
+        if not where_clause:
+            return '',[]
+        where = ' AND '.join([f'{f}={self.placeholder}' for f in where_clause.keys()])
+        return ' WHERE ' + where, list(where_clause.values())
+
+    def _fetch(self,query:str,params) -> list:
+        logger.debug("[DBAPI]Query: %s : %s",query,params)
+        with self._cursor() as cursor:
+            cursor.execute(query,tuple(params))
+            col_name_list = [field[0] for field in cursor.description]
+            return [{c:row[i] for i,c in enumerate(col_name_list)} for row in cursor.fetchall()]
+
+    def _execute(self,query:str,params):
+        logger.debug("[DBAPI]Query: %s : %s",query,params)
+        with self._cursor() as cursor:
+            cursor.execute(query,tuple(params))
+            return cursor.rowcount
+
+    def save(self,model:DbObject):
+        key, value = model.get_db_key()
+        fields_to_save = model.get_db_updates()
+        params = list(fields_to_save.values())
+        if not value:
+            #New object. Insert
+            values_placeholder = ",".join([self.placeholder] * len(fields_to_save))
+            query = f"INSERT INTO {model._db_table} ({','.join(fields_to_save.keys())}) VALUES ({values_placeholder})"
+        else:
+            # Update object
+            values_placeholder = ','.join([f"{f}={self.placeholder}" for f in fields_to_save.keys()])
+            params.append(str(value))
+            query = f"UPDATE {model._db_table} SET {values_placeholder} WHERE {key}={self.placeholder}"
+        self._execute(query,params)
+
+    def delete(self,model:DbObject):
+        key, value = model.get_db_key()
+        self._execute(f"DELETE FROM {model._db_table} WHERE {key}={self.placeholder}",[str(value)])
+
+    def load_by_id(self,table:str, record_id:dict):
+        where, params = self._where(record_id)
+        rows = self._fetch(f"SELECT * from {table}{where} LIMIT 1",params)
+        if not rows:
+            raise BackendErrorNotFound('Not found')
+        return rows[0]
+
+    def load_list(self,table:str, where_clause:dict=None, order:str=None):
+        where, params = self._where(where_clause)
+        query = f"SELECT * from {table}{where}"
+        if order:
+            query = query + f' ORDER BY {order}'
+        return self._fetch(query,params)
+
+    def load_page(self,table:str,where_clause:dict=None,order:str=None,limit:int=100,after=None) -> list:
+        """Keyset pagination: up to limit records with `order` field greater than `after`
+
+        Args:
+            table (str): database table
+            where_clause (dict): where clause filter
+            order (str): unique field to order by
+            limit (int): page size
+            after: `order` value of last record of previous page, None - first page
+
+        Returns:
+            List[dict]: page records
+        """
+        where, params = self._where(where_clause)
+        if after is not None:
+            where = (where + ' AND ' if where else ' WHERE ') + f"{order}>{self.placeholder}"
+            params.append(after)
+        return self._fetch(f"SELECT * from {table}{where} ORDER BY {order} LIMIT {int(limit)}",params)
+
+    def save_many(self,models:list):
+        """Insert new models of the same table with one executemany
+
+        Args:
+            models (List[DbObject]): new validated models
+        """
+        if not models:
+            return
+        table = models[0]._db_table
+        fields_names = list(models[0].get_db_updates().keys())
+        values_placeholder = ",".join([self.placeholder] * len(fields_names))
+        query = f"INSERT INTO {table} ({','.join(fields_names)}) VALUES ({values_placeholder})"
+        rows = [tuple(m.get_db_updates()[f] for f in fields_names) for m in models]
+        logger.debug("[DBAPI][SAVE_MANY]Query: %s : %s rows",query,len(rows))
+        with self.transaction(), self._cursor() as cursor:
+            cursor.executemany(query,rows)
+
+    def bulk_update(self,table:str,updates:dict,key:str,keys:list=None,where_clause:dict=None) -> list:
+        """Set-based update of all records matching keys list and/or where clause
+
+        Args:
+            table (str): database table
+            updates (dict): fields to set
+            key (str): key field name
+            keys (list): update only records with these keys
+            where_clause (dict): where clause filter
+
+        Returns:
+            list: keys of updated records
+        """
+        where, where_params = self._where(where_clause)
+        chunks = [None] if keys is None else [keys[i:i + BULK_CHUNK_SIZE] for i in range(0,len(keys),BULK_CHUNK_SIZE)]
+        set_placeholder = ','.join([f"{f}={self.placeholder}" for f in updates.keys()])
+        updated = []
+        with self.transaction():
+            for chunk in chunks:
+                chunk_where, params = where, list(where_params)
+                if chunk is not None:
+                    in_clause = f"{key} IN ({','.join([self.placeholder] * len(chunk))})"
+                    chunk_where = (chunk_where + ' AND ' if chunk_where else ' WHERE ') + in_clause
+                    params.extend(str(k) for k in chunk)
+                # Lock selected rows so returned keys match updated ones
+                lock = ' FOR UPDATE' if self.select_for_update else ''
+                chunk_keys = [row[key] for row in self._fetch(f"SELECT {key} from {table}{chunk_where}{lock}",params)]
+                if not chunk_keys:
+                    continue
+                self._execute(f"UPDATE {table} SET {set_placeholder}{chunk_where}",[*updates.values(),*params])
+                updated.extend(chunk_keys)
+        return updated
+
+    def rotate(self,table:str,max_size:int=100) -> bool:
+        """ This is custom function for rotating audits: keep max_size newest records,
+            move older ones to {table}_archive
+
+        Note:
+            Records with the same datetime as the oldest kept one are kept too
+        """
+        if max_size < 1:
+            raise BackendError('max_size should be at least 1')
+        with self.transaction():
+            # Oldest record to keep
+            rows = self._fetch(f"SELECT datetime from {table} ORDER BY datetime DESC LIMIT 1 OFFSET {int(max_size) - 1}",())
+            if not rows:
+                return False
+            cutoff = rows[0]['datetime']
+            logger.debug("[DBAPI][ROTATE] Archive %s older than %s",table,cutoff)
+            self._execute(f"INSERT INTO {table}_archive SELECT * from {table} WHERE datetime<{self.placeholder}",[cutoff])
+            self._execute(f"DELETE FROM {table} WHERE datetime<{self.placeholder}",[cutoff])
+        return True
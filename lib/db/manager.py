@@ -1,30 +1,300 @@
+import contextlib
+import itertools
+import threading
+import time
+import uuid
 from abc import ABC
+from contextvars import ContextVar
 from typing import Type
-from . import DbBackend,DbObject
+from . import DbBackend,DbObject,BackendError
+
+# Time (time.time()) of last write of current client, reads are served by replicas having it
+_last_write = ContextVar('last_write',default=None)
+_unit_of_work = ContextVar('unit_of_work',default=None)
+
+
+class UnitOfWork:
+    """Collects model writes and flushes them in one backend transaction.
+       Set-based writes (execute) need their result at once: they start backend transaction,
+       collected and following writes are applied in it and it is committed on flush
+    """
+
+    def __init__(self):
+        self._operations = []
+        # (table,operation,rows) passed to listeners after commit
+        self._changes = []
+        self._transaction = None
+
+    def add(self,operation:str,model:DbObject):
+        if self._transaction is not None:
+            self._apply(DatabaseManager.get_write_backend(),[(operation,model)])
+        elif (operation,model) not in self._operations:
+            self._operations.append((operation,model))
+
+    def execute(self,operation:str,*args):
+        """Call backend write method in transaction of unit and return its result
+        """
+        backend = DatabaseManager.get_write_backend()
+        if self._transaction is None:
+            self._transaction = contextlib.ExitStack()
+            self._transaction.enter_context(backend.transaction() if hasattr(backend,'transaction') else contextlib.nullcontext())
+            operations, self._operations = self._operations, []
+            self._apply(backend,operations)
+        return getattr(backend,operation)(*args)
+
+    def changed(self,table:str,operation:str,rows:list):
+        self._changes.append((table,operation,rows))
+
+    def _apply(self,backend,operations:list):
+        for operation,model in operations:
+            getattr(backend,operation)(model)
+            self.changed(model._db_table,operation,[DatabaseManager.written_row(operation,model)])
+
+    def flush(self):
+        if self._transaction is not None:
+            transaction, self._transaction = self._transaction, None
+            transaction.close()
+        operations, self._operations = self._operations, []
+        if operations:
+            backend = DatabaseManager.get_write_backend()
+            if hasattr(backend,'write_unit'):
+                # Group commit backends apply unit with other writers in one commit
+                transaction = backend.write_unit()
+            elif hasattr(backend,'transaction'):
+                transaction = backend.transaction()
+            else:
+                transaction = contextlib.nullcontext()
+            with transaction:
+                self._apply(backend,operations)
+        changes, self._changes = self._changes, []
+        if not changes:
+            return
+        _last_write.set(time.time())
+        for table in dict.fromkeys(table for table,_,_ in changes):
+            DatabaseManager.touch(table)
+        for table,operation,rows in changes:
+            DatabaseManager.notify(table,operation,rows)
+
+    def rollback(self,exc:BaseException=None):
+        self._operations = []
+        self._changes = []
+        if self._transaction is not None:
+            transaction, self._transaction = self._transaction, None
+            exc = exc or BackendError("Unit of work rolled back")
+            transaction.__exit__(type(exc),exc,exc.__traceback__)
+
 
 class DatabaseManager:
 
     backend:DbBackend = None
+    replicas:list = []
+    # Replicas lagging more than max_staleness seconds are skipped. None - no limit
+    max_staleness:float = None
+    _replica_counter = itertools.count()
 
     @classmethod
-    def register_backend(cls,backend:DbBackend):
+    def register_backend(cls,backend:DbBackend,replicas:list=None):
         cls.backend = backend
+        cls.replicas = list(replicas or [])
 
     @classmethod
     def get_backend(cls) -> DbBackend:
         return cls.backend
 
+    @classmethod
+    def get_write_backend(cls) -> DbBackend:
+        """Returns primary backend and makes following reads in current context sticky to primary
+           (until replica is refreshed after the write)
+        """
+        _last_write.set(time.time())
+        return cls.backend
+
+    @classmethod
+    def last_write(cls) -> float:
+        """Time of last write in current context (or passed by clear_sticky), None if there were no writes
+        """
+        return _last_write.get()
+
+    @classmethod
+    def write(cls,operation:str,model:DbObject):
+        """Save/delete model now or in current unit of work
+
+        Args:
+            operation (str): backend method: save or delete
+            model (DbObject): model to write
+        """
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.add(operation,model)
+            return
+        getattr(cls.get_write_backend(),operation)(model)
+        _last_write.set(time.time())
+        cls.changed(model._db_table,operation,[cls.written_row(operation,model)])
+
+    @classmethod
+    def bulk_write(cls,operation:str,*args):
+        """Call set-based backend write method (bulk_update, save_many) and return its result.
+           In unit of work it is done in the transaction of unit (committed on flush)
+
+        Args:
+            operation (str): backend method
+            args: method arguments
+        """
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None:
+            return unit_of_work.execute(operation,*args)
+        result = getattr(cls.get_write_backend(),operation)(*args)
+        _last_write.set(time.time())
+        return result
+
+    @classmethod
+    def changed(cls,table:str,operation:str,rows:list):
+        """Bump table version and pass written rows to listeners now
+           or after current unit of work is committed
+        """
+        unit_of_work = _unit_of_work.get()
+        if unit_of_work is not None:
+            unit_of_work.changed(table,operation,rows)
+            return
+        cls.touch(table)
+        cls.notify(table,operation,rows)
+
+    _listeners = []
+
+    @classmethod
+    def add_listener(cls,listener):
+        """Register callable(table,operation,rows) called after models are written
+        """
+        cls._listeners.append(listener)
+
+    @classmethod
+    def notify(cls,table:str,operation:str,rows:list):
+        """Pass written rows (key and updated fields) to listeners
+        """
+        for listener in cls._listeners:
+            listener(table,operation,rows)
+
+    @staticmethod
+    def written_row(operation:str,model:DbObject) -> dict:
+        key,value = model.get_db_key()
+        row = model.get_db_updates() if operation == 'save' else {}
+        if value is not None:
+            row = {**row,key:str(value)}
+        return row
+
+    @classmethod
+    @contextlib.contextmanager
+    def unit_of_work(cls):
+        """Defer writes made inside context and flush them in one transaction on exit.
+           Writes are discarded if context exits with exception. Nested context is a part of outer one
+        """
+        if _unit_of_work.get() is not None:
+            yield _unit_of_work.get()
+            return
+        unit_of_work = UnitOfWork()
+        token = _unit_of_work.set(unit_of_work)
+        try:
+            yield unit_of_work
+        except BaseException as ex:
+            unit_of_work.rollback(ex)
+            raise
+        finally:
+            _unit_of_work.reset(token)
+        unit_of_work.flush()
+
+    @classmethod
+    def get_read_backend(cls) -> DbBackend:
+        """Returns replica backend (round robin) or primary if no fresh replica available.
+           Replicas refreshed before last write of current context are skipped (read-your-writes)
+        """
+        if not cls.replicas:
+            return cls.backend
+        last_write = _last_write.get()
+        replicas = [r for r in cls.replicas if cls._is_fresh(r) and cls._has_write(r,last_write)]
+        if not replicas:
+            return cls.backend
+        return replicas[next(cls._replica_counter) % len(replicas)]
+
+    @classmethod
+    def clear_sticky(cls,last_write:float=None):
+        """Start new read-your-writes context (called on request start)
+
+        Args:
+            last_write (float): time of last write of the client (e.g. from cookie), made by any process
+        """
+        _last_write.set(last_write)
+
+    _versions = {}
+    _modified = {}
+    _data_version = None
+    _epoch = uuid.uuid4().hex[:8]
+    _started = time.time()
+    _versions_lock = threading.Lock()
+
+    @classmethod
+    def touch(cls,table:str):
+        """Bump table version on every change (used for ETag/Last-Modified)
+        """
+        with cls._versions_lock:
+            cls._versions[table] = cls._versions.get(table,0) + 1
+            cls._modified[table] = time.time()
+
+    @classmethod
+    def table_version(cls,table:str):
+        """Returns current table version and last modification time
+
+        Note:
+            If backend persists table versions (table_version()) they are shared by all processes.
+            Otherwise version is counted by touch() in this process and backend data_version()
+            (changes committed by other processes) is a part of it. Backend without both has no
+            version shared by workers, so there is no version at all
+
+        Returns:
+            tuple: (version:str, last_modified:float) or None
+        """
+        if hasattr(cls.backend,'table_version'):
+            shared = cls.backend.table_version(table)
+            if shared is not None:
+                version, modified = shared
+                return f"{version}.{modified}", modified
+        if not hasattr(cls.backend,'data_version'):
+            return None
+        data_version = cls.backend.data_version()
+        with cls._versions_lock:
+            if data_version != cls._data_version:
+                if cls._data_version is not None:
+                    now = time.time()
+                    cls._modified = {t:now for t in cls._modified}
+                    cls._started = now
+                cls._data_version = data_version
+            version = f"{cls._epoch}.{cls._versions.get(table,0)}.{data_version}"
+            return version, cls._modified.get(table,cls._started)
+
+    @classmethod
+    def _is_fresh(cls,replica) -> bool:
+        if cls.max_staleness is None or not hasattr(replica,'staleness'):
+            return True
+        return replica.staleness() <= cls.max_staleness
+
+    @staticmethod
+    def _has_write(replica,last_write:float) -> bool:
+        # Replicas without refreshed_at read primary database itself
+        if last_write is None or getattr(replica,'refreshed_at',None) is None:
+            return True
+        return replica.refreshed_at >= last_write
+
 
 class ObjectManager:
 
     @staticmethod
     def get_one(model:Type[DbObject],where_clause:dict):
-        model_data = DatabaseManager.get_backend().load_by_id(model._db_table, where_clause)
+        model_data = DatabaseManager.get_read_backend().load_by_id(model._db_table, where_clause)
         return model(**model_data)
 
     @staticmethod
-    def get_many(model:Type[DbObject],where_clause:dict=None,order=None):
-        # TODO: order not supported yet
-        objects_data = DatabaseManager.get_backend().load_list(model._db_table, where_clause)
+    def get_many(model:Type[DbObject],where_clause:dict=None,order:str=None):
+        if order:
+            objects_data = DatabaseManager.get_read_backend().load_list(model._db_table, where_clause, order)
+        else:
+            objects_data = DatabaseManager.get_read_backend().load_list(model._db_table, where_clause)
         return [model(**o) for o in objects_data]
-
@@ -0,0 +1,254 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from . import DbBackend,DbObject,BackendErrorNotFound
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryCacheBackend(DbBackend):
+    """Memory resident copy of small tables on top of persistent backend
+
+    Note:
+        Cached tables are loaded on startup and served from memory. Writes go to
+        wrapped backend first, then cached row is refreshed (write through).
+        Writes committed by other processes are detected by backend data_version()
+        before reads: rows changed since last read are reloaded using change log
+        (whole tables if backend has no change log). Other tables and methods are passed
+        to wrapped backend as is.
+    """
+
+    """ Cached tables: table => key field """
+    cached_tables = {'users':'username'}
+    """ Secondary indexes: table => list of fields """
+    indexes = {'users':['deleted']}
+    """ Max changes of other processes applied row by row, more reload whole tables """
+    sync_max_changes = 10000
+
+    def __init__(self,backend:DbBackend,cached_tables:dict=None,indexes:dict=None,verify_reads=False):
+        self.backend = backend
+        if cached_tables is not None:
+            self.cached_tables = cached_tables
+        if indexes is not None:
+            self.indexes = indexes
+        self.verify_reads = verify_reads
+        self._lock = threading.RLock()
+        self._unit = threading.local()
+        self._rows = {}
+        self._index = {}
+        self.warmup_time = None
+        self._data_version = None
+        self._change_seq = None
+        self.warmup()
+
+    def __getattr__(self,name):
+        # rotate, backup etc.
+        if name == 'backend':
+            raise AttributeError(name)
+        return getattr(self.backend,name)
+
+    def warmup(self):
+        """Load cached tables from wrapped backend"""
+        started = time.monotonic()
+        with self._lock:
+            self._data_version = self.backend.data_version() if hasattr(self.backend,'data_version') else None
+            self._change_seq = self.backend.changes_seq() if hasattr(self.backend,'changes_seq') else None
+            self._rows = {table:{} for table in self.cached_tables}
+            self._index = {table:{f:{} for f in self.indexes.get(table,[])} for table in self.cached_tables}
+            for table in self.cached_tables:
+                for row in self.backend.load_list(table):
+                    self._put(table,row)
+        self.warmup_time = time.monotonic() - started
+        logger.debug("[MEMORY][WARMUP] %s rows in %.3fs",{t:len(r) for t,r in self._rows.items()},self.warmup_time)
+
+    def sync(self):
+        """Apply writes committed by other processes since last call"""
+        if self._data_version is None:
+            return
+        data_version = self.backend.data_version()
+        if data_version == self._data_version:
+            return
+        with self._lock:
+            if data_version == self._data_version:
+                return
+            seq = self._change_seq
+            last_seq = self.backend.changes_seq() if seq is not None else None
+            if last_seq is None or last_seq < seq or last_seq - seq > self.sync_max_changes:
+                # No change log or it was replaced (restore)
+                logger.info("[MEMORY][SYNC] Reload cached tables")
+                self.warmup()
+                return
+            changed = set()
+            if last_seq > seq:
+                for change in self.backend.load_changes(seq,last_seq - seq):
+                    if change['table_name'] in self.cached_tables:
+                        changed.add((change['table_name'],change['record_key']))
+            for table,key in changed:
+                try:
+                    self._put(table,self.backend.load_by_id(table,{self.cached_tables[table]:key}))
+                except BackendErrorNotFound:
+                    self._remove(table,key)
+            logger.debug("[MEMORY][SYNC] %s rows reloaded",len(changed))
+            self._data_version = data_version
+            self._change_seq = last_seq
+
+    def _put(self,table,row):
+        key = row[self.cached_tables[table]]
+        self._remove(table,key)
+        self._rows[table][key] = row
+        for field,index in self._index[table].items():
+            index.setdefault(row[field],set()).add(key)
+
+    def _remove(self,table,key):
+        row = self._rows[table].pop(key,None)
+        if row is None:
+            return
+        for field,index in self._index[table].items():
+            index.get(row[field],set()).discard(key)
+
+    def _match(self,table,where_clause:dict):
+        where_clause = dict(where_clause or {})
+        rows = self._rows[table]
+        key_name = self.cached_tables[table]
+        if key_name in where_clause:
+            key = where_clause.pop(key_name)
+            candidates = [key] if key in rows else []
+        else:
+            candidates = None
+            for field in list(where_clause):
+                if field in self._index[table]:
+                    keys = self._index[table][field].get(where_clause.pop(field),set())
+                    candidates = keys if candidates is None else candidates & keys
+            if candidates is None:
+                candidates = rows.keys()
+        return [dict(rows[k]) for k in candidates if all(rows[k].get(f) == v for f,v in where_clause.items())]
+
+    @contextmanager
+    def transaction(self):
+        """Wrapped backend transaction. Cache is reloaded if transaction rolled back"""
+        try:
+            with self.backend.transaction():
+                yield
+        except BaseException:
+            self.warmup()
+            raise
+
+    @contextmanager
+    def write_unit(self):
+        """Wrapped backend write unit (transaction if not supported).
+           Cached rows are refreshed when unit is applied, reloaded if it failed
+        """
+        if getattr(self._unit,'models',None) is not None:
+            yield
+            return
+        unit = self.backend.write_unit if hasattr(self.backend,'write_unit') else self.backend.transaction
+        self._unit.models = []
+        try:
+            with unit():
+                yield
+            models = self._unit.models
+        except BaseException:
+            self.warmup()
+            raise
+        finally:
+            self._unit.models = None
+        for model in models:
+            self._refresh(model)
+
+    def save(self,model:DbObject):
+        self.backend.save(model)
+        if getattr(self._unit,'models',None) is not None:
+            # Written with unit
+            self._unit.models.append(model)
+            return
+        self._refresh(model)
+
+    def delete(self,model:DbObject):
+        self.backend.delete(model)
+        if getattr(self._unit,'models',None) is not None:
+            self._unit.models.append(model)
+            return
+        if model._db_table in self.cached_tables:
+            _, value = model.get_db_key()
+            with self._lock:
+                self._remove(model._db_table,str(value))
+
+    def save_many(self,models:list):
+        self.backend.save_many(models)
+        for model in models:
+            self._refresh(model)
+
+    def bulk_update(self,table:str,updates:dict,key:str,keys:list=None,where_clause:dict=None) -> list:
+        updated = self.backend.bulk_update(table,updates,key,keys,where_clause)
+        if table in self.cached_tables:
+            with self._lock:
+                for k in updated:
+                    self._put(table,self.backend.load_by_id(table,{key:k}))
+        return updated
+
+    def archive_deleted(self,table:str,key:str,older_than:int,limit:int=500) -> list:
+        moved = self.backend.archive_deleted(table,key,older_than,limit)
+        if table in self.cached_tables:
+            with self._lock:
+                for k in moved:
+                    self._remove(table,k)
+        return moved
+
+    def _refresh(self,model:DbObject):
+        table = model._db_table
+        if table not in self.cached_tables:
+            return
+        key, value = model.get_db_key()
+        if not value:
+            value = model.get_db_updates()[key]
+        with self._lock:
+            try:
+                self._put(table,self.backend.load_by_id(table,{key:str(value)}))
+            except BackendErrorNotFound:
+                self._remove(table,str(value))
+
+    def load_by_id(self,table:str, record_id:dict):
+        if table not in self.cached_tables:
+            return self.backend.load_by_id(table,record_id)
+        self.sync()
+        with self._lock:
+            rows = self._match(table,record_id)
+        if not rows:
+            raise BackendErrorNotFound('Not found')
+        return rows[0]
+
+    def load_list(self,table:str, where_clause:dict=None, order:str=None):
+        if table not in self.cached_tables:
+            if order:
+                return self.backend.load_list(table,where_clause,order)
+            return self.backend.load_list(table,where_clause)
+        self.sync()
+        with self._lock:
+            rows = self._match(table,where_clause)
+        if order:
+            rows.sort(key=lambda row: row[order])
+        if self.verify_reads:
+            self._verify(table,rows,self.backend.load_list(table,where_clause))
+        return rows
+
+    def _verify(self,table,rows,expected):
+        key_name = self.cached_tables[table]
+        if sorted(rows,key=lambda r: r[key_name]) != sorted(expected,key=lambda r: r[key_name]):
+            logger.warning("[MEMORY][VERIFY] Cached %s differs from backend",table)
+
+    def check_consistency(self) -> dict:
+        """Compare cached tables with wrapped backend
+
+        Returns:
+            dict: table => list of keys which differ (missing, extra or changed)
+        """
+        differences = {}
+        for table,key_name in self.cached_tables.items():
+            stored = {row[key_name]:row for row in self.backend.load_list(table)}
+            with self._lock:
+                cached = dict(self._rows[table])
+            keys = set(stored) | set(cached)
+            differences[table] = sorted(k for k in keys if stored.get(k) != cached.get(k))
+        return differences
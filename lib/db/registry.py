@@ -0,0 +1,65 @@
+import importlib
+import logging
+
+from . import DbBackend, BackendError
+
+logger = logging.getLogger(__name__)
+
+_drivers = {}
+
+# DB_NAME of settings template. Settings made from it before DB_DRIVER was supported
+# (DB_DRIVER="mysql" never used) are run with sqlite database as before
+PLACEHOLDER_DB_NAME = 'your_db_name'
+SQLITE_DB_NAME = 'users-audit.db'
+
+def register_driver(name:str,factory):
+    """Register backend factory for settings.DB_DRIVER value
+
+    Args:
+        name (str): driver name
+        factory (callable): factory(config) -> DbBackend
+    """
+    _drivers[name] = factory
+
+def create_backend(config) -> DbBackend:
+    """Create backend selected by config.DB_DRIVER (default sqlite)
+    """
+    driver = getattr(config,'DB_DRIVER','sqlite')
+    if driver != 'sqlite' and getattr(config,'DB_NAME',None) == PLACEHOLDER_DB_NAME:
+        logger.warning("DB_NAME is not configured for DB_DRIVER %s, using sqlite %s",driver,SQLITE_DB_NAME)
+        driver = 'sqlite'
+    if driver not in _drivers:
+        raise BackendError(f"Unknown DB_DRIVER {driver}. Available: {sorted(_drivers)}")
+    return _drivers[driver](config)
+
+
+def _sqlite_backend(config):
+    from .sqlite import SqLiteBackend
+    db_name = getattr(config,'DB_NAME',SQLITE_DB_NAME)
+    if db_name == PLACEHOLDER_DB_NAME:
+        db_name = SQLITE_DB_NAME
+    return SqLiteBackend(db_name,
+        timeout=getattr(config,'DB_TIMEOUT',5.0),group_commit=getattr(config,'DB_GROUP_COMMIT',False))
+
+def _dbapi_factory(module_name:str,connect_args):
+    def factory(config):
+        from .dbapi import DbApiBackend
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as ex:
+            raise BackendError(f"{config.DB_DRIVER} driver requires {module_name}: {ex}")
+        return DbApiBackend(module,pool_size=getattr(config,'DB_POOL_SIZE',5),
+            pool_timeout=getattr(config,'DB_TIMEOUT',5.0),**connect_args(config))
+    return factory
+
+def _mysql_args(config):
+    return dict(host=getattr(config,'DB_HOST','localhost'),port=getattr(config,'DB_PORT',3306),
+        database=config.DB_NAME,user=config.DB_USER,password=config.DB_PASS)
+
+def _postgresql_args(config):
+    return dict(host=getattr(config,'DB_HOST','localhost'),port=getattr(config,'DB_PORT',5432),
+        dbname=config.DB_NAME,user=config.DB_USER,password=config.DB_PASS)
+
+register_driver('sqlite',_sqlite_backend)
+register_driver('mysql',_dbapi_factory('pymysql',_mysql_args))
+register_driver('postgresql',_dbapi_factory('psycopg2',_postgresql_args))
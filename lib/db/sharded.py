@@ -0,0 +1,238 @@
+import heapq
+import logging
+import threading
+import zlib
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from . import DbBackend,DbObject,BackendError, BackendErrorNotFound
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedBackend(DbBackend):
+    """Routes objects across multiple backends by hash of object key
+
+    Note:
+        Point operations go to one shard. load_list and bulk_update fan out to all shards in parallel
+        and merge results. Transactions are atomic per shard only.
+    """
+
+    """ Shard key field per table. Lookups without shard key go to all shards """
+    shard_keys = {
+        'users':'username',
+        'audit':'uuid',
+        'audit_archive':'uuid',
+    }
+
+    def __init__(self,shards:list,shard_keys:dict=None):
+        if not shards:
+            raise BackendError('At least one shard required')
+        self.shards = list(shards)
+        if shard_keys:
+            self.shard_keys = {**self.shard_keys,**shard_keys}
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+        self._local = threading.local()
+
+    @classmethod
+    def from_paths(cls,db_paths:list,**kwargs):
+        from .sqlite import SqLiteBackend
+        return cls([SqLiteBackend(p) for p in db_paths],**kwargs)
+
+    def shard_index(self,key_value) -> int:
+        return zlib.crc32(str(key_value).encode()) % len(self.shards)
+
+    def get_shard(self,key_value) -> DbBackend:
+        return self.shards[self.shard_index(key_value)]
+
+    def _model_shard_index(self,model:DbObject) -> int:
+        key, value = model.get_db_key()
+        if not value:
+            value = model.get_db_updates()[key]
+        return self.shard_index(value)
+
+    def close(self):
+        """ Stop fan out threads and close shards """
+        self._executor.shutdown(wait=True)
+        for shard in self.shards:
+            if hasattr(shard,'close'):
+                shard.close()
+
+    def _fan_out(self,func,*args):
+        return list(self._executor.map(lambda shard: func(shard,*args),self.shards))
+
+    @contextmanager
+    def transaction(self):
+        """Writes (save, delete) inside context are queued and applied on exit in transaction
+           of every shard they go to. Shard transactions are started in shard order, so concurrent
+           transactions do not deadlock, and committed together
+
+        Note:
+            Writes are not visible to reads inside context. If commit of one shard fails,
+            shards committed before it keep their writes
+        """
+        if getattr(self._local,'writes',None) is not None:
+            yield
+            return
+        self._local.writes = []
+        try:
+            yield
+            writes = self._local.writes
+        finally:
+            self._local.writes = None
+        by_shard = {}
+        for index,operation,model in writes:
+            by_shard.setdefault(index,[]).append((operation,model))
+        if len(by_shard) > 1:
+            logger.debug("[SHARDED][TRANSACTION] %s writes to shards %s",len(writes),sorted(by_shard))
+        with ExitStack() as stack:
+            for index in sorted(by_shard):
+                if hasattr(self.shards[index],'transaction'):
+                    stack.enter_context(self.shards[index].transaction())
+            for index in sorted(by_shard):
+                for operation,model in by_shard[index]:
+                    getattr(self.shards[index],operation)(model)
+
+    def _write(self,operation:str,model:DbObject):
+        writes = getattr(self._local,'writes',None)
+        index = self._model_shard_index(model)
+        if writes is not None:
+            writes.append((index,operation,model))
+            return
+        getattr(self.shards[index],operation)(model)
+
+    def save(self,model:DbObject):
+        self._write('save',model)
+
+    def delete(self,model:DbObject):
+        self._write('delete',model)
+
+    def save_many(self,models:list):
+        """ Insert new models with one save_many per shard, in transaction of shards they go to """
+        by_shard = {}
+        for model in models:
+            by_shard.setdefault(self._model_shard_index(model),[]).append(model)
+        with self.transaction():
+            for index,shard_models in sorted(by_shard.items()):
+                self._local.writes.append((index,'save_many',shard_models))
+
+    def bulk_update(self,table:str,updates:dict,key:str,keys:list=None,where_clause:dict=None) -> list:
+        """Set-based update on shards of keys (if key is shard key) or on all shards
+
+        Note:
+            Update is applied immediately in transaction of every shard, not on exit of transaction()
+
+        Returns:
+            list: keys of updated records
+        """
+        if keys is not None and key == self.shard_keys.get(table):
+            by_shard = {}
+            for value in keys:
+                by_shard.setdefault(self.shard_index(value),[]).append(value)
+            results = [self.shards[index].bulk_update(table,updates,key,shard_keys,where_clause)
+                for index,shard_keys in sorted(by_shard.items())]
+        else:
+            results = self._fan_out(lambda shard: shard.bulk_update(table,updates,key,keys,where_clause))
+        return [value for updated in results for value in updated]
+
+    def load_by_id(self,table:str, record_id:dict):
+        key = self.shard_keys.get(table)
+        if key in record_id:
+            return self.get_shard(record_id[key]).load_by_id(table,dict(record_id))
+
+        def load_from_shard(shard):
+            try:
+                return shard.load_by_id(table,dict(record_id))
+            except BackendErrorNotFound:
+                return None
+
+        for row in self._fan_out(load_from_shard):
+            if row is not None:
+                return row
+        raise BackendErrorNotFound('Not found')
+
+    def load_list(self,table:str, where_clause:dict=None, order:str=None):
+        if order:
+            results = self._fan_out(lambda shard: shard.load_list(table,where_clause,order))
+            return list(heapq.merge(*results,key=lambda row: row[order]))
+        results = self._fan_out(lambda shard: shard.load_list(table,where_clause))
+        return [row for rows in results for row in rows]
+
+    def table_version(self,table:str):
+        """Table version made of persisted versions of all shards, last modification time of any shard
+
+        Returns:
+            tuple: (version:str, last_modified:float), None if some shard has no persisted versions
+        """
+        if not all(hasattr(shard,'table_version') for shard in self.shards):
+            return None
+        versions = [shard.table_version(table) for shard in self.shards]
+        return '.'.join(str(v) for v,_ in versions), max(m for _,m in versions)
+
+    def rotate(self,table:str,max_size:int=100) -> bool:
+        """ Rotate each shard keeping max_size records in total """
+        shard_max_size = max(1,max_size // len(self.shards))
+        return any(self._fan_out(lambda shard: shard.rotate(table,shard_max_size)))
+
+
+def rebalance(source_paths:list,target_paths:list,tables=('users','audit','audit_archive')):
+    """Copy all rows from source shards to new target shards using target shards count
+
+    Note:
+        Target files are created from scratch and should not overlap source files.
+        Changes go to shard of their record with new sequence numbers (change feed readers start over),
+        audit rollups are recounted and table versions get new modification time
+
+    Returns:
+        list: rows of `tables` copied to every target shard
+    """
+    import sqlite3
+    import time
+    from .sqlite import init_database
+
+    if set(source_paths) & set(target_paths):
+        raise BackendError('Target shards should not overlap source shards')
+    for path in target_paths:
+        init_database(path)
+
+    target = ShardedBackend.from_paths(target_paths)
+    counts = [0] * len(target_paths)
+    versions = {}
+    for path in source_paths:
+        source = sqlite3.connect(path)
+        for table in tables:
+            key = target.shard_keys[table]
+            cursor = source.execute(f"SELECT * from {table}")
+            columns = [field[0] for field in cursor.description]
+            key_index = columns.index(key)
+            query = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join(['?'] * len(columns))})"
+            for row in cursor:
+                index = target.shard_index(row[key_index])
+                target.shards[index].connection.execute(query,row)
+                counts[index] += 1
+        source_tables = {row[0] for row in source.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if 'changes' in source_tables:
+            cursor = source.execute("SELECT table_name,record_key,operation,datetime FROM changes ORDER BY seq")
+            for row in cursor:
+                target.shards[target.shard_index(row[1])].connection.execute(
+                    "INSERT INTO changes (table_name,record_key,operation,datetime) VALUES (?,?,?,?)",row)
+        if 'table_versions' in source_tables:
+            for table,version in source.execute("SELECT table_name,version FROM table_versions"):
+                versions[table] = max(versions.get(table,0),version)
+        source.close()
+    now = time.time()
+    for shard in target.shards:
+        # Versions were served before, new modification time makes them unique
+        shard.connection.executemany("INSERT INTO table_versions (table_name,version,modified) VALUES (?,?,?)",
+            [(table,version + 1,now) for table,version in versions.items()])
+        shard.connection.commit()
+        shard.rebuild_audit_rollup()
+    logger.debug("[SHARDED][REBALANCE] Rows per shard: %s",counts)
+    target.close()
+    return counts
+
+
+if __name__ == '__main__':
+    import sys
+    # python -m lib.db.sharded old1.db,old2.db new1.db,new2.db,new3.db
+    print(f"[+]Rows per shard: {rebalance(sys.argv[1].split(','),sys.argv[2].split(','))}")
@@ -1,14 +1,263 @@
 import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
 from . import DbBackend,DbObject,BackendError, BackendErrorNotFound
 
 logger = logging.getLogger(__name__)
 
+# Max keys in one IN (...) clause
+BULK_CHUNK_SIZE = 500
+
+# Audit rollup granularity, seconds
+ROLLUP_BUCKET = 3600
+ROLLUP_TABLE = "CREATE TABLE IF NOT EXISTS audit_rollup (username TEXT, bucket NUMBER, count NUMBER, PRIMARY KEY (username,bucket))"
+ROLLUP_UPSERT = "INSERT INTO audit_rollup (username,bucket,count) VALUES (?,?,?) ON CONFLICT (username,bucket) DO UPDATE SET count=count+excluded.count"
+
+CHANGES_TABLE = "CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT, record_key TEXT, operation TEXT, datetime NUMBER)"
+CHANGES_INDEX = "CREATE INDEX IF NOT EXISTS changes_record ON changes (table_name,record_key)"
+
+# Table version and last modification time, bumped in every write transaction (ETag/Last-Modified shared by processes)
+VERSIONS_TABLE = "CREATE TABLE IF NOT EXISTS table_versions (table_name TEXT PRIMARY KEY, version NUMBER, modified NUMBER)"
+VERSIONS_UPSERT = ("INSERT INTO table_versions (table_name,version,modified) VALUES (?,1,?) "
+                   "ON CONFLICT (table_name) DO UPDATE SET version=version+1, modified=excluded.modified")
+
 
 class SqLiteBackend(DbBackend):
-    def __init__(self,db_path):
-        self.connection = sqlite3.connect(db_path,check_same_thread=False)
+    def __init__(self,db_path,timeout:float=5.0,retries:int=3,retry_delay:float=0.05,
+                 group_commit:bool=False,group_size:int=64,group_delay:float=0.002):
+        """
+        Note:
+            Connection is opened lazily on first use and reopened in forked process,
+            so backend can be created before pre-fork server starts workers.
+            In group commit mode concurrent writes are applied by single writer thread,
+            up to group_size writes waiting at most group_delay seconds share one commit
+
+        Args:
+            db_path (str): database file name
+            timeout (float): seconds to wait for lock (sqlite busy timeout)
+            retries (int): retries of write on 'database is locked'
+            retry_delay (float): first retry delay, doubled on every retry
+            group_commit (bool): enable group commit (single writes and write units)
+            group_size (int): max writes per commit
+            group_delay (float): max seconds to wait for more writes
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.group_commit = group_commit
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.group_stats = {'commits':0,'writes':0}
+        self._connection = None
+        self._pid = None
+        self._changed = threading.Condition()
+        self._write_lock = threading.RLock()
+        self._in_transaction = False
+        self._restores = 0
+        self._queue = None
+        self._writer_pid = None
+        self._unit = threading.local()
+
+    def connect(self):
+        connection = sqlite3.connect(self.db_path,timeout=self.timeout,check_same_thread=False)
+        connection.execute(CHANGES_TABLE)
+        connection.execute(CHANGES_INDEX)
+        connection.execute(ROLLUP_TABLE)
+        connection.execute(VERSIONS_TABLE)
+        return connection
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            logger.debug("[SQLITE] Open %s in process %s",self.db_path,os.getpid())
+            self.connection = self.connect()
+        return self._connection
+
+    @connection.setter
+    def connection(self,connection):
+        self._connection = connection
+        self._pid = os.getpid()
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    @contextmanager
+    def transaction(self):
+        """Writes inside context are committed once on exit or rolled back on exception.
+           Other threads writes wait until transaction finished.
+           Write lock of database is taken on enter (BEGIN IMMEDIATE), so reads inside context
+           see data other processes can not change before commit
+
+        Raises:
+            BackendError: database error (raw sqlite errors are wrapped)
+        """
+        with self._write_lock:
+            if self._in_transaction:
+                # Nested transaction is a part of outer one
+                yield
+                return
+            self._begin_immediate()
+            self._in_transaction = True
+            try:
+                yield
+                self.connection.commit()
+            except sqlite3.Error as ex:
+                self.connection.rollback()
+                raise BackendError(str(ex)) from ex
+            except BaseException:
+                self.connection.rollback()
+                raise
+            finally:
+                self._in_transaction = False
+        self._notify_changed()
+
+    @contextmanager
+    def write_unit(self):
+        """Writes (save, delete) inside context are applied together or not at all.
+           In group commit mode they are queued and applied by group writer as one unit,
+           sharing commit with other writes, otherwise in transaction
+
+        Note:
+            Writes are not visible to reads inside context in group commit mode
+
+        Raises:
+            BackendError: unit failed and was rolled back
+        """
+        if getattr(self._unit,'writes',None) is not None:
+            yield
+            return
+        if not self.group_commit or self._in_transaction:
+            with self.transaction():
+                yield
+            return
+        self._unit.writes = []
+        try:
+            yield
+            writes = self._unit.writes
+        finally:
+            self._unit.writes = None
+        if writes:
+            self._group_submit(_PendingWrite(writes))
+
+    def _begin_immediate(self):
+        """ Start transaction holding database write lock, retry on 'database is locked' """
+        for attempt in range(self.retries + 1):
+            try:
+                if not self.connection.in_transaction:
+                    self.connection.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as ex:
+                if 'locked' not in str(ex) or attempt == self.retries:
+                    raise BackendError(str(ex)) from ex
+                logger.warning("[SQLITE] %s, retry %s",ex,attempt + 1)
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _notify_changed(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    @staticmethod
+    def _execute_statements(cursor,query,params,change,extra=()):
+        cursor.execute(query,params)
+        for extra_query,extra_params in extra:
+            cursor.execute(extra_query,extra_params)
+        if change:
+            cursor.execute("INSERT INTO changes (table_name,record_key,operation,datetime) VALUES (?,?,?,?)",(*change,int(time.time())))
+            cursor.execute(VERSIONS_UPSERT,(change[0],time.time()))
+
+    def _execute_write(self,query,params,change:tuple=None,extra:list=()):
+        """Execute write query and commit (if not in transaction).
+           Change (table,key,operation) and extra statements [(query,params)] are executed in the same transaction
+        """
+        unit = getattr(self._unit,'writes',None)
+        if unit is not None:
+            unit.append((query,params,change,extra))
+            return None
+        if self.group_commit and not self._in_transaction:
+            return self._group_submit(_PendingWrite([(query,params,change,extra)]))
+        with self._write_lock:
+            attempts = 1 if self._in_transaction else self.retries + 1
+            for attempt in range(attempts):
+                try:
+                    cursor = self.connection.cursor()
+                    self._execute_statements(cursor,query,params,change,extra)
+                    if self._in_transaction:
+                        return cursor
+                    self.connection.commit()
+                    break
+                except sqlite3.OperationalError as ex:
+                    if 'locked' not in str(ex) or attempt == attempts - 1:
+                        raise BackendError(str(ex))
+                    logger.warning("[SQLITE] %s, retry %s",ex,attempt + 1)
+                    self.connection.rollback()
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        if change:
+            self._notify_changed()
+        return cursor
+
+    def _group_submit(self,pending):
+        if self._writer_pid != os.getpid():
+            with self._write_lock:
+                if self._writer_pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._group_writer,args=(self._queue,),daemon=True).start()
+                    self._writer_pid = os.getpid()
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error:
+            raise pending.error
+
+    def _group_writer(self,writes:queue.Queue):
+        while True:
+            batch = [writes.get()]
+            deadline = time.monotonic() + self.group_delay
+            while len(batch) < self.group_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(writes.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._apply_group(batch)
+
+    def _apply_group(self,batch:list):
+        """Apply pending writes (units) in one transaction. Failed unit is rolled back to its savepoint
+           and does not affect others
+        """
+        with self._write_lock:
+            try:
+                # Without BEGIN release of savepoint commits every unit separately
+                self._begin_immediate()
+                cursor = self.connection.cursor()
+                for pending in batch:
+                    cursor.execute("SAVEPOINT group_write")
+                    try:
+                        for query,params,change,extra in pending.writes:
+                            self._execute_statements(cursor,query,params,change,extra)
+                    except sqlite3.Error as ex:
+                        cursor.execute("ROLLBACK TO group_write")
+                        pending.error = BackendError(str(ex))
+                    cursor.execute("RELEASE group_write")
+                self.connection.commit()
+                self.group_stats['commits'] += 1
+                self.group_stats['writes'] += sum(len(pending.writes) for pending in batch)
+            except (sqlite3.Error,BackendError) as ex:
+                self.connection.rollback()
+                for pending in batch:
+                    pending.error = pending.error or BackendError(str(ex))
+        logger.debug("[SQLITE][GROUP_COMMIT] %s writes",len(batch))
+        self._notify_changed()
+        for pending in batch:
+            pending.done.set()
 
     def save(self,model:DbObject):
         key, value = model.get_db_key()
@@ -20,26 +269,124 @@ class SqLiteBackend(DbBackend):
             #New object. Insert
             values_placeholder = ",".join(['?'] * len(fields_to_save))
             query = f"INSERT INTO {model._db_table} ({','.join(fields_names)}) VALUES ({values_placeholder})"
+            change = (model._db_table,str(fields_to_save.get(key)),'insert')
+            extra = self._rollup_statements(model._db_table,[fields_to_save])
         else: 
             # Update object 
             values_placeholder = ','.join([f"{f}=?" for f in fields_names])
             params.append(str(value))
             query = f"UPDATE {model._db_table} SET {values_placeholder} WHERE {key}=?"
+            change = (model._db_table,str(value),'update')
+            extra = ()
 
         logger.debug("[SQLITE][SAVE]Query: %s : %s",query,params)
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute(query,params)
-            self.connection.commit()
-        except sqlite3.OperationalError as ex:
-            raise BackendError(str(ex))
+        self._execute_write(query,params,change,extra)
 
     def delete(self,model:DbObject):
         key, value = model.get_db_key()
         query = f"DELETE FROM {model._db_table} WHERE {key}=?"
         logger.debug("[SQLITE][DELETE]Query: %s : %s",query,value)
-        cursor = self.connection.cursor()
-        cursor.execute(query,(value,))
+        self._execute_write(query,(str(value),),(model._db_table,str(value),'delete'))
+
+    def load_changes(self,since:int=0,limit:int=100) -> list:
+        """Load changes recorded after sequence number `since`
+
+        Returns:
+            List[dict]: changes (seq, table_name, record_key, operation, datetime) ordered by seq
+        """
+        return self.load_list_query("SELECT * from changes WHERE seq>? ORDER BY seq LIMIT ?",(int(since),int(limit)))
+
+    def prune_changes(self,older_than:int,limit:int=500) -> int:
+        """Delete changes recorded before older_than, last change is kept for its sequence number
+
+        Args:
+            older_than (int): timestamp
+            limit (int): max changes to delete
+
+        Returns:
+            int: deleted changes
+        """
+        with self.transaction():
+            cursor = self.connection.execute("DELETE FROM changes WHERE seq IN (SELECT seq FROM changes "
+                "WHERE datetime<? AND seq<(SELECT MAX(seq) FROM changes) ORDER BY seq LIMIT ?)",(int(older_than),int(limit)))
+            return cursor.rowcount
+
+    def changes_seq(self) -> int:
+        """ Sequence number of last recorded change, 0 if there are no changes """
+        return self.connection.execute("SELECT COALESCE(MAX(seq),0) FROM changes").fetchone()[0]
+
+    def _rollup_statements(self,table:str,rows:list) -> list:
+        """ Upserts of audit counts per username and hour for inserted rows """
+        if table != 'audit':
+            return []
+        counts = {}
+        for row in rows:
+            bucket = int(row['datetime']) // ROLLUP_BUCKET * ROLLUP_BUCKET
+            counts[(str(row.get('username')),bucket)] = counts.get((str(row.get('username')),bucket),0) + 1
+        return [(ROLLUP_UPSERT,(username,bucket,count)) for (username,bucket),count in counts.items()]
+
+    def audit_stats(self,start:int=None,end:int=None,bucket_size:int=ROLLUP_BUCKET,username:str=None) -> list:
+        """Audit counts grouped by username and time bucket, archived audits included
+
+        Note:
+            Counts are kept per ROLLUP_BUCKET (hour), so start and end should be multiples of it
+
+        Args:
+            start (int): from timestamp (included)
+            end (int): to timestamp (excluded)
+            bucket_size (int): bucket seconds, multiple of ROLLUP_BUCKET
+            username (str): count only this user audits
+
+        Raises:
+            BackendError: start or end is not aligned to ROLLUP_BUCKET
+
+        Returns:
+            List[dict]: username, bucket (start timestamp), count
+        """
+        for bound in (start,end):
+            if bound is not None and int(bound) % ROLLUP_BUCKET:
+                raise BackendError(f"Audit stats start and end should be multiples of {ROLLUP_BUCKET} seconds")
+        bucket_size = max(ROLLUP_BUCKET,int(bucket_size) // ROLLUP_BUCKET * ROLLUP_BUCKET)
+        where, params = [], [bucket_size,bucket_size]
+        if start is not None:
+            where.append("bucket>=?")
+            params.append(int(start))
+        if end is not None:
+            where.append("bucket<?")
+            params.append(int(end))
+        if username is not None:
+            where.append("username=?")
+            params.append(username)
+        where_sql = (' WHERE ' + ' AND '.join(where)) if where else ''
+        query = f"SELECT username, bucket/? * ? AS bucket, SUM(count) AS count FROM audit_rollup{where_sql} GROUP BY 1,2 ORDER BY 2,1"
+        return self.load_list_query(query,tuple(params))
+
+    def rebuild_audit_rollup(self):
+        """ Recount rollups from audit and audit_archive (e.g. for audits inserted before rollups) """
+        with self.transaction():
+            cursor = self.connection.cursor()
+            cursor.execute("DELETE FROM audit_rollup")
+            cursor.execute(f"INSERT INTO audit_rollup (username,bucket,count) "
+                f"SELECT username, datetime/{ROLLUP_BUCKET}*{ROLLUP_BUCKET}, COUNT(*) FROM "
+                f"(SELECT username,datetime FROM audit UNION ALL SELECT username,datetime FROM audit_archive) GROUP BY 1,2")
+
+    def wait_for_change(self,timeout:float):
+        """Block until change committed by this process or timeout"""
+        with self._changed:
+            self._changed.wait(timeout)
+
+    def table_version(self,table:str) -> tuple:
+        """Persisted table version and last modification time, shared by all connections
+
+        Returns:
+            tuple: (version:int, last_modified:float), (0, 0) if table was not written
+        """
+        row = self.connection.execute("SELECT version,modified FROM table_versions WHERE table_name=?",(table,)).fetchone()
+        return (row[0],row[1]) if row else (0,0)
+
+    def data_version(self) -> int:
+        """ Changes when other connections commit to database or it is restored by this backend """
+        return self.connection.execute("PRAGMA data_version").fetchone()[0] + self._restores
 
     def load_by_id(self,table:str, record_id:dict):
         key_name,value = record_id.popitem()
@@ -53,7 +400,7 @@ class SqLiteBackend(DbBackend):
         col_name_list = [field[0] for field in res.description]
         return {c:row[i] for i,c in enumerate(col_name_list)}
 
-    def load_list(self,table:str, where_clause:dict=None):
+    def load_list(self,table:str, where_clause:dict=None, order:str=None):
         query = f"SELECT * from {table}"
         params = ()
         if where_clause:
@@ -61,8 +408,13 @@ class SqLiteBackend(DbBackend):
             where = ' AND '.join([f'{f}=?' for f in where_fields])
             params = tuple(where_clause.values())
             query = query + ' WHERE ' + where
+        if order:
+            query = query + f' ORDER BY {order}'
 
         logger.debug("[SQLITE][SAVE]LoadList: %s : %s",query,params)
+        return self.load_list_query(query,params)
+
+    def load_list_query(self,query:str,params:tuple=()) -> list:
         cursor = self.connection.cursor()
         res = cursor.execute(query,params)
         col_name_list = [field[0] for field in res.description]
@@ -74,20 +426,331 @@ class SqLiteBackend(DbBackend):
         return [build_row_object(o) for o in rows]
 
 
+    def save_many(self,models:list):
+        """Insert new models of the same table with one multi-row statement
+
+        Args:
+            models (List[DbObject]): new validated models
+        """
+        if not models:
+            return
+        table = models[0]._db_table
+        key = models[0].get_db_key()[0]
+        fields_names = list(models[0].get_db_updates().keys())
+        values_placeholder = ",".join(['?'] * len(fields_names))
+        query = f"INSERT INTO {table} ({','.join(fields_names)}) VALUES ({values_placeholder})"
+        rows = [[str(m.get_db_updates()[f]) for f in fields_names] for m in models]
+        logger.debug("[SQLITE][SAVE_MANY]Query: %s : %s rows",query,len(rows))
+        now = int(time.time())
+        with self.transaction():
+            cursor = self.connection.cursor()
+            cursor.executemany(query,rows)
+            cursor.executemany("INSERT INTO changes (table_name,record_key,operation,datetime) VALUES (?,?,?,?)",
+                [(table,str(m.get_db_updates().get(key)),'insert',now) for m in models])
+            for rollup_query,rollup_params in self._rollup_statements(table,[m.get_db_updates() for m in models]):
+                cursor.execute(rollup_query,rollup_params)
+            cursor.execute(VERSIONS_UPSERT,(table,time.time()))
+
+    def bulk_update(self,table:str,updates:dict,key:str,keys:list=None,where_clause:dict=None) -> list:
+        """Set-based update of all records matching keys list and/or where clause
+
+        Args:
+            table (str): database table
+            updates (dict): fields to set
+            key (str): key field name
+            keys (list): update only records with these keys
+            where_clause (dict): where clause filter
+
+        Returns:
+            list: keys of updated records
+        """
+        where_clause = where_clause or {}
+        where = [f'{f}=?' for f in where_clause.keys()]
+        chunks = [None] if keys is None else [keys[i:i + BULK_CHUNK_SIZE] for i in range(0,len(keys),BULK_CHUNK_SIZE)]
+        set_placeholder = ','.join([f"{f}=?" for f in updates.keys()])
+        updated = []
+        now = int(time.time())
+        with self.transaction():
+            cursor = self.connection.cursor()
+            for chunk in chunks:
+                chunk_where = list(where)
+                params = [*where_clause.values()]
+                if chunk is not None:
+                    chunk_where.append(f"{key} IN ({','.join(['?'] * len(chunk))})")
+                    params.extend(str(k) for k in chunk)
+                where_sql = (' WHERE ' + ' AND '.join(chunk_where)) if chunk_where else ''
+                cursor.execute(f"SELECT {key} from {table}{where_sql}",params)
+                chunk_keys = [row[0] for row in cursor.fetchall()]
+                if not chunk_keys:
+                    continue
+                query = f"UPDATE {table} SET {set_placeholder}{where_sql}"
+                logger.debug("[SQLITE][BULK_UPDATE]Query: %s : %s",query,params)
+                cursor.execute(query,[*map(str,updates.values()),*params])
+                cursor.executemany("INSERT INTO changes (table_name,record_key,operation,datetime) VALUES (?,?,?,?)",
+                    [(table,str(k),'update',now) for k in chunk_keys])
+                updated.extend(chunk_keys)
+            if updated:
+                cursor.execute(VERSIONS_UPSERT,(table,time.time()))
+        return updated
+
     def rotate(self,table:str,max_size:int=100) -> bool:
-        """ This is custom function for rotating audits """
-        cursor = self.connection.cursor()
-        res = cursor.execute(f"SELECT COUNT(*) from {table}")
-        count = int(cursor.fetchone()[0])
-        if count < max_size:
-            return False
-        logger.debug("[SQLITE][ROTATE] Found %s count for %s of max %s",count,table,max_size)
-        query = f"INSERT INTO {table}_archive select * from {table} ORDER BY datetime DESC LIMIT {max_size},{count}"
-        res = cursor.execute(query)
-        query = f"DELETE FROM {table} ORDER BY datetime DESC LIMIT {max_size},{count}"
-        res = cursor.execute(query)
+        """ This is custom function for rotating audits
+
+        Note:
+            Audit rollups count rows of both tables, so they are kept as is
+        """
+        with self.transaction():
+            cursor = self.connection.cursor()
+            res = cursor.execute(f"SELECT COUNT(*) from {table}")
+            count = int(cursor.fetchone()[0])
+            if count < max_size:
+                return False
+            logger.debug("[SQLITE][ROTATE] Found %s count for %s of max %s",count,table,max_size)
+            query = f"INSERT INTO {table}_archive select * from {table} ORDER BY datetime DESC LIMIT {max_size},{count}"
+            res = cursor.execute(query)
+            query = f"DELETE FROM {table} ORDER BY datetime DESC LIMIT {max_size},{count}"
+            res = cursor.execute(query)
+            cursor.executemany(VERSIONS_UPSERT,[(table,time.time()),(f"{table}_archive",time.time())])
         return True
 
+    def archive_deleted(self,table:str,key:str,older_than:int,limit:int=500) -> list:
+        """Move soft deleted records (deleted=1) not changed since older_than to {table}_deleted.
+           Last change in change log is deletion time. Records without changes (deleted before
+           change log existed) get change with current time, so retention window starts now
+
+        Args:
+            table (str): database table
+            key (str): key field name
+            older_than (int): timestamp, only records deleted before it are moved
+            limit (int): max records to move
+
+        Returns:
+            list: keys of moved records
+        """
+        now = int(time.time())
+        with self.transaction():
+            cursor = self.connection.cursor()
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_deleted AS SELECT * FROM {table} WHERE 0")
+            cursor.execute(f"INSERT INTO changes (table_name,record_key,operation,datetime) SELECT ?,{key},'delete',? "
+                f"FROM {table} t WHERE deleted=1 AND NOT EXISTS "
+                f"(SELECT 1 FROM changes c WHERE c.table_name=? AND c.record_key=t.{key})",(table,now,table))
+            if cursor.rowcount:
+                logger.info("[SQLITE][ARCHIVE_DELETED] %s: retention started for %s records without changes",table,cursor.rowcount)
+            cursor.execute(f"SELECT {key} FROM {table} t WHERE deleted=1 AND "
+                f"(SELECT MAX(datetime) FROM changes c WHERE c.table_name=? AND c.record_key=t.{key})<? LIMIT ?",
+                (table,int(older_than),int(limit)))
+            keys = [row[0] for row in cursor.fetchall()]
+            if not keys:
+                return []
+            where = f"{key} IN ({','.join(['?'] * len(keys))})"
+            logger.debug("[SQLITE][ARCHIVE_DELETED] %s: %s records",table,len(keys))
+            cursor.execute(f"INSERT INTO {table}_deleted SELECT * FROM {table} WHERE {where}",keys)
+            cursor.execute(f"DELETE FROM {table} WHERE {where}",keys)
+            cursor.executemany("INSERT INTO changes (table_name,record_key,operation,datetime) VALUES (?,?,?,?)",
+                [(table,str(k),'delete',now) for k in keys])
+            cursor.executemany(VERSIONS_UPSERT,[(table,time.time()),(f"{table}_deleted",time.time())])
+        return keys
+
+    def database_size(self) -> dict:
+        """ Database file size: page_size, pages, free pages, bytes """
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        free = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return {'page_size':page_size,'pages':pages,'free_pages':free,'bytes':page_size * pages}
+
+    def vacuum(self,mode:str='incremental',pages:int=None) -> int:
+        """Return free pages to file system
+
+        Note:
+            Incremental vacuum works only for database with auto_vacuum=INCREMENTAL (set by init_database),
+            full vacuum switches database to it (and rewrites whole file). Incremental vacuum of
+            database created without it is done once as full
+
+        Args:
+            mode (str): incremental or full
+            pages (int): max pages to free in incremental mode, None - all
+
+        Returns:
+            int: bytes reclaimed
+        """
+        if mode not in ('incremental','full'):
+            raise BackendError(f"Unknown vacuum mode {mode}")
+        before = self.database_size()['bytes']
+        if mode == 'incremental' and self.connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.warning("[SQLITE][VACUUM] auto_vacuum is not INCREMENTAL, full vacuum is done instead")
+            mode = 'full'
+        with self._write_lock:
+            if mode == 'full':
+                self.connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self.connection.execute("VACUUM")
+            else:
+                self.connection.execute(f"PRAGMA incremental_vacuum{'' if pages is None else f'({int(pages)})'}").fetchall()
+                self.connection.commit()
+        return before - self.database_size()['bytes']
+
+    def backup(self,target_path:str,pages:int=64,sleep:float=0) -> dict:
+        """Online copy of database to target_path using sqlite backup API
+
+        Note:
+            Copy is done in steps of `pages` pages, so writers are only blocked for one step.
+            `sleep` seconds pause between steps throttles the copy.
+
+        Args:
+            target_path (str): backup file name
+            pages (int): pages copied per step
+            sleep (float): pause between steps
+
+        Returns:
+            dict: backup stats (pages, steps, duration, pages_per_sec)
+        """
+        target = sqlite3.connect(target_path)
+        try:
+            return _copy_database(self.connection,target,pages,sleep)
+        finally:
+            target.close()
+
+    def restore(self,source_path:str,pages:int=64,sleep:float=0) -> dict:
+        """Restore database in place from backup file created by backup().
+           Writes of this process wait until restore is finished
+
+        Note:
+            'restore' change is recorded, so change log readers (e.g. username index) reload data
+
+        Args:
+            source_path (str): backup file name
+            pages (int): pages copied per step
+            sleep (float): pause between steps
+
+        Returns:
+            dict: restore stats (pages, steps, duration, pages_per_sec)
+        """
+        source = sqlite3.connect(source_path)
+        with self._write_lock:
+            try:
+                stats = _copy_database(source,self.connection,pages,sleep)
+            finally:
+                source.close()
+            self._restores += 1
+            # Versions of backup were served before, new modification time makes them unique
+            with self.transaction():
+                self.connection.execute(VERSIONS_TABLE)
+                self.connection.execute("UPDATE table_versions SET version=version+1, modified=?",(time.time(),))
+                self.connection.execute(CHANGES_TABLE)
+                self.connection.execute("INSERT INTO changes (table_name,record_key,operation,datetime) VALUES ('','','restore',?)",
+                    (int(time.time()),))
+        return stats
+
+
+class _PendingWrite:
+    __slots__ = ['writes','done','error']
+
+    def __init__(self,writes:list):
+        # [(query,params,change,extra)] applied together
+        self.writes = writes
+        self.done = threading.Event()
+        self.error = None
+
+
+def _copy_database(source,target,pages,sleep) -> dict:
+    stats = {'pages':0,'steps':0}
+
+    def progress(status,remaining,total):
+        stats['pages'] = total
+        stats['steps'] += 1
+        if sleep and remaining:
+            time.sleep(sleep)
+
+    started = time.monotonic()
+    try:
+        source.backup(target,pages=pages,progress=progress)
+    except sqlite3.Error as ex:
+        raise BackendError(str(ex))
+    duration = time.monotonic() - started
+    stats['duration'] = duration
+    stats['pages_per_sec'] = stats['pages'] / duration if duration else 0
+    logger.debug("[SQLITE][BACKUP] %s",stats)
+    return stats
+
+
+class PeriodicBackup(threading.Thread):
+    """Background thread taking backup of backend every `interval` seconds"""
+
+    def __init__(self,backend:SqLiteBackend,target_path:str,interval:float,pages:int=64,sleep:float=0):
+        super(PeriodicBackup, self).__init__(daemon=True)
+        self.backend = backend
+        self.target_path = target_path
+        self.interval = interval
+        self.pages = pages
+        self.sleep = sleep
+        self.last_stats = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.last_stats = self.backend.backup(self.target_path,self.pages,self.sleep)
+                logger.info("[SQLITE][BACKUP] %s: %s",self.target_path,self.last_stats)
+            except BackendError as ex:
+                logger.error("[SQLITE][BACKUP] Periodic backup failed: %s",ex)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ReadOnlyMixin:
+    """Rejects write operations on replica backends"""
+
+    def save(self,model:DbObject):
+        raise BackendError('Replica is read only')
+
+    def delete(self,model:DbObject):
+        raise BackendError('Replica is read only')
+
+    def rotate(self,table:str,max_size:int=100) -> bool:
+        raise BackendError('Replica is read only')
+
+
+class SqLiteReadOnlyBackend(ReadOnlyMixin,SqLiteBackend):
+    """Read only connection to the same sqlite file as primary"""
+
+    def connect(self):
+        return sqlite3.connect(f"file:{self.db_path}?mode=ro",uri=True,timeout=self.timeout,check_same_thread=False)
+
+    def staleness(self) -> float:
+        return 0
+
+
+class SqLiteMemoryReplica(ReadOnlyMixin,SqLiteBackend):
+    """In-memory copy of primary database refreshed every refresh_interval seconds"""
+
+    def __init__(self,primary:SqLiteBackend,refresh_interval:float=None):
+        super(SqLiteMemoryReplica, self).__init__(':memory:')
+        self.primary = primary
+        self.refreshed_at = None
+        self.refresh()
+        self._stopped = threading.Event()
+        if refresh_interval:
+            threading.Thread(target=self._refresh_loop,args=(refresh_interval,),daemon=True).start()
+
+    def refresh(self):
+        # Copy has all writes committed before it started (wall clock, compared with client last write time)
+        started = time.time()
+        _copy_database(self.primary.connection,self.connection,-1,0)
+        self.refreshed_at = started
+
+    def staleness(self) -> float:
+        return time.time() - self.refreshed_at
+
+    def stop(self):
+        self._stopped.set()
+
+    def _refresh_loop(self,interval):
+        while not self._stopped.wait(interval):
+            try:
+                self.refresh()
+            except BackendError as ex:
+                logger.error("[SQLITE][REPLICA] Refresh failed: %s",ex)
+
 
 def init_database(db_name):
     import os
@@ -96,16 +759,50 @@ def init_database(db_name):
         print(f"[+]Delete file {db_name}")
         os.remove(db_name)
     connection = sqlite3.connect(db_name)
+    # Free pages of compacted tables are returned by incremental vacuum
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
     print("Create users table")
     connection.execute("CREATE TABLE users (username TEXT, password TEXT,gender TEXT,deleted NUMBER)")
     print("Create audit table")
     connection.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
     print("Create audit_archive table")
     connection.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+    print("Create changes table")
+    connection.execute(CHANGES_TABLE)
+    connection.execute(CHANGES_INDEX)
+    print("Create audit_rollup table")
+    connection.execute(ROLLUP_TABLE)
+    print("Create table_versions table")
+    connection.execute(VERSIONS_TABLE)
+
+def backup_database(db_name,target_path,pages=64,sleep=0):
+    stats = SqLiteBackend(db_name).backup(target_path,int(pages),float(sleep))
+    print(f"[+]Backup {db_name} to {target_path}: {stats['pages']} pages in {stats['duration']:.3f}s ({stats['pages_per_sec']:.0f} pages/sec)")
+
+
+def rebuild_audit_rollup(db_name):
+    SqLiteBackend(db_name).rebuild_audit_rollup()
+    print(f"[+]Audit rollup rebuilt for {db_name}")
+
+
+def periodic_backup(db_name,target_path,interval,pages=64,sleep=0):
+    logging.basicConfig(level=logging.INFO)
+    thread = PeriodicBackup(SqLiteBackend(db_name),target_path,float(interval),int(pages),float(sleep))
+    thread.start()
+    print(f"[+]Backup {db_name} to {target_path} every {interval}s, Ctrl+C to stop")
+    try:
+        thread.join()
+    except KeyboardInterrupt:
+        thread.stop()
+
+def restore_database(db_name,source_path,pages=64,sleep=0):
+    stats = SqLiteBackend(db_name).restore(source_path,int(pages),float(sleep))
+    print(f"[+]Restore {db_name} from {source_path}: {stats['pages']} pages in {stats['duration']:.3f}s ({stats['pages_per_sec']:.0f} pages/sec)")
+
 
 if __name__ == '__main__':
     import sys
-    globals()[sys.argv[1]](sys.argv[2])
+    globals()[sys.argv[1]](*sys.argv[2:])
 
 
 
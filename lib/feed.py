@@ -0,0 +1,90 @@
+import time
+import logging
+import contextlib
+
+from db import DatabaseManager, BackendError, BackendErrorNotFound
+from model.user import User
+from model.audit import Audit
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeSet:
+    """Changed users and new audits after given change sequence number"""
+
+    def __init__(self,last_seq:int,users:list,deleted_users:list,audits:list):
+        self.last_seq = last_seq
+        self.users = users
+        self.deleted_users = deleted_users
+        self.audits = audits
+
+    def __iter__(self):
+        yield "last_seq", self.last_seq
+        yield "users", [dict(u) for u in self.users]
+        yield "deleted_users", self.deleted_users
+        yield "audits", [dict(a) for a in self.audits]
+
+
+def _get_backend():
+    backend = DatabaseManager.get_backend()
+    if not hasattr(backend,'load_changes'):
+        raise BackendError('Change feed not supported by backend')
+    return backend
+
+
+def get_changes(since:int,limit:int=100) -> ChangeSet:
+    """Collect current state of users changed and audits created after `since`
+
+    Args:
+        since (int): last change sequence number seen by client
+        limit (int): max number of changes to process
+
+    Returns:
+        ChangeSet: changes, last_seq should be used as `since` for next call
+    """
+    backend = _get_backend()
+    changes = backend.load_changes(since,limit)
+    if since and changes and changes[0]['seq'] > int(since) + 1:
+        raise BackendError(f"Changes after {since} were pruned, reload users and audits")
+    last_seq = changes[-1]['seq'] if changes else int(since)
+    users, deleted_users, audits = [], [], []
+    user_keys = list(dict.fromkeys(c['record_key'] for c in changes if c['table_name'] == User._db_table))
+    audit_keys = [c['record_key'] for c in changes if c['table_name'] == Audit._db_table and c['operation'] == 'insert']
+    # Current state is loaded from primary, replicas may be behind the change log
+    for username in user_keys:
+        try:
+            user = User(**backend.load_by_id(User._db_table,{'username':username}))
+        except BackendErrorNotFound:
+            deleted_users.append(username)
+            continue
+        if user.deleted.value:
+            deleted_users.append(username)
+        else:
+            users.append(user)
+    for uuid in audit_keys:
+        # Audit may be already rotated to archive
+        for table in (Audit._db_table,f"{Audit._db_table}_archive"):
+            with contextlib.suppress(BackendErrorNotFound):
+                audits.append(Audit(**backend.load_by_id(table,{'uuid':uuid})))
+                break
+    return ChangeSet(last_seq,users,deleted_users,audits)
+
+
+def wait_changes(since:int,timeout:float,limit:int=100,poll_interval:float=0.5) -> ChangeSet:
+    """Long poll: wait up to `timeout` seconds for changes after `since`
+
+    Note:
+        Changes from this process wake up waiter immediately, changes from
+        other processes are found by polling every poll_interval seconds
+    """
+    backend = _get_backend()
+    deadline = time.monotonic() + timeout
+    while True:
+        changeset = get_changes(since,limit)
+        remaining = deadline - time.monotonic()
+        if changeset.last_seq != int(since) or remaining <= 0:
+            return changeset
+        if hasattr(backend,'wait_for_change'):
+            backend.wait_for_change(min(poll_interval,remaining))
+        else:
+            time.sleep(min(poll_interval,remaining))
@@ -0,0 +1,146 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TABLE = "CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, fingerprint TEXT, response TEXT, expires NUMBER)"
+
+# Purge expired persisted responses every N completed requests
+PURGE_INTERVAL = 100
+
+
+class IdempotencyError(Exception):
+    """Idempotency key can not be used for this request"""
+
+
+class _InFlight:
+
+    def __init__(self,fingerprint:str):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+
+
+class _Completed:
+
+    __slots__ = ['fingerprint','response','expires']
+
+    def __init__(self,fingerprint:str,response:dict,expires:float):
+        self.fingerprint = fingerprint
+        self.response = response
+        self.expires = expires
+
+
+class IdempotencyStore:
+    """Bounded store of completed responses by Idempotency-Key with TTL.
+       Requests with key of in-flight request wait for it to complete
+
+    Note:
+        In-flight requests are tracked per process. With `path` completed responses
+        are persisted to sqlite and shared by worker processes
+    """
+
+    def __init__(self,max_size:int=10000,ttl:float=86400,wait_timeout:float=30,path:str=None):
+        """
+        Args:
+            max_size (int): max responses kept in memory (least recently used evicted)
+            ttl (float): seconds response is kept
+            wait_timeout (float): max seconds duplicate waits for in-flight request
+            path (str): sqlite database to persist responses, None - memory only
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.path = path
+        self._lock = threading.Lock()
+        self._completed = OrderedDict()
+        self._in_flight = {}
+        self._connection = None
+        self._completed_count = 0
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            import sqlite3
+            self._connection = sqlite3.connect(self.path,check_same_thread=False)
+            self._connection.execute(IDEMPOTENCY_TABLE)
+        return self._connection
+
+    def begin(self,key:str,fingerprint:str=None) -> dict:
+        """Start request with idempotency key
+
+        Raises:
+            IdempotencyError: key used for other request or first request still in progress
+
+        Returns:
+            dict: response of completed request with this key or None if caller should process request
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self._lock:
+                entry = self._get(key)
+                if entry is None:
+                    in_flight = self._in_flight.get(key)
+                    if in_flight is None:
+                        self._in_flight[key] = _InFlight(fingerprint)
+                        return None
+                    entry = in_flight
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyError("Idempotency-Key was used for other request")
+                if not isinstance(entry,_InFlight):
+                    return entry.response
+            logger.debug("[IDEMPOTENCY] Wait for in-flight request %s",key)
+            if not entry.done.wait(max(0,deadline - time.monotonic())):
+                raise IdempotencyError("Request with this Idempotency-Key is in progress")
+
+    def complete(self,key:str,response:dict):
+        """Store response of request started by begin"""
+        with self._lock:
+            in_flight = self._in_flight.pop(key)
+            entry = _Completed(in_flight.fingerprint,response,time.time() + self.ttl)
+            self._completed[key] = entry
+            while len(self._completed) > self.max_size:
+                self._completed.popitem(last=False)
+            if self.path:
+                self._persist(key,entry)
+        in_flight.done.set()
+
+    def abort(self,key:str):
+        """Forget request started by begin, next request with this key is processed"""
+        with self._lock:
+            in_flight = self._in_flight.pop(key)
+        in_flight.done.set()
+
+    def _get(self,key:str):
+        entry = self._completed.get(key)
+        if entry is None and self.path:
+            entry = self._load(key)
+            if entry is not None:
+                self._completed[key] = entry
+        if entry is None:
+            return None
+        if entry.expires <= time.time():
+            del self._completed[key]
+            return None
+        self._completed.move_to_end(key)
+        return entry
+
+    def _load(self,key:str):
+        row = self.connection.execute("SELECT fingerprint,response,expires FROM idempotency WHERE key=?",(key,)).fetchone()
+        if row is None:
+            return None
+        return _Completed(row[0],json.loads(row[1]),row[2])
+
+    def _persist(self,key:str,entry):
+        try:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO idempotency (key,fingerprint,response,expires) VALUES (?,?,?,?)",
+                    (key,entry.fingerprint,json.dumps(entry.response),entry.expires))
+                self._completed_count += 1
+                if self._completed_count % PURGE_INTERVAL == 0:
+                    self.connection.execute("DELETE FROM idempotency WHERE expires<=?",(time.time(),))
+        except Exception as ex:
+            # Response is still kept in memory
+            logger.warning("[IDEMPOTENCY] Persist %s failed: %s",key,ex)
@@ -0,0 +1,205 @@
+"""Audit ingestion listener: newline delimited JSON audits over unix socket (stream) or UDP
+
+    python lib/ingest.py users-audit.db --unix /tmp/audit.sock [--udp 127.0.0.1:5140]
+    echo '{"username":"test1","message":"Logged-in"}' | nc -U /tmp/audit.sock
+
+Records are validated by Audit model rules and written by single writer in batches
+(one transaction per batch). Stream producers are slowed down when max_pending records
+wait for write, UDP records are dropped instead.
+"""
+import json
+import asyncio
+import logging
+
+from db import DatabaseManager, BackendError
+from model.audit import Audit
+from model import ModelException, ValidateException
+
+logger = logging.getLogger(__name__)
+
+# Fields producer may set, others are ignored
+AUDIT_FIELDS = ('message','username','datetime','uuid')
+MAX_LINE = 65536
+
+
+class AuditIngestor:
+
+    def __init__(self,batch_size:int=1000,flush_interval:float=0.05,max_pending:int=10000):
+        """
+        Args:
+            batch_size (int): max audits per transaction
+            flush_interval (float): max seconds audit waits for batch to fill
+            max_pending (int): max validated audits waiting for write
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = {'received':0,'accepted':0,'invalid':0,'dropped':0,'batches':0,'written':0,'write_errors':0}
+        self._queue = None
+        self._writer = None
+        self._servers = []
+        self._transports = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.max_pending)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def serve_unix(self,path:str):
+        self._servers.append(await asyncio.start_unix_server(self._handle_stream,path))
+
+    async def serve_udp(self,host:str,port:int):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramProtocol(self),local_addr=(host,port))
+        self._transports.append(transport)
+
+    async def close(self):
+        """Stop listening and write all accepted audits"""
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for transport in self._transports:
+            transport.close()
+        await self._queue.put(None)
+        await self._writer
+
+    def parse(self,line:bytes) -> Audit:
+        """Validated audit of line or None if line is invalid"""
+        self.stats['received'] += 1
+        try:
+            record = json.loads(line)
+            if not isinstance(record,dict):
+                raise ValueError("Audit record should be an object")
+            audit = Audit.create(**{f:record[f] for f in AUDIT_FIELDS if f in record})
+            audit.validate()
+        except (ValueError,TypeError,ValidateException,ModelException) as ex:
+            self.stats['invalid'] += 1
+            logger.debug("[INGEST] Invalid record %r: %s",line[:100],ex)
+            return None
+        self.stats['accepted'] += 1
+        return audit
+
+    async def _handle_stream(self,reader:asyncio.StreamReader,writer:asyncio.StreamWriter):
+        buffer = b''
+        try:
+            while True:
+                data = await reader.read(MAX_LINE)
+                if not data:
+                    break
+                *lines, buffer = (buffer + data).split(b'\n')
+                if len(buffer) > MAX_LINE:
+                    self.stats['received'] += 1
+                    self.stats['invalid'] += 1
+                    buffer = b''
+                for line in lines:
+                    audit = self.parse(line) if line.strip() else None
+                    if audit is not None:
+                        # Backpressure: stop reading while writer is behind
+                        await self._queue.put(audit)
+            if buffer.strip():
+                audit = self.parse(buffer)
+                if audit is not None:
+                    await self._queue.put(audit)
+        finally:
+            writer.close()
+
+    def _datagram_received(self,data:bytes):
+        for line in data.split(b'\n'):
+            audit = self.parse(line) if line.strip() else None
+            if audit is None:
+                continue
+            try:
+                self._queue.put_nowait(audit)
+            except asyncio.QueueFull:
+                self.stats['dropped'] += 1
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        stopped = False
+        while not stopped:
+            audit = await self._queue.get()
+            if audit is None:
+                break
+            batch = [audit]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    audit = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        audit = await asyncio.wait_for(self._queue.get(),remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if audit is None:
+                    stopped = True
+                    break
+                batch.append(audit)
+            await loop.run_in_executor(None,self._write,batch)
+
+    def _write(self,batch:list):
+        try:
+            DatabaseManager.get_write_backend().save_many(batch)
+        except BackendError as ex:
+            self.stats['write_errors'] += len(batch)
+            logger.error("[INGEST] Write of %s audits failed: %s",len(batch),ex)
+            return
+        except Exception:
+            # Writer must survive any driver error, batch is lost
+            self.stats['write_errors'] += len(batch)
+            logger.exception("[INGEST] Write of %s audits failed",len(batch))
+            return
+        DatabaseManager.touch(Audit._db_table)
+        self.stats['batches'] += 1
+        self.stats['written'] += len(batch)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self,ingestor:AuditIngestor):
+        self.ingestor = ingestor
+
+    def datagram_received(self,data,addr):
+        self.ingestor._datagram_received(data)
+
+
+async def serve(unix_path:str=None,udp:tuple=None,stats_interval:float=10,**options):
+    ingestor = AuditIngestor(**options)
+    await ingestor.start()
+    if unix_path:
+        await ingestor.serve_unix(unix_path)
+    if udp:
+        await ingestor.serve_udp(*udp)
+    logger.info("[INGEST] Listening on %s",[a for a in (unix_path,udp) if a])
+    try:
+        while True:
+            await asyncio.sleep(stats_interval)
+            logger.info("[INGEST] %s",ingestor.stats)
+    finally:
+        await ingestor.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    from db.sqlite import SqLiteBackend
+
+    parser = argparse.ArgumentParser(description="Audit ingestion listener")
+    parser.add_argument('db')
+    parser.add_argument('--unix',help="unix socket path")
+    parser.add_argument('--udp',help="host:port")
+    parser.add_argument('--batch-size',type=int,default=1000)
+    parser.add_argument('--max-pending',type=int,default=10000)
+    args = parser.parse_args()
+    if not args.unix and not args.udp:
+        parser.error("--unix or --udp required")
+    logging.basicConfig(level=logging.INFO)
+    DatabaseManager.register_backend(SqLiteBackend(args.db))
+    udp = None
+    if args.udp:
+        host, port = args.udp.rsplit(':',1)
+        udp = (host,int(port))
+    try:
+        asyncio.run(serve(args.unix,udp,batch_size=args.batch_size,max_pending=args.max_pending))
+    except KeyboardInterrupt:
+        pass
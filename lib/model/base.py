@@ -117,13 +117,13 @@ class ModelBase(Model,DbObject):
         if not self._validated_data:
             self.validate()
         logger.debug("[MODEL]Save: %s %s",self,self._validated_data)
-        DatabaseManager.get_backend().save(self)
+        DatabaseManager.write('save',self)
         
     def delete(self):
         """Delete object from database
         """
         logger.debug("[MODEL]Save: %s",self)
-        DatabaseManager.get_backend().delete(self)
+        DatabaseManager.write('delete',self)
 
     def is_new(self):
         """ checks if object newly created
@@ -155,6 +155,64 @@ class ModelBase(Model,DbObject):
         self._duty_fields.add(field)
 
 
+    @classmethod
+    def validate_bulk(cls,updates:dict) -> dict:
+        """Validate fields update applied to many records at once.
+           Field rules are checked once for all records. Unique and hidden (internal) fields
+           can not be updated in bulk, e.g. users deleted flag is set by bulk_delete only
+
+        Raises:
+            ModelException: on model errors
+            ValidateException: on validation error
+
+        Returns:
+            dict: dict of names-values to save in db
+        """
+        prototype = cls(**{f:None for f in cls.__slots__})
+        validated_data = {}
+        for field,value in updates.items():
+            prototype.update(field,value)
+            f = getattr(prototype,field)
+            if f.unique or f.hidden:
+                raise ModelException(f"{field} can not be updated in bulk")
+            f.validate()
+            validated_data[field] = f.value
+        return validated_data
+
+    @classmethod
+    def bulk_update(cls,updates:dict,keys:list=None,where:dict=None) -> list:
+        """Update all records matching keys and/or filter with one statement
+
+        Args:
+            updates (dict): fields to update
+            keys (list): key values of records to update
+            where (dict): filter
+
+        Returns:
+            list: keys of updated records
+        """
+        cls._check_bulk_target(keys,where)
+        return cls._bulk_update(cls.validate_bulk(updates),keys,where)
+
+    @classmethod
+    def _check_bulk_target(cls,keys:list,where:dict):
+        if keys is None and not where:
+            raise ModelException("List of keys or filter required")
+        for field in (where or {}):
+            if field not in cls.__slots__:
+                raise ModelException(f"Unknown field {field}")
+
+    @classmethod
+    def _bulk_update(cls,validated_data:dict,keys:list,where:dict) -> list:
+        """ Set-based update of validated fields, in current unit of work like save() """
+        if not hasattr(DatabaseManager.get_write_backend(),'bulk_update'):
+            raise ModelException("Bulk update not supported by backend")
+        key = cls.create(**{f:None for f in cls.__slots__}).get_db_key()[0]
+        logger.debug("[MODEL]Bulk update %s: %s",cls._db_table,validated_data)
+        updated = DatabaseManager.bulk_write('bulk_update',cls._db_table,validated_data,key,keys,where)
+        DatabaseManager.changed(cls._db_table,'save',[{**validated_data,key:k} for k in updated])
+        return updated
+
     @classmethod
     def create(cls,**kwargs):
         """Create new model
@@ -1,4 +1,5 @@
-from .base import ModelBase, ModelField
+from db import DatabaseManager
+from .base import ModelBase, ModelField, ModelException
 from .validator import PasswordValidator,EnumValidator
 from .audit import Audit
 
@@ -23,3 +24,25 @@ class User(ModelBase):
         self.save()
         audit = Audit.create(**{'message':f"user {self.username} deleted",'username':str(self.username)})
         audit.save()
+
+    @classmethod
+    def bulk_delete(cls,usernames:list=None,where:dict=None) -> list:
+        """Set delete flag for many users and audit it in one transaction
+
+        Returns:
+            list: deleted usernames
+        """
+        if usernames is None and not where:
+            raise ModelException("List of usernames or filter required")
+        where = {**(where or {}),'deleted':0}
+        cls._check_bulk_target(usernames,where)
+        if not hasattr(DatabaseManager.get_write_backend(),'save_many'):
+            raise ModelException("Bulk delete not supported by backend")
+        with DatabaseManager.unit_of_work():
+            deleted = cls._bulk_update({'deleted':1},usernames,where)
+            audits = [Audit.create(**{'message':f"user {username} deleted",'username':str(username)}) for username in deleted]
+            for audit in audits:
+                audit.validate()
+            DatabaseManager.bulk_write('save_many',audits)
+            DatabaseManager.changed(Audit._db_table,'save',[audit.get_db_updates() for audit in audits])
+        return deleted
@@ -0,0 +1,149 @@
+import bisect
+import logging
+import threading
+
+from db import DatabaseManager,BackendErrorNotFound
+from model.user import User
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixIndex:
+    """Sorted list of keys for prefix lookups. Only keys are kept in memory"""
+
+    def __init__(self):
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def rebuild(self,keys):
+        keys = sorted(set(keys))
+        with self._lock:
+            self._keys = keys
+
+    def add(self,key:str):
+        with self._lock:
+            i = bisect.bisect_left(self._keys,key)
+            if i == len(self._keys) or self._keys[i] != key:
+                self._keys.insert(i,key)
+
+    def remove(self,key:str):
+        with self._lock:
+            i = bisect.bisect_left(self._keys,key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+    def search(self,prefix:str,limit:int=10) -> list:
+        """Returns up to `limit` keys starting with prefix in sorted order
+        """
+        with self._lock:
+            i = bisect.bisect_left(self._keys,prefix)
+            ret = self._keys[i:i+limit]
+        return [k for k in ret if k.startswith(prefix)]
+
+
+class UsernameIndex(PrefixIndex):
+    """Index of active usernames. Updated on users writes done by this process,
+       writes of other processes are applied from change log (rebuilt if there is none)
+    """
+
+    """ Max changes of other processes applied one by one, more rebuild index """
+    sync_max_changes = 10000
+
+    def __init__(self):
+        super().__init__()
+        self._data_version = None
+        self._change_seq = None
+        self._last_change = None
+        self._loaded = False
+        self._refresh_lock = threading.Lock()
+
+    def on_write(self,table:str,operation:str,rows:list):
+        if table != User._db_table:
+            return
+        for row in rows:
+            if row.get('username') is None:
+                continue
+            if operation == 'delete' or row.get('deleted') == 1:
+                self.remove(str(row['username']))
+            elif row.get('deleted') == 0:
+                self.add(str(row['username']))
+
+    def refresh(self):
+        """Load index if not loaded yet. If database data version changed, apply users changes
+           recorded since last refresh or rebuild index (see _changes_since)
+        """
+        backend = DatabaseManager.get_backend()
+        data_version = backend.data_version() if hasattr(backend,'data_version') else None
+        if self._loaded and data_version == self._data_version:
+            return
+        with self._refresh_lock:
+            if self._loaded and data_version == self._data_version:
+                return
+            seq = self._change_seq if self._loaded else None
+            last_seq = backend.changes_seq() if hasattr(backend,'changes_seq') else None
+            changes = self._changes_since(backend,seq,last_seq)
+            if changes is None:
+                self._rebuild(backend)
+                last_changes = backend.load_changes(last_seq - 1,1) if last_seq else []
+                self._last_change = last_changes[0] if last_changes else None
+            else:
+                self._apply_changes(backend,changes)
+                if changes:
+                    self._last_change = changes[-1]
+            self._data_version = data_version
+            self._change_seq = last_seq
+            self._loaded = True
+
+    def _changes_since(self,backend,seq:int,last_seq:int):
+        """Changes recorded after seq, None if index should be rebuilt: no change log, too many changes,
+           changes after seq were pruned or database was restored
+        """
+        if seq is None or last_seq is None or last_seq < seq or last_seq - seq > self.sync_max_changes:
+            return None
+        # Change at seq is loaded too, other change there means database was restored
+        changes = backend.load_changes(max(seq - 1,0),last_seq - seq + 1)
+        if seq and (not changes or changes.pop(0) != self._last_change):
+            return None
+        if changes and (changes[0]['seq'] != seq + 1 or any(c['operation'] == 'restore' for c in changes)):
+            return None
+        return changes
+
+    def _rebuild(self,backend):
+        users = backend.load_list(User._db_table,{'deleted':0})
+        self.rebuild(u['username'] for u in users)
+        logger.info("Username index rebuilt: %d users",len(self))
+
+    def _apply_changes(self,backend,changes:list):
+        usernames = {c['record_key'] for c in changes if c['table_name'] == User._db_table}
+        for username in usernames:
+            try:
+                active = backend.load_by_id(User._db_table,{'username':username}).get('deleted') == 0
+            except BackendErrorNotFound:
+                active = False
+            if active:
+                self.add(username)
+            else:
+                self.remove(username)
+        logger.debug("Username index: %d changed users applied",len(usernames))
+
+
+_username_index = None
+_username_index_lock = threading.Lock()
+
+def get_username_index() -> UsernameIndex:
+    """Returns process wide username index, registers it for users writes on first call
+    """
+    global _username_index
+    with _username_index_lock:
+        if _username_index is None:
+            _username_index = UsernameIndex()
+            DatabaseManager.add_listener(_username_index.on_write)
+    _username_index.refresh()
+    return _username_index
+
+
+def search_usernames(prefix:str,limit:int=10) -> list:
+    return get_username_index().search(prefix,limit)
@@ -1,6 +1,8 @@
 import logging
+import hashlib
 from contextlib import contextmanager
-from db import BackendError
+from email.utils import formatdate
+from db import DatabaseManager
 from model import ValidateException, ModelException
 
 logger = logging.getLogger()
@@ -47,9 +49,51 @@ class ApiModelError(ApiError):
 
 
 class RequestContext():
+    # Cache-Control for cacheable responses. Clients and proxies should revalidate using ETag
+    cache_control = 'no-cache'
+
     def __init__(self,request_id):
         self._response = None
         self._request_id = request_id
+        self.etag = None
+        self.last_modified = None
+        self.replayed = False
+
+    def set_cache_key(self,table:str,*key):
+        """Compute ETag and Last-Modified of response from table version
+
+        Args:
+            table (str): table response built from
+            key: resource identity (e.g. username) or nothing for list
+
+        Note:
+            No caching headers if backend has no table version shared by workers
+        """
+        table_version = DatabaseManager.table_version(table)
+        if table_version is None:
+            return
+        version, self.last_modified = table_version
+        digest = hashlib.sha1("/".join([table,version,*map(str,key)]).encode()).hexdigest()[:20]
+        self.etag = f'W/"{digest}"'
+
+    def is_not_modified(self,if_none_match:str) -> bool:
+        """Check If-None-Match header matches current ETag
+        """
+        if not self.etag or not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or self.etag in tags or self.etag[2:] in tags
+
+    @property
+    def headers(self) -> dict:
+        """ Caching headers for successful response """
+        if not self.etag or isinstance(self._response,ApiError):
+            return {}
+        return {
+            'ETag':self.etag,
+            'Last-Modified':formatdate(self.last_modified,usegmt=True),
+            'Cache-Control':self.cache_control,
+        }
 
     def create_response(self,resp):
         self._response = ApiResponse(self._request_id,resp)
@@ -57,19 +101,59 @@ class RequestContext():
     def error(self,msg,err_type:str='general'):
         self._response = ApiError(self._request_id,msg,err_type)
 
+    def replay(self,response:dict):
+        """ Use response of completed request. Handler should return it as is """
+        self._response = response
+        self.replayed = True
+
+    @property
+    def is_transient_error(self) -> bool:
+        """ General errors (e.g. database) may not repeat on retry """
+        return isinstance(self._response,ApiError) and self._response.error_type == 'general'
+
     @property
     def response(self):
         return dict(self._response)
 
 @contextmanager
-def request_context(request_id):
+def request_context(request_id,idempotency_key:str=None,fingerprint:str=None,idempotency_store=None):
+    """Request processing context. Exceptions are converted to error response
+
+    Args:
+        request_id (str): request id
+        idempotency_key (str): client Idempotency-Key (scoped by endpoint). Response of completed
+            request with the same key is replayed (context.replayed is set)
+        fingerprint (str): request body hash, key reuse with other body is an error
+        idempotency_store (idempotency.IdempotencyStore): responses by Idempotency-Key. None - key ignored
+    """
     _request_context = RequestContext(request_id)
+    store = idempotency_store if idempotency_key else None
+    if store is not None:
+        from idempotency import IdempotencyError
+        try:
+            cached = store.begin(idempotency_key,fingerprint)
+        except IdempotencyError as ex:
+            _request_context.error(str(ex),'idempotency')
+            _request_context.replayed = True
+            cached = None
+        if _request_context.replayed or cached is not None:
+            if cached is not None:
+                _request_context.replay(cached)
+            yield _request_context
+            return
     try:
-        yield _request_context
+        with DatabaseManager.unit_of_work():
+            yield _request_context
     except ValidateException as ex:
         _request_context.error(str(ex),'validation')
     except ModelException as ex:
         _request_context.error(str(ex),'model')
     except Exception as ex:
         logger.exception(str(ex))
-        _request_context.error(str(ex))
\ No newline at end of file
+        _request_context.error(str(ex))
+    finally:
+        if store is not None:
+            if _request_context._response is None or _request_context.is_transient_error:
+                store.abort(idempotency_key)
+            else:
+                store.complete(idempotency_key,_request_context.response)
\ No newline at end of file
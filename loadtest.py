@@ -0,0 +1,322 @@
+"""Load generator replaying Thunder collection requests at given rate
+
+    python loadtest.py --rps 200 --concurrency 16 --duration 30
+    python loadtest.py --launch --workers 4 --threads 8 --mix create=1,get=6,list=1,update=1,delete=1,audit=2,audits=1
+
+Requests are scheduled at fixed rate (open loop), latency is measured from scheduled time,
+so server stalls are not hidden by waiting clients.
+"""
+import os
+import sys
+import json
+import math
+import time
+import queue
+import uuid
+import random
+import socket
+import argparse
+import threading
+import itertools
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+COLLECTION = os.path.join(os.path.dirname(__file__),'thunder-collection_User-Service.json')
+
+DEFAULT_MIX = {'create':2,'get':5,'list':1,'update':2,'delete':1,'audit':3,'audits':1}
+
+
+class Operation:
+    """Request template of the collection"""
+
+    def __init__(self,name:str,method:str,path:str,body:dict=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+
+    def request(self,username:str) -> tuple:
+        """Returns (method, path, body) with template username replaced"""
+        path = self.path.replace('{username}',username)
+        body = None
+        if self.body is not None:
+            body = {k:(username if k == 'username' else v) for k,v in self.body.items()}
+        return self.method, path, body
+
+
+def load_collection(path:str=COLLECTION) -> dict:
+    """Build operations of the mix from collection requests.
+       Get/delete user are derived from update request (same url)
+
+    Returns:
+        dict: operation name -> Operation
+    """
+    with open(path) as f:
+        collection = json.load(f)
+    requests = {}
+    for r in collection['requests']:
+        raw = (r.get('body') or {}).get('raw')
+        body = json.loads(raw) if raw else None
+        requests[(r['method'],urlsplit(r['url']).path)] = (r['name'],body)
+
+    def find(method,path_prefix):
+        for (m,path),(name,body) in requests.items():
+            if m == method and path.startswith(path_prefix):
+                return name,path,body
+        raise KeyError(f"{method} {path_prefix} not found in collection")
+
+    operations = {}
+    name,path,body = find('POST','/api/v1/users/')
+    operations['create'] = Operation(name,'POST',path,body)
+    name,path,_ = find('GET','/api/v1/users/')
+    operations['list'] = Operation(name,'GET',path)
+    name,path,body = find('PUT','/api/v1/users/')
+    user_path = path.rsplit('/',1)[0] + '/{username}'
+    operations['update'] = Operation(name,'PUT',user_path,body)
+    operations['get'] = Operation('Get user','GET',user_path)
+    operations['delete'] = Operation('Delete user','DELETE',user_path)
+    name,path,body = find('POST','/api/v1/audits/')
+    operations['audit'] = Operation(name,'POST',path,body)
+    name,path,_ = find('GET','/api/v1/audits/')
+    operations['audits'] = Operation(name,'GET',path)
+    return operations
+
+
+def percentile(values:list,p:float) -> float:
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[min(len(values),max(1,math.ceil(p / 100 * len(values)))) - 1]
+
+
+class Stats:
+    """Latencies and errors per operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self,operation:str,latency:float,error:str=None):
+        with self._lock:
+            self.latencies.setdefault(operation,[]).append(latency)
+            if error is not None:
+                errors = self.errors.setdefault(operation,{})
+                errors[error] = errors.get(error,0) + 1
+
+    def report(self,duration:float) -> dict:
+        ret = {}
+        for operation,latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            ret[operation] = {
+                'requests':len(latencies),
+                'throughput':len(latencies) / duration,
+                'p50':percentile(latencies,50),
+                'p95':percentile(latencies,95),
+                'p99':percentile(latencies,99),
+                'errors':self.errors.get(operation,{}),
+            }
+        return ret
+
+
+class LoadTest:
+
+    def __init__(self,base_url:str,operations:dict,mix:dict=None,rps:float=50,concurrency:int=8,
+                 seed_users:int=20,timeout:float=10.0):
+        """
+        Args:
+            base_url (str): service url, e.g. http://127.0.0.1:5000
+            operations (dict): operations from load_collection
+            mix (dict): operation name -> weight
+            rps (float): target requests per second
+            concurrency (int): client threads (max requests in flight)
+            seed_users (int): users created before measurement, targets of get/update/delete
+            timeout (float): request timeout
+        """
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.operations = operations
+        self.mix = mix or DEFAULT_MIX
+        unknown = set(self.mix) - set(operations)
+        if unknown:
+            raise ValueError(f"Unknown operations in mix: {sorted(unknown)}")
+        self.rps = rps
+        self.concurrency = concurrency
+        self.seed_users = seed_users
+        self.timeout = timeout
+        self.stats = Stats()
+        self._users = []
+        self._users_lock = threading.Lock()
+        self._prefix = f"lt{uuid.uuid4().hex[:6]}x"
+        self._counter = itertools.count()
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self._local,'connection',None) is None:
+            self._local.connection = http.client.HTTPConnection(self.host,self.port,timeout=self.timeout)
+        return self._local.connection
+
+    def call(self,method:str,path:str,body:dict=None) -> str:
+        """Send request, returns error kind or None"""
+        headers = {'Content-Type':'application/json'} if body is not None else {}
+        try:
+            connection = self._connection()
+            connection.request(method,path,json.dumps(body) if body is not None else None,headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError,http.client.HTTPException) as ex:
+            self._local.connection = None
+            return type(ex).__name__
+        if response.status >= 400:
+            return f"http_{response.status}"
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return None
+        if isinstance(payload,dict) and payload.get('status') == 'error':
+            return payload.get('error_type','error')
+        return None
+
+    def _new_username(self) -> str:
+        return f"{self._prefix}{next(self._counter)}"
+
+    def _pick_user(self,remove:bool=False) -> str:
+        with self._users_lock:
+            if not self._users:
+                return None
+            i = random.randrange(len(self._users))
+            if remove:
+                self._users[i], self._users[-1] = self._users[-1], self._users[i]
+                return self._users.pop()
+            return self._users[i]
+
+    def run_operation(self,name:str) -> tuple:
+        """Returns (operation actually sent, error kind or None)"""
+        if name in ('get','update','delete'):
+            username = self._pick_user(remove=name == 'delete')
+            if username is None:
+                name, username = 'create', self._new_username()
+        elif name == 'create':
+            username = self._new_username()
+        else:
+            username = self._pick_user() or self._new_username()
+        error = self.call(*self.operations[name].request(username))
+        if name == 'create' and error is None:
+            with self._users_lock:
+                self._users.append(username)
+        return name, error
+
+    def seed(self):
+        for _ in range(self.seed_users):
+            self.run_operation('create')
+
+    def run(self,duration:float) -> dict:
+        """Send requests at target rate for duration seconds
+
+        Returns:
+            dict: per operation requests, throughput, p50/p95/p99 latency (seconds), errors
+        """
+        self.seed()
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        scheduled = queue.Queue(maxsize=self.concurrency * 4)
+
+        def worker():
+            while True:
+                item = scheduled.get()
+                if item is None:
+                    return
+                start, name = item
+                delay = start - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                name, error = self.run_operation(name)
+                self.stats.add(name,time.monotonic() - start,error)
+
+        threads = [threading.Thread(target=worker,daemon=True) for _ in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        started = time.monotonic()
+        total = int(duration * self.rps)
+        for i in range(total):
+            scheduled.put((started + i / self.rps,random.choices(names,weights)[0]))
+        for _ in threads:
+            scheduled.put(None)
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+        report = self.stats.report(elapsed)
+        report['total'] = {
+            'requests':total,
+            'duration':elapsed,
+            'throughput':total / elapsed,
+            'errors':sum(sum(r['errors'].values()) for r in report.values()),
+        }
+        return report
+
+
+def format_report(report:dict) -> str:
+    lines = [f"{'operation':<10}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  errors"]
+    for name,r in report.items():
+        if name == 'total':
+            continue
+        errors = ', '.join(f"{k}:{v}" for k,v in sorted(r['errors'].items())) or '-'
+        lines.append(f"{name:<10}{r['requests']:>10}{r['throughput']:>10.1f}{r['p50'] * 1000:>10.1f}"
+            f"{r['p95'] * 1000:>10.1f}{r['p99'] * 1000:>10.1f}  {errors}")
+    t = report['total']
+    lines.append(f"total: {t['requests']} requests in {t['duration']:.1f}s, {t['throughput']:.1f} req/s, {t['errors']} errors")
+    return '\n'.join(lines)
+
+
+def launch_server(port:int,workers:int,threads:int) -> subprocess.Popen:
+    """Start server.py and wait until it accepts connections"""
+    process = subprocess.Popen([sys.executable,os.path.join(os.path.dirname(__file__),'server.py'),
+        '--host','127.0.0.1','--port',str(port),'--workers',str(workers),'--threads',str(threads)])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1',port),timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def parse_mix(value:str) -> dict:
+    mix = {}
+    for item in value.split(','):
+        name,weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Users service load generator")
+    parser.add_argument('--url',default='http://127.0.0.1:5000')
+    parser.add_argument('--collection',default=COLLECTION)
+    parser.add_argument('--rps',type=float,default=50)
+    parser.add_argument('--concurrency',type=int,default=8)
+    parser.add_argument('--duration',type=float,default=10)
+    parser.add_argument('--mix',type=parse_mix,default=DEFAULT_MIX)
+    parser.add_argument('--seed-users',type=int,default=20)
+    parser.add_argument('--json',action='store_true',help="print report as json")
+    parser.add_argument('--launch',action='store_true',help="start server.py on --url port for the test")
+    parser.add_argument('--workers',type=int,default=2)
+    parser.add_argument('--threads',type=int,default=8)
+    args = parser.parse_args(argv)
+
+    server = launch_server(urlsplit(args.url).port or 80,args.workers,args.threads) if args.launch else None
+    try:
+        test = LoadTest(args.url,load_collection(args.collection),args.mix,args.rps,args.concurrency,args.seed_users)
+        report = test.run(args.duration)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    print(json.dumps(report,indent=2) if args.json else format_report(report))
+
+
+if __name__ == '__main__':
+    main()
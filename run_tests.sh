@@ -2,3 +2,15 @@
 python3 -m unittest tests.test_model.TestModel -vvv
 python3 -m unittest tests.test_db_sqlite.TestSqLiteBackend -vvv
 python3 -m unittest tests.test_api.TestApi -vvv
+python3 -m unittest tests.test_db_sharded.TestShardedBackend -vvv
+python3 -m unittest tests.test_db_memory.TestMemoryCacheBackend -vvv
+python3 -m unittest tests.test_db_dbapi.TestDbApiBackend -vvv
+python3 -m unittest tests.test_admission.TestAdmission -vvv
+python3 -m unittest tests.test_idempotency.TestIdempotency -vvv
+python3 -m unittest tests.test_compression.TestCompression -vvv
+python3 -m unittest tests.test_audit_export.TestAuditExport -vvv
+python3 -m unittest tests.test_audit_analytics.TestAuditAnalytics -vvv
+python3 -m unittest tests.test_startup.TestStartup -vvv
+python3 -m unittest tests.test_loadtest.TestLoadTest -vvv
+python3 -m unittest tests.test_compaction.TestCompaction -vvv
+python3 -m unittest tests.test_ingest.TestIngest -vvv
@@ -0,0 +1,118 @@
+"""Production launcher: pre-forked worker processes, each serving requests from a thread pool
+
+    python server.py --host 0.0.0.0 --port 5000 --workers 4 --threads 8
+
+Database connections are opened lazily inside every worker after fork.
+"""
+import os
+import signal
+import socket
+import logging
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger(__name__)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server handling requests in fixed size thread pool"""
+
+    multithread = True
+
+    def __init__(self,*args,threads:int=8,**kwargs):
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        super(PooledWSGIServer, self).__init__(*args,**kwargs)
+
+    def process_request(self,request,client_address):
+        self._pool.submit(self._process_request_thread,request,client_address)
+
+    def _process_request_thread(self,request,client_address):
+        try:
+            self.finish_request(request,client_address)
+        except Exception:
+            self.handle_error(request,client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def close_pool(self):
+        self._pool.shutdown(wait=True)
+
+
+def _stop(signum,frame):
+    raise SystemExit(0)
+
+
+def run_worker(sock:socket.socket,host:str,port:int,threads:int,index:int=0):
+    import wsgi
+
+    signal.signal(signal.SIGTERM,_stop)
+    signal.signal(signal.SIGINT,_stop)
+    # Periodic backup (settings.BACKUP_INTERVAL) runs in first worker only
+    wsgi.on_worker_start(backup=index == 0)
+    server = PooledWSGIServer(host,port,wsgi.app,threads=threads,fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        server.close_pool()
+        server.server_close()
+        wsgi.on_worker_stop()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Users service pre-fork launcher")
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=5000)
+    parser.add_argument('--workers',type=int,default=os.cpu_count() or 1)
+    parser.add_argument('--threads',type=int,default=8)
+    args = parser.parse_args(args)
+
+    sock = socket.create_server((args.host,args.port),reuse_port=False,backlog=1024)
+    sock.set_inheritable(True)
+    logger.info("Listen %s:%s with %s workers x %s threads",args.host,args.port,args.workers,args.threads)
+
+    # pid => worker index, restarted worker keeps index
+    workers = {}
+    stopping = False
+
+    def spawn(index:int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(sock,args.host,args.port,args.threads,index)
+            except SystemExit:
+                pass
+            except Exception:
+                logger.exception("Worker %s failed",os.getpid())
+                code = 1
+            os._exit(code)
+        workers[pid] = index
+
+    def shutdown(signum,frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid,signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM,shutdown)
+    signal.signal(signal.SIGINT,shutdown)
+    for index in range(args.workers):
+        spawn(index)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid,None)
+        if not stopping and index is not None:
+            logger.warning("Worker %s exited with %s, restart",pid,status)
+            time.sleep(1)
+            spawn(index)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import sys
+import logging
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmission(unittest.TestCase):
+
+    @patch('admission.time')
+    def test_admission_client_rate(self,timefunc):
+        """ Test client bucket with cost weights """
+        timefunc.monotonic.return_value = 100
+        controller = AdmissionController(client_rate=(1,10),costs={'list':5})
+        controller.acquire('client1','list')
+        controller.acquire('client1','list')
+        with self.assertRaises(AdmissionRejected) as context:
+            controller.acquire('client1','get')
+        self.assertEqual(context.exception.retry_after,1)
+        # Other client has own bucket
+        controller.acquire('client2','list')
+        # Refill
+        timefunc.monotonic.return_value = 101
+        controller.acquire('client1','get')
+        self.assertEqual(controller.stats,{'admitted':4,'rate_limited':1,'concurrency_limited':0})
+
+    def test_admission_concurrency(self):
+        """ Test per endpoint concurrency limit """
+        controller = AdmissionController(concurrency={'list':1})
+        controller.acquire('client1','list')
+        with self.assertRaises(AdmissionRejected):
+            controller.acquire('client2','list')
+        controller.acquire('client2','get')
+        controller.release('list')
+        controller.acquire('client2','list')
+
+    def test_admission_max_clients(self):
+        """ Test client buckets storage is bounded """
+        controller = AdmissionController(client_rate=(1,1),max_clients=2)
+        for client in ['client1','client2','client3']:
+            controller.acquire(client,'get')
+        self.assertEqual(list(controller._clients),['client2','client3'])
@@ -4,7 +4,12 @@ import logging
 import unittest
 import json
 import time
+import gzip
+import contextlib
+import threading
+import types
 from unittest.mock import MagicMock,patch
+import wsgi
 from wsgi import app
 
 sys.path.append("./lib")
@@ -15,6 +20,10 @@ app.testing = True
 from db import DatabaseManager,BackendErrorNotFound
 from model.user import User
 from model.audit import Audit
+from admission import AdmissionController
+from db.sqlite import SqLiteBackend, SqLiteMemoryReplica, init_database
+from search import UsernameIndex
+from feed import ChangeSet
 
 
 class TestApi(unittest.TestCase):
@@ -26,6 +35,8 @@ class TestApi(unittest.TestCase):
 
     def setUp(self):
         self._backend = MagicMock()
+        # Table versions are counted in process
+        del self._backend.table_version
         DatabaseManager.register_backend(self._backend)
 
     def test_api_get_users(self):
@@ -48,6 +59,35 @@ class TestApi(unittest.TestCase):
         self.assertEqual(rv.json['payload']['item'],{'username':'test1','password':'p1234','gender':'male'})
 
 
+    def test_api_get_user_not_modified(self):
+        client = app.test_client()
+        self._backend.load_by_id.return_value = {'username':'test1','password':'p1234','gender':'male'}
+        rv = client.get("/api/v1/users/test1")
+        etag = rv.headers['ETag']
+        self.assertIn('Last-Modified',rv.headers)
+        self.assertEqual(rv.headers['Cache-Control'],'no-cache')
+        rv = client.get("/api/v1/users/test1",headers={'If-None-Match':etag})
+        self.assertEqual(rv.status_code,304)
+        self._backend.load_by_id.assert_called_once()
+        # Other user has other ETag
+        rv = client.get("/api/v1/users/test2",headers={'If-None-Match':etag})
+        self.assertEqual(rv.status_code,200)
+        # Update changes ETag
+        client.put("/api/v1/users/test1",data=json.dumps({'password':'p12345678'}),content_type='application/json')
+        rv = client.get("/api/v1/users/test1",headers={'If-None-Match':etag})
+        self.assertEqual(rv.status_code,200)
+        self.assertNotEqual(rv.headers['ETag'],etag)
+
+    def test_api_get_user_no_shared_version(self):
+        """ Test no caching headers if table version is not shared by workers """
+        client = app.test_client()
+        del self._backend.data_version
+        self._backend.load_by_id.return_value = {'username':'test1','password':'p1234','gender':'male'}
+        rv = client.get("/api/v1/users/test1",headers={'If-None-Match':'*'})
+        self.assertEqual(rv.status_code,200)
+        self.assertNotIn('ETag',rv.headers)
+        self.assertNotIn('Last-Modified',rv.headers)
+
     def test_api_get_user_not_found(self):
         client = app.test_client()
         self._backend.load_by_id.side_effect = BackendErrorNotFound('Not found')
@@ -138,6 +178,7 @@ class TestApi(unittest.TestCase):
         self.assertEqual(rv.json['status'],'error')
         self.assertEqual(rv.json['error_type'],'model')
         self.assertEqual(rv.json['message'],"username is read only")
+        self._backend.save.assert_not_called()
 
 
     @patch('model.audit.time')
@@ -162,6 +203,8 @@ class TestApi(unittest.TestCase):
         self.assertEqual(updates['message'],'user test1 deleted')
         self.assertEqual(updates['username'],'test1')
         self.assertEqual(updates['datetime'],now_timestamp)
+        # User and audit saved in one write unit
+        self._backend.write_unit.assert_called_once()
 
 
     def test_api_get_audits(self):
@@ -175,7 +218,7 @@ class TestApi(unittest.TestCase):
         self._backend.load_list.return_value = audit_data
         rv = client.get("/api/v1/audits/")
         self.assertNotEqual(rv.data, None)
-        self._backend.load_list.assert_called_once_with('audit',None)
+        self._backend.load_list.assert_called_once_with('audit',None,'datetime')
         self.assertEqual(rv.json['status'],'ok')
         self.assertDictEqual(rv.json['payload']['items'][0],audit_data[0])
         self.assertDictEqual(rv.json['payload']['items'][1],audit_data[1])
@@ -201,3 +244,306 @@ class TestApi(unittest.TestCase):
         self.assertEqual(rv.json['payload']['item']['datetime'],now_timestamp)
 
 
+
+    def test_api_create_audit_idempotent(self):
+        client = app.test_client()
+        headers = {'Idempotency-Key':'retry-1'}
+        audit_data = {'username':'test1','message':'test audit for user1'}
+        rv = client.post("/api/v1/audits/",data=json.dumps(audit_data),content_type='application/json',headers=headers)
+        self.assertEqual(rv.json['status'],'ok')
+        retry = client.post("/api/v1/audits/",data=json.dumps(audit_data),content_type='application/json',headers=headers)
+        self.assertEqual(retry.json,rv.json)
+        self._backend.save.assert_called_once()
+        # Same key with other body
+        audit_data['message'] = 'other'
+        rv = client.post("/api/v1/audits/",data=json.dumps(audit_data),content_type='application/json',headers=headers)
+        self.assertEqual(rv.json['error_type'],'idempotency')
+        self._backend.save.assert_called_once()
+
+    def test_api_get_changes(self):
+        client = app.test_client()
+        self._backend.load_changes.return_value = [
+            {'seq':1,'table_name':'users','record_key':'test1','operation':'insert','datetime':1704893712},
+            {'seq':2,'table_name':'users','record_key':'test1','operation':'update','datetime':1704893712},
+            {'seq':3,'table_name':'audit','record_key':'be266e0d9e1d4','operation':'insert','datetime':1704893712},
+            ]
+        audit_data = {'datetime':1704893712,'username':'test1','message':'user test1 deleted','uuid':'be266e0d9e1d4'}
+        self._backend.load_by_id.side_effect = [{'username':'test1','password':'p1234','gender':'male','deleted':1},audit_data]
+        rv = client.get("/api/v1/changes?since=0")
+        self._backend.load_changes.assert_called_once_with(0,100)
+        self.assertEqual(rv.json['status'],'ok')
+        self.assertEqual(rv.json['payload']['item'],{'last_seq':3,'users':[],'deleted_users':['test1'],'audits':[audit_data]})
+
+    def test_api_changes_subscribers(self):
+        """ Test long poll and stream subscribers limit, bad stream position """
+        client = wsgi.create_app(types.SimpleNamespace(FEED_MAX_SUBSCRIBERS=1)).test_client()
+        self._backend.load_changes.return_value = []
+        rv = client.get("/api/v1/changes/stream?since=abc")
+        self.assertEqual(rv.status_code,400)
+        with patch('feed.wait_changes',return_value=ChangeSet(0,[],[],[])):
+            stream = client.get("/api/v1/changes/stream?since=0")
+        self.assertEqual(stream.status_code,200)
+        rv = client.get("/api/v1/changes?since=0&wait=0.01")
+        self.assertEqual(rv.status_code,503)
+        self.assertEqual(rv.json['error_type'],'feed_busy')
+        self.assertEqual(client.get("/api/v1/changes/stream").status_code,503)
+        # Short poll does not wait
+        self.assertEqual(client.get("/api/v1/changes?since=0").json['status'],'ok')
+        stream.close()
+        rv = client.get("/api/v1/changes?since=0&wait=0.01")
+        self.assertEqual(rv.json['payload']['item']['last_seq'],0)
+
+    def test_api_bulk_update_users(self):
+        client = app.test_client()
+        self._backend.bulk_update.return_value = ['test1','test2']
+        rv = client.patch("/api/v1/users/",data=json.dumps(
+            {'usernames':['test1','test2','test3'],'update':{'gender':'female'}}
+            ),content_type='application/json')
+        self.assertEqual(rv.json['status'],'ok')
+        self._backend.bulk_update.assert_called_once_with('users',{'gender':'female'},'username',['test1','test2','test3'],{'deleted':0})
+        self.assertEqual(rv.json['payload']['items'],[{'username':'test1'},{'username':'test2'}])
+
+    def test_api_bulk_update_users_validation_error(self):
+        client = app.test_client()
+        rv = client.patch("/api/v1/users/",data=json.dumps(
+            {'usernames':['test1'],'update':{'gender':'wrong_enum'}}
+            ),content_type='application/json')
+        self.assertEqual(rv.json['error_type'],'validation')
+        rv = client.patch("/api/v1/users/",data=json.dumps(
+            {'usernames':['test1'],'update':{'username':'test2'}}
+            ),content_type='application/json')
+        self.assertEqual(rv.json['error_type'],'model')
+        # Deletion only by bulk delete
+        rv = client.patch("/api/v1/users/",data=json.dumps(
+            {'usernames':['test1'],'update':{'deleted':1}}
+            ),content_type='application/json')
+        self.assertEqual(rv.json['error_type'],'model')
+        self._backend.bulk_update.assert_not_called()
+
+    def test_api_bulk_delete_users(self):
+        client = app.test_client()
+        self._backend.bulk_update.return_value = ['test1','test2']
+        rv = client.delete("/api/v1/users/",data=json.dumps({'usernames':['test1','test2']}),content_type='application/json')
+        self.assertEqual(rv.json['status'],'ok')
+        self._backend.bulk_update.assert_called_once_with('users',{'deleted':1},'username',['test1','test2'],{'deleted':0})
+        audits = self._backend.save_many.call_args[0][0]
+        self.assertEqual([a.get_db_updates()['message'] for a in audits],['user test1 deleted','user test2 deleted'])
+
+    def test_api_search_users(self):
+        client = app.test_client()
+        self._backend.load_list.return_value = [{'username':u,'password':'p1234','gender':'male','deleted':0} for u in ['bob','alice','albert']]
+        rv = client.get("/api/v1/users/search?prefix=al")
+        self.assertEqual(rv.json['payload']['items'],[{'username':'albert'},{'username':'alice'}])
+        self._backend.load_list.assert_called_once_with('users',{'deleted':0})
+        # Index maintained on create and delete
+        self._backend.load_by_id.side_effect = BackendErrorNotFound('Not found')
+        client.post("/api/v1/users/",data=json.dumps({'username':'alfred','password':'p1234','gender':'male'}),content_type='application/json')
+        self._backend.load_by_id.side_effect = None
+        self._backend.load_by_id.return_value = {'username':'albert','password':'p1234','gender':'male','deleted':0}
+        client.delete("/api/v1/users/albert")
+        rv = client.get("/api/v1/users/search?prefix=al&limit=5")
+        self.assertEqual(rv.json['payload']['items'],[{'username':'alfred'},{'username':'alice'}])
+        rv = client.get("/api/v1/users/search?prefix=al&limit=1")
+        self.assertEqual(rv.json['payload']['items'],[{'username':'alfred'}])
+        self._backend.load_list.assert_called_once()
+        rv = client.get("/api/v1/users/search?prefix=al&limit=1000")
+        self.assertEqual(rv.json['error_type'],'validation')
+
+    def test_api_rate_limited(self):
+        client = app.test_client()
+        self._backend.load_list.return_value = []
+        app.extensions['admission'] = AdmissionController(client_rate=(0.1,10),costs={'api_audit_get':10})
+        try:
+            rv = client.get("/api/v1/audits/")
+            self.assertEqual(rv.status_code,200)
+            rv = client.get("/api/v1/audits/")
+            self.assertEqual(rv.status_code,429)
+            self.assertEqual(rv.json['status'],'error')
+            self.assertEqual(rv.json['error_type'],'rate_limit')
+            self.assertIn('Retry-After',rv.headers)
+            self._backend.load_list.assert_called_once()
+        finally:
+            app.extensions['admission'] = None
+
+    def test_api_get_audits_compressed(self):
+        client = app.test_client()
+        audit_data = [{'datetime':1704893712+i,'username':'test1','message':'test audit for user1','uuid':f'be266e0d9e1d{i}'} for i in range(100)]
+        self._backend.load_list.return_value = audit_data
+        rv = client.get("/api/v1/audits/",headers={'Accept-Encoding':'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'],'gzip')
+        self.assertIn('Accept-Encoding',rv.headers['Vary'])
+        payload = json.loads(gzip.decompress(rv.data))
+        self.assertEqual(payload['payload']['items'],audit_data)
+        # Small response not compressed
+        self._backend.load_list.return_value = audit_data[:1]
+        rv = client.get("/api/v1/audits/",headers={'Accept-Encoding':'gzip'})
+        self.assertNotIn('Content-Encoding',rv.headers)
+
+    def test_api_audit_stats(self):
+        client = app.test_client()
+        stats = [{'username':'test1','bucket':1704891600,'count':2}]
+        self._backend.audit_stats.return_value = stats
+        rv = client.get("/api/v1/audits/stats?start=1704891600&bucket=day")
+        self.assertEqual(rv.json['status'],'ok')
+        self._backend.audit_stats.assert_called_once_with(1704891600,None,86400,None)
+        self.assertEqual(rv.json['payload']['items'],stats)
+        rv = client.get("/api/v1/audits/stats?bucket=week")
+        self.assertEqual(rv.json['error_type'],'validation')
+        rv = client.get("/api/v1/audits/stats?start=1704891600&end=1704891601")
+        self.assertEqual(rv.json['error_type'],'validation')
+        self._backend.audit_stats.assert_called_once()
+
+    def test_api_admin_compact(self):
+        client = app.test_client()
+        self._backend.archive_deleted.return_value = ['test1','test2']
+        self._backend.prune_changes.return_value = 0
+        self._backend.vacuum.return_value = 4096
+        rv = client.get("/api/v1/admin/compact")
+        self.assertEqual(rv.status_code,200)
+        self.assertEqual(rv.json['rows'],2)
+        self.assertEqual(rv.json['batches'],1)
+        self.assertEqual(rv.json['bytes_reclaimed'],4096)
+        table,key,older_than,limit = self._backend.archive_deleted.call_args[0]
+        self.assertEqual((table,key),('users','username'))
+        self.assertLess(older_than,time.time() - 29 * 86400)
+        audits = self._backend.save_many.call_args[0][0]
+        self.assertEqual([(a.username.value,a.message.value) for a in audits],[('test1','user test1 purged'),('test2','user test2 purged')])
+
+    def test_api_app_config(self):
+        """ Test config of one app does not change other app """
+        other = wsgi.create_app(types.SimpleNamespace(CACHE_CONTROL='private, no-cache',COMPACTION={'retention':86400},
+            IDEMPOTENCY={'max_size':10}))
+        self._backend.load_by_id.return_value = {'username':'test1','password':'p1234','gender':'male'}
+        self.assertEqual(other.test_client().get("/api/v1/users/test1").headers['Cache-Control'],'private, no-cache')
+        self.assertEqual(app.test_client().get("/api/v1/users/test1").headers['Cache-Control'],'no-cache')
+        self._backend.archive_deleted.return_value = ['test1']
+        self._backend.prune_changes.return_value = 0
+        self._backend.vacuum.return_value = 0
+        other.test_client().get("/api/v1/admin/compact")
+        self.assertGreater(self._backend.archive_deleted.call_args[0][2],time.time() - 2 * 86400)
+        app.test_client().get("/api/v1/admin/compact")
+        self.assertLess(self._backend.archive_deleted.call_args[0][2],time.time() - 29 * 86400)
+        self.assertIsNot(other.extensions['idempotency'],app.extensions['idempotency'])
+
+
+class TestApiSqLite(unittest.TestCase):
+
+    DB_FILENAME = "api_sqlite_unit_test.db"
+
+    def setUp(self):
+        with contextlib.redirect_stdout(None):
+            init_database(TestApiSqLite.DB_FILENAME)
+        self._backend = SqLiteBackend(TestApiSqLite.DB_FILENAME,group_commit=True,group_delay=0.05)
+        DatabaseManager.register_backend(self._backend)
+
+    def tearDown(self):
+        self._backend.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestApiSqLite.DB_FILENAME)
+
+    def test_api_concurrent_requests_group_commit(self):
+        """ Test concurrent requests units share commits """
+        statuses = []
+
+        def create_user(username):
+            rv = app.test_client().post("/api/v1/users/",data=json.dumps({'username':username,'password':'p12345678','gender':'male'}),content_type='application/json')
+            statuses.append(rv.json['status'])
+
+        threads = [threading.Thread(target=create_user,args=(f"user{i}",)) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(statuses,['ok'] * 10)
+        self.assertEqual(len(self._backend.load_list('users')),10)
+        self.assertEqual(self._backend.group_stats['writes'],len(self._backend.load_changes(0)))
+        self.assertLess(self._backend.group_stats['commits'],10)
+
+    def test_api_read_your_writes(self):
+        """ Test client reads its writes from primary until replica is refreshed after them """
+        replica = SqLiteMemoryReplica(self._backend)
+        DatabaseManager.register_backend(self._backend,[replica])
+        client = app.test_client()
+        rv = client.post("/api/v1/users/",data=json.dumps({'username':'test1','password':'p12345678','gender':'male'}),content_type='application/json')
+        self.assertEqual(rv.json['status'],'ok')
+        self.assertIsNotNone(client.get_cookie('last_write'))
+        # Writer (served by any worker) reads from primary, other clients from replica
+        self.assertEqual(client.get("/api/v1/users/test1").json['status'],'ok')
+        self.assertEqual(app.test_client().get("/api/v1/users/test1").json['status'],'error')
+        replica.refresh()
+        self.assertEqual(app.test_client().get("/api/v1/users/test1").json['status'],'ok')
+
+    def test_username_index_other_process_writes(self):
+        """ Test username index applies users changes of other worker from change log """
+        index = UsernameIndex()
+        index.refresh()
+        other = SqLiteBackend(TestApiSqLite.DB_FILENAME)
+        user = MagicMock(_db_table="users")
+        user.get_db_key.return_value = ['username',None]
+        for username in ['alice','albert']:
+            user.get_db_updates.return_value = {'username':username,'password':'p1234','gender':'male','deleted':0}
+            other.save(user)
+        with patch.object(index,'rebuild',side_effect=AssertionError('rebuild')):
+            index.refresh()
+            self.assertEqual(index.search('al'),['albert','alice'])
+            user.get_db_key.return_value = ['username','albert']
+            user.get_db_updates.return_value = {'deleted':1}
+            other.save(user)
+            index.refresh()
+            self.assertEqual(index.search('al'),['alice'])
+        # Too many changes rebuild index
+        index.sync_max_changes = 0
+        other.delete(user)
+        user.get_db_key.return_value = ['username',None]
+        user.get_db_updates.return_value = {'username':'alfred','password':'p1234','gender':'male','deleted':0}
+        other.save(user)
+        with patch.object(index,'rebuild',wraps=index.rebuild) as rebuild:
+            index.refresh()
+        rebuild.assert_called_once()
+        self.assertEqual(index.search('al'),['alfred','alice'])
+        other.close()
+
+    def test_username_index_restore(self):
+        """ Test username index rebuilt after database restore by other worker or by this one """
+        backup_filename = TestApiSqLite.DB_FILENAME + ".backup"
+        index = UsernameIndex()
+        index.refresh()
+        other = SqLiteBackend(TestApiSqLite.DB_FILENAME)
+        user = MagicMock(_db_table="users")
+        user.get_db_key.return_value = ['username',None]
+        user.get_db_updates.return_value = {'username':'alice','password':'p1234','gender':'male','deleted':0}
+        other.save(user)
+        other.backup(backup_filename)
+        user.get_db_updates.return_value = {'username':'albert','password':'p1234','gender':'male','deleted':0}
+        other.save(user)
+        index.refresh()
+        self.assertEqual(index.search('al'),['albert','alice'])
+        # Restore change gets sequence number of last change seen by index
+        other.restore(backup_filename)
+        index.refresh()
+        self.assertEqual(index.search('al'),['alice'])
+        user.get_db_updates.return_value = {'username':'alfred','password':'p1234','gender':'male','deleted':0}
+        other.save(user)
+        index.refresh()
+        self.assertEqual(index.search('al'),['alfred','alice'])
+        self._backend.restore(backup_filename)
+        index.refresh()
+        self.assertEqual(index.search('al'),['alice'])
+        other.close()
+        os.remove(backup_filename)
+
+    def test_periodic_backup(self):
+        """ Test backup file written every BACKUP_INTERVAL """
+        backup_filename = TestApiSqLite.DB_FILENAME + ".backup"
+        self.assertIsNone(wsgi.start_periodic_backup(types.SimpleNamespace(BACKUP_INTERVAL=None)))
+        thread = wsgi.start_periodic_backup(types.SimpleNamespace(BACKUP_INTERVAL=0.05,BACKUP_PATH=backup_filename))
+        try:
+            deadline = time.monotonic() + 5
+            while thread.last_stats is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            wsgi.stop_periodic_backup()
+            thread.join(1)
+        self.assertGreater(thread.last_stats['pages'],0)
+        self.assertTrue(os.path.exists(backup_filename))
+        os.remove(backup_filename)
@@ -0,0 +1,64 @@
+import sys
+import math
+import shutil
+import logging
+import sqlite3
+import unittest
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+import audit_analytics
+from audit_analytics import AuditColumns, histogram, per_user_counts, gap_percentiles, retention_projection, report, benchmark
+from audit_export import export_audits
+
+
+class TestAuditAnalytics(unittest.TestCase):
+
+    EXPORT_PATH = "audit_analytics_unit_test"
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+        self.connection.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+        # user0 every 100s, user1 every 300s for 2 days (day 1 in archive)
+        day = 1704844800
+        rows = [("user0",day + t) for t in range(0,2 * 86400,100)] + [("user1",day + t) for t in range(50,2 * 86400,300)]
+        for i,(username,datetime) in enumerate(rows):
+            table = 'audit_archive' if datetime < day + 86400 else 'audit'
+            self.connection.execute(f"INSERT INTO {table} VALUES (?,?,?,?)",(f"uuid{i}",username,"message",datetime))
+        self.day = day
+        self.columns = AuditColumns.from_database(self.connection,chunk_size=1000)
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(TestAuditAnalytics.EXPORT_PATH,ignore_errors=True)
+
+    def test_analytics_python(self):
+        """ Test pure Python path """
+        self.assertEqual(len(self.columns),1728 + 576)
+        self.assertEqual(histogram(self.columns,86400,use_numpy=False),[(self.day,1152),(self.day + 86400,1152)])
+        self.assertEqual(histogram(self.columns,3600,self.day,self.day + 3600,use_numpy=False),[(self.day,48)])
+        self.assertEqual(per_user_counts(self.columns,use_numpy=False),[('user0',1728),('user1',576)])
+        self.assertEqual(gap_percentiles(self.columns,(50,100),per_user=True,use_numpy=False),{50:100,100:300})
+        self.assertEqual(gap_percentiles(self.columns,(50,99),use_numpy=False),{50:50,99:100})
+        retention = retention_projection(self.columns,window_days=1,max_size=2304,use_numpy=False)
+        self.assertEqual(retention['peak_daily'],1152)
+        self.assertEqual(retention['rows_for_days'][7],math.ceil(retention['daily_rate'] * 7))
+        self.assertAlmostEqual(retention['days_kept'],2304 / retention['daily_rate'])
+
+    def test_analytics_export(self):
+        """ Test memory mapped export columns give the same results """
+        export_audits(self.connection,TestAuditAnalytics.EXPORT_PATH)
+        with AuditColumns.from_export(TestAuditAnalytics.EXPORT_PATH) as columns:
+            self.assertEqual(report(columns,use_numpy=False),report(self.columns,use_numpy=False))
+
+    @unittest.skipUnless(audit_analytics.numpy,"numpy is not installed")
+    def test_analytics_numpy(self):
+        """ Test NumPy path gives the same results as pure Python """
+        self.assertEqual(report(self.columns,3600,use_numpy=True),report(self.columns,3600,use_numpy=False))
+        export_audits(self.connection,TestAuditAnalytics.EXPORT_PATH)
+        with AuditColumns.from_export(TestAuditAnalytics.EXPORT_PATH) as columns:
+            self.assertEqual(report(columns,use_numpy=True),report(self.columns,use_numpy=False))
+        logger.info(benchmark(self.columns))
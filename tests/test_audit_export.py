@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import logging
+import sqlite3
+import unittest
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from audit_export import export_audits, ColumnarAuditReader
+
+
+class TestAuditExport(unittest.TestCase):
+
+    EXPORT_PATH = "audit_export_unit_test"
+
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+        self.connection.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+        for i in range(100):
+            table = 'audit_archive' if i < 40 else 'audit'
+            self.connection.execute(f"INSERT INTO {table} VALUES (?,?,?,?)",(f"uuid{i}",f"user{i % 3}",f"message {i}",1000000 + i))
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(TestAuditExport.EXPORT_PATH,ignore_errors=True)
+
+    def test_export_and_scan(self):
+        """ Test export in chunks and scan by time range """
+        stats = export_audits(self.connection,TestAuditExport.EXPORT_PATH,chunk_size=7)
+        self.assertEqual(stats['rows'],100)
+        self.assertEqual(stats['usernames'],3)
+        with ColumnarAuditReader(TestAuditExport.EXPORT_PATH) as reader:
+            self.assertEqual(len(reader),100)
+            rows = list(reader.scan(1000038,1000042))
+            self.assertEqual([r['datetime'] for r in rows],[1000038,1000039,1000040,1000041])
+            self.assertEqual(rows[0],{'uuid':'uuid38','username':'user2','message':'message 38','datetime':1000038,'archived':True})
+            self.assertFalse(rows[-1]['archived'])
+            self.assertEqual(len(list(reader.scan())),100)
+
+    def test_export_streams_index_order(self):
+        """ Test tables are read in datetime index order without sort, bytes counts only export files """
+        export_audits(self.connection,TestAuditExport.EXPORT_PATH)
+        for table in ('audit','audit_archive'):
+            plan = " ".join(str(row[-1]) for row in self.connection.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM {table} ORDER BY datetime"))
+            self.assertNotIn('TEMP B-TREE',plan)
+        with open(os.path.join(TestAuditExport.EXPORT_PATH,'unrelated.bin'),'wb') as unrelated:
+            unrelated.write(b'0' * 100000)
+        stats = export_audits(self.connection,TestAuditExport.EXPORT_PATH)
+        self.assertLess(stats['bytes'],100000)
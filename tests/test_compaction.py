@@ -0,0 +1,115 @@
+import sys
+import os
+import logging
+import contextlib
+import unittest
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from db import DatabaseManager, BackendError
+from db.sqlite import SqLiteBackend, init_database
+from model.user import User
+from compaction import compact_deleted_users
+from feed import get_changes
+from search import UsernameIndex
+
+
+class TestCompaction(unittest.TestCase):
+
+    DB_FILENAME = "compaction_unit_test.db"
+
+    def setUp(self):
+        with contextlib.redirect_stdout(None):
+            init_database(TestCompaction.DB_FILENAME)
+        self._backend = SqLiteBackend(TestCompaction.DB_FILENAME)
+        DatabaseManager.register_backend(self._backend)
+        for i in range(5):
+            User.create(username=f'user{i}',password='p1234',gender='male').save()
+        for i in range(3):
+            User(**self._backend.load_by_id('users',{'username':f'user{i}'})).delete()
+
+    def tearDown(self):
+        self._backend.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestCompaction.DB_FILENAME)
+
+    def test_compaction_retention(self):
+        """ Test only users deleted before retention window are moved """
+        # user0, user1 deleted long ago
+        self._backend.connection.execute("UPDATE changes SET datetime=1000 WHERE record_key IN ('user0','user1')")
+        self._backend.connection.commit()
+        stats = compact_deleted_users(retention=86400,batch_size=1)
+        self.assertEqual((stats['rows'],stats['batches']),(2,2))
+        self.assertEqual(sorted(u['username'] for u in self._backend.load_list('users')),['user2','user3','user4'])
+        self.assertEqual(sorted(u['username'] for u in self._backend.load_list('users_deleted')),['user0','user1'])
+        messages = [a['message'] for a in self._backend.load_list('audit')]
+        self.assertEqual(sorted(m for m in messages if 'purged' in m),['user user0 purged','user user1 purged'])
+        self.assertEqual(compact_deleted_users(retention=86400)['rows'],0)
+
+    def test_compaction_without_changes(self):
+        """ Test users deleted before change log existed are kept for retention from first run """
+        self._backend.connection.execute("DELETE FROM changes")
+        self._backend.connection.commit()
+        self.assertEqual(compact_deleted_users(retention=86400)['rows'],0)
+        self.assertEqual(len(self._backend.load_list('users')),5)
+        changes = self._backend.load_changes()
+        self.assertEqual(sorted(c['record_key'] for c in changes),['user0','user1','user2'])
+        self.assertEqual({c['operation'] for c in changes},{'delete'})
+        # Retention window started on first run
+        self.assertEqual(compact_deleted_users(retention=86400)['rows'],0)
+        self._backend.connection.execute("UPDATE changes SET datetime=1000")
+        self._backend.connection.commit()
+        self.assertEqual(compact_deleted_users(retention=86400)['rows'],3)
+
+    def test_compaction_prune_changes(self):
+        """ Test changes before retention pruned, last change and its sequence number kept """
+        # Index of other process
+        other = SqLiteBackend(TestCompaction.DB_FILENAME)
+        DatabaseManager.register_backend(other)
+        index = UsernameIndex()
+        index.refresh()
+        DatabaseManager.register_backend(self._backend)
+        User.create(username='user5',password='p1234',gender='male').save()
+        last_seq = self._backend.changes_seq()
+        self._backend.connection.execute("UPDATE changes SET datetime=1000")
+        self._backend.connection.commit()
+        stats = compact_deleted_users(retention=86400,batch_size=2)
+        self.assertEqual(stats['rows'],3)
+        self.assertEqual(stats['changes_pruned'],last_seq)
+        self.assertEqual(self._backend.load_changes()[0]['seq'],last_seq + 1)
+        with self.assertRaises(BackendError):
+            get_changes(1)
+        # Index missed pruned creation of user5 and is rebuilt
+        DatabaseManager.register_backend(other)
+        try:
+            index.refresh()
+        finally:
+            DatabaseManager.register_backend(self._backend)
+            other.close()
+        self.assertEqual(index.search('user'),['user3','user4','user5'])
+
+    def test_compaction_vacuum(self):
+        """ Test space returned to file system by vacuum """
+        for i in range(5,500):
+            User.create(username=f'user{i}',password='p1234',gender='male').save()
+        User.bulk_delete(where={'gender':'male'})
+        stats = compact_deleted_users(retention=-1,vacuum='incremental')
+        self.assertEqual(stats['rows'],500)
+        self.assertEqual(self._backend.load_list('users'),[])
+        self.assertGreaterEqual(stats['bytes_reclaimed'],0)
+        # Database is created with incremental vacuum
+        self.assertEqual(self._backend.connection.execute("PRAGMA auto_vacuum").fetchone()[0],2)
+        self._backend.connection.execute("DELETE FROM users_deleted")
+        self._backend.connection.commit()
+        free_pages = self._backend.database_size()['free_pages']
+        self.assertGreater(self._backend.vacuum('incremental'),0)
+        self.assertLess(self._backend.database_size()['free_pages'],free_pages)
+        # Database created without auto_vacuum is switched to incremental vacuum by full one
+        self._backend.connection.execute("PRAGMA auto_vacuum=NONE")
+        self._backend.connection.execute("VACUUM")
+        self._backend.connection.execute("DELETE FROM audit")
+        self._backend.connection.commit()
+        self.assertGreater(self._backend.vacuum('incremental'),0)
+        self.assertEqual(self._backend.connection.execute("PRAGMA auto_vacuum").fetchone()[0],2)
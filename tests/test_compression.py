@@ -0,0 +1,31 @@
+import sys
+import zlib
+import gzip
+import logging
+import unittest
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+import compression
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_negotiate(self):
+        """ Test Accept-Encoding negotiation """
+        self.assertIsNone(compression.negotiate(None))
+        self.assertIsNone(compression.negotiate('identity'))
+        self.assertEqual(compression.negotiate('deflate, gzip;q=0.5'),'deflate')
+        self.assertEqual(compression.negotiate('gzip;q=0, deflate'),'deflate')
+        self.assertEqual(compression.negotiate('gzip, deflate'),'gzip')
+        self.assertIsNone(compression.negotiate('*;q=0'))
+
+    def test_compress_stream(self):
+        """ Test streamed compression output equals to input """
+        chunks = [f"data: event {i}\n\n" for i in range(100)]
+        compressed = b"".join(compression.compress_stream('gzip',chunks))
+        self.assertEqual(gzip.decompress(compressed).decode(),"".join(chunks))
+        data = "".join(chunks).encode()
+        self.assertEqual(zlib.decompress(compression.compress('deflate',data,level=1)),data)
@@ -0,0 +1,140 @@
+import sys
+import os
+import logging
+import contextlib
+import sqlite3
+import threading
+import types
+import unittest
+from unittest.mock import MagicMock
+
+
+sys.path.append("./lib")
+
+
+logger = logging.getLogger(__name__)
+
+from db import DatabaseManager,BackendError,BackendErrorNotFound,create_backend
+from db.dbapi import DbApiBackend
+
+
+class TestDbApiBackend(unittest.TestCase):
+    """ DB-API backend tested with sqlite3 as in-process stand-in of database server """
+
+    DB_FILENAME = "dbapi_unit_test.db"
+
+    def setUp(self):
+        self.tearDown()
+        self._backend = DbApiBackend(sqlite3,pool_size=2,pool_timeout=0.1,select_for_update=False,
+            database=TestDbApiBackend.DB_FILENAME,check_same_thread=False)
+        DatabaseManager.register_backend(self._backend)
+        with self._backend.transaction(), self._backend._cursor() as cursor:
+            cursor.execute("CREATE TABLE users (username TEXT, password TEXT, gender TEXT, deleted NUMBER)")
+            cursor.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT, datetime NUMBER)")
+            cursor.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT, datetime NUMBER)")
+
+    def tearDown(self):
+        if hasattr(self,'_backend'):
+            self._backend.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestDbApiBackend.DB_FILENAME)
+
+    def create_test_model(self,table,key,data):
+        model = MagicMock(_db_table=table)
+        model.get_db_key.return_value = [key,None]
+        model.get_db_updates.return_value = data
+        return model
+
+    def create_test_user(self,username,deleted=0):
+        user = self.create_test_model('users','username',{'username':username,'password':'12345678','gender':'male','deleted':deleted})
+        self._backend.save(user)
+        return user
+
+    def test_dbapi_save_load(self):
+        """ Test insert, update, load by id and list """
+        user = self.create_test_user('test1')
+        self.create_test_user('test2',deleted=1)
+        user.get_db_key.return_value = ['username','test1']
+        user.get_db_updates.return_value = {'password':'87654321'}
+        self._backend.save(user)
+        self.assertEqual(self._backend.load_by_id('users',{'username':'test1','deleted':0})['password'],'87654321')
+        with self.assertRaises(BackendErrorNotFound):
+            self._backend.load_by_id('users',{'username':'test2','deleted':0})
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0})],['test1'])
+        self._backend.delete(user)
+        self.assertEqual(self._backend.load_list('users',{'deleted':0}),[])
+
+    def test_dbapi_save_many_load_page(self):
+        """ Test bulk insert and keyset pagination """
+        users = [self.create_test_model('users','username',{'username':f'test{i:02}','password':'12345678','gender':'male','deleted':0}) for i in range(25)]
+        self._backend.save_many(users)
+        pages, after = [], None
+        while True:
+            page = self._backend.load_page('users',{'deleted':0},'username',10,after)
+            if not page:
+                break
+            pages.append(len(page))
+            after = page[-1]['username']
+        self.assertEqual(pages,[10,10,5])
+        self.assertEqual(after,'test24')
+
+    def test_dbapi_bulk_update(self):
+        """ Test bulk update by keys and filter """
+        for username in ['test1','test2','test3']:
+            self.create_test_user(username)
+        updated = self._backend.bulk_update('users',{'deleted':1},'username',['test1','test2','missing'],{'deleted':0})
+        self.assertEqual(sorted(updated),['test1','test2'])
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0})],['test3'])
+
+    def test_dbapi_transaction_rollback(self):
+        """ Test writes in failed transaction are rolled back and connection returned to pool """
+        with self.assertRaises(BackendError):
+            with self._backend.transaction():
+                self.create_test_user('test1')
+                self._backend.load_list('no_such_table')
+        self.assertEqual(self._backend.load_list('users'),[])
+        self.assertEqual(self._backend.pool._slots._value,2)
+
+    def test_dbapi_pool_exhausted(self):
+        """ Test pool bounds open connections """
+        started, finish = threading.Event(), threading.Event()
+
+        def hold():
+            with self._backend.pool.connection():
+                started.set()
+                finish.wait()
+
+        threads = [threading.Thread(target=hold) for _ in range(2)]
+        for t in threads:
+            t.start()
+            started.wait()
+            started.clear()
+        try:
+            with self.assertRaises(BackendError):
+                self._backend.load_list('users')
+        finally:
+            finish.set()
+            for t in threads:
+                t.join()
+        self.assertEqual(self._backend.load_list('users'),[])
+
+    def test_dbapi_rotate(self):
+        """ Test rotate keeps max_size newest audits """
+        for i in range(10):
+            self._backend.save(self.create_test_model('audit','uuid',{'uuid':f'uuid{i}','username':'test1','message':'test','datetime':1704893712 + i}))
+        self.assertTrue(self._backend.rotate('audit',max_size=4))
+        self.assertEqual([a['datetime'] for a in self._backend.load_list('audit',order='datetime')],[1704893718 + i for i in range(4)])
+        self.assertEqual(len(self._backend.load_list('audit_archive')),6)
+        self.assertFalse(self._backend.rotate('audit',max_size=5))
+        with self.assertRaises(BackendError):
+            self._backend.rotate('audit',max_size=0)
+
+    def test_dbapi_registry(self):
+        """ Test backend selected by DB_DRIVER """
+        config = types.SimpleNamespace(DB_DRIVER='sqlite',DB_NAME=TestDbApiBackend.DB_FILENAME)
+        self.assertEqual(create_backend(config).db_path,TestDbApiBackend.DB_FILENAME)
+        with self.assertRaises(BackendError):
+            create_backend(types.SimpleNamespace(DB_DRIVER='oracle'))
+        # Settings made from template before DB_DRIVER was supported
+        config = types.SimpleNamespace(DB_DRIVER='mysql',DB_NAME='your_db_name',DB_USER='your_db_user',DB_PASS='your_db_pass')
+        self.assertEqual(create_backend(config).db_path,'users-audit.db')
@@ -0,0 +1,99 @@
+import sys
+import os
+import logging
+import contextlib
+import unittest
+from unittest.mock import MagicMock
+
+
+sys.path.append("./lib")
+
+
+logger = logging.getLogger(__name__)
+
+from db import DatabaseManager,BackendErrorNotFound
+from db.sqlite import SqLiteBackend
+from db.memory import MemoryCacheBackend
+
+
+class TestMemoryCacheBackend(unittest.TestCase):
+
+    DB_FILENAME = "memory_unit_test.db"
+
+    def setUp(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestMemoryCacheBackend.DB_FILENAME)
+        self._sqlite = SqLiteBackend(TestMemoryCacheBackend.DB_FILENAME)
+        self._sqlite.connection.execute("CREATE TABLE users (username TEXT, password TEXT, gender TEXT, deleted NUMBER)")
+        self._sqlite.connection.execute("INSERT INTO users VALUES ('test1','12345678','male',0)")
+        self._sqlite.connection.execute("INSERT INTO users VALUES ('test2','12345678','female',1)")
+        self._backend = MemoryCacheBackend(self._sqlite)
+        DatabaseManager.register_backend(self._backend)
+
+    def tearDown(self):
+        self._sqlite.connection.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestMemoryCacheBackend.DB_FILENAME)
+
+    def test_memory_warmup_and_reads(self):
+        """ Test users served from memory """
+        self.assertIsNotNone(self._backend.warmup_time)
+        self._sqlite.connection.execute("DELETE FROM users")
+        self.assertEqual(self._backend.load_by_id('users',{'deleted':0,'username':'test1'})['username'],'test1')
+        with self.assertRaises(BackendErrorNotFound):
+            self._backend.load_by_id('users',{'deleted':0,'username':'test2'})
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0})],['test1'])
+        self.assertEqual(self._backend.check_consistency(),{'users':['test1','test2']})
+
+    def test_memory_write_unit(self):
+        """ Test cache refreshed after group commit unit is applied """
+        self._sqlite.connection.commit()
+        self._sqlite.group_commit = True
+        users = []
+        for username in ['test3','test4']:
+            user = MagicMock(_db_table="users")
+            user.get_db_key.return_value = ['username',None]
+            user.get_db_updates.return_value = {'username':username,'password':'12345678','gender':'male','deleted':0}
+            users.append(user)
+        with self._backend.write_unit():
+            for user in users:
+                self._backend.save(user)
+            self.assertEqual(len(self._backend.load_list('users',{'deleted':0})),1)
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0},order='username')],['test1','test3','test4'])
+        self.assertEqual(self._sqlite.group_stats,{'commits':1,'writes':2})
+        self.assertEqual(self._backend.check_consistency(),{'users':[]})
+
+    def test_memory_other_process_writes(self):
+        """ Test writes of other worker process are visible on next read """
+        self._sqlite.connection.commit()
+        other_sqlite = SqLiteBackend(TestMemoryCacheBackend.DB_FILENAME)
+        other = MemoryCacheBackend(other_sqlite)
+        user = MagicMock(_db_table="users")
+        user.get_db_key.return_value = ['username',None]
+        user.get_db_updates.return_value = {'username':'test3','password':'12345678','gender':'male','deleted':0}
+        other.save(user)
+        self.assertEqual(self._backend.load_by_id('users',{'username':'test3'})['gender'],'male')
+        user.get_db_key.return_value = ['username','test1']
+        user.get_db_updates.return_value = {'deleted':1}
+        other.save(user)
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0})],['test3'])
+        self.assertEqual(self._backend.check_consistency(),{'users':[]})
+        # Too many changes reload whole table
+        self._backend.sync_max_changes = 0
+        other.delete(user)
+        with self.assertRaises(BackendErrorNotFound):
+            self._backend.load_by_id('users',{'username':'test1'})
+        other_sqlite.close()
+
+    def test_memory_write_through(self):
+        """ Test saves go to database and update memory """
+        user = MagicMock(_db_table="users")
+        user.get_db_key.return_value = ['username',None]
+        user.get_db_updates.return_value = {'username':'test3','password':'12345678','gender':'male','deleted':0}
+        self._backend.save(user)
+        user.get_db_key.return_value = ['username','test1']
+        user.get_db_updates.return_value = {'deleted':1}
+        self._backend.save(user)
+        self.assertEqual([u['username'] for u in self._backend.load_list('users',{'deleted':0},order='username')],['test3'])
+        self.assertEqual(len(self._backend.load_list('users',{'deleted':1})),2)
+        self.assertEqual(self._backend.check_consistency(),{'users':[]})
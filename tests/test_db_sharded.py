@@ -0,0 +1,130 @@
+import sys
+import os
+import logging
+import contextlib
+import unittest
+from unittest.mock import MagicMock
+
+
+sys.path.append("./lib")
+
+
+logger = logging.getLogger(__name__)
+
+from db import DatabaseManager,BackendError,BackendErrorNotFound
+from db.sharded import ShardedBackend, rebalance
+from model.user import User
+
+
+class TestShardedBackend(unittest.TestCase):
+
+    DB_FILENAMES = ["sharded_unit_test_0.db","sharded_unit_test_1.db","sharded_unit_test_2.db"]
+    REBALANCE_FILENAMES = ["sharded_unit_test_r0.db","sharded_unit_test_r1.db"]
+
+    def setUp(self):
+        self.tearDown()
+        self._backend = ShardedBackend.from_paths(TestShardedBackend.DB_FILENAMES)
+        DatabaseManager.register_backend(self._backend)
+        for shard in self._backend.shards:
+            shard.connection.execute("CREATE TABLE users (username TEXT, password TEXT, gender TEXT, deleted NUMBER)")
+            shard.connection.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT, datetime NUMBER)")
+            shard.connection.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT, datetime NUMBER)")
+
+    def tearDown(self):
+        if hasattr(self,'_backend'):
+            self._backend.close()
+        for filename in TestShardedBackend.DB_FILENAMES + TestShardedBackend.REBALANCE_FILENAMES:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+
+    def create_test_user(self,username):
+        user = MagicMock(_db_table="users")
+        user.get_db_key.return_value = ['username',None]
+        user.get_db_updates.return_value = {'username':username,'password':'12345678','gender':'male','deleted':0}
+        DatabaseManager.get_backend().save(user)
+        return user
+
+    def test_sharded_point_lookup(self):
+        """ Test object saved and loaded from one shard """
+        self.create_test_user('test')
+        shard = self._backend.get_shard('test')
+        self.assertEqual(len(shard.load_list('users')),1)
+        self.assertEqual(sum(len(s.load_list('users')) for s in self._backend.shards),1)
+        user_data = self._backend.load_by_id('users',{'deleted':0,'username':'test'})
+        self.assertEqual(user_data['username'],'test')
+        with self.assertRaises(BackendErrorNotFound):
+            self._backend.load_by_id('users',{'username':'not_found'})
+
+    def test_sharded_load_list_ordered(self):
+        """ Test load_list merges all shards respecting order """
+        usernames = [f"user{i:02}" for i in range(20)]
+        for username in reversed(usernames):
+            self.create_test_user(username)
+        self.assertGreater(len([s for s in self._backend.shards if s.load_list('users')]),1)
+        user_data = self._backend.load_list('users',{'deleted':0},order='username')
+        self.assertEqual([u['username'] for u in user_data],usernames)
+
+    def test_sharded_transaction(self):
+        """ Test writes to several shards committed on exit, all rolled back if one fails """
+        with self._backend.transaction():
+            for i in range(10):
+                self.create_test_user(f"user{i}")
+            self.assertEqual(self._backend.load_list('users'),[])
+        self.assertEqual(len(self._backend.load_list('users')),10)
+        self.assertGreater(len([s for s in self._backend.shards if s.load_list('users')]),1)
+        bad = MagicMock(_db_table="not_existing_table")
+        bad.get_db_key.return_value = ['username','bad']
+        bad.get_db_updates.return_value = {'deleted':1}
+        with self.assertRaises(BackendError):
+            with self._backend.transaction():
+                for i in range(10,20):
+                    self.create_test_user(f"user{i}")
+                self._backend.save(bad)
+        self.assertEqual(len(self._backend.load_list('users')),10)
+
+    def test_sharded_table_version(self):
+        """ Test table version changes on write to any shard """
+        version = self._backend.table_version('users')
+        self.create_test_user('test')
+        new_version = self._backend.table_version('users')
+        self.assertNotEqual(new_version,version)
+        self.assertGreater(new_version[1],0)
+        self.assertEqual(DatabaseManager.table_version('users')[1],new_version[1])
+
+    def test_sharded_bulk_writes(self):
+        """ Test bulk update routed by keys or fanned out, bulk delete with audits on every shard """
+        for i in range(10):
+            self.create_test_user(f"user{i}")
+        updated = self._backend.bulk_update('users',{'gender':'female'},'username',['user1','user2','not_found'],{'deleted':0})
+        self.assertEqual(sorted(updated),['user1','user2'])
+        updated = self._backend.bulk_update('users',{'gender':'female'},'username',None,{'gender':'male'})
+        self.assertEqual(len(updated),8)
+        deleted = User.bulk_delete(where={'gender':'female'})
+        self.assertEqual(len(deleted),10)
+        self.assertEqual(self._backend.load_list('users',{'deleted':0}),[])
+        audits = self._backend.load_list('audit')
+        self.assertEqual(sorted(a['username'] for a in audits),sorted(deleted))
+        self.assertGreater(len([s for s in self._backend.shards if s.load_list('audit')]),1)
+
+    def test_sharded_rebalance(self):
+        """ Test rebalance to different shards count """
+        for i in range(10):
+            self.create_test_user(f"user{i}")
+            audit = MagicMock(_db_table="audit")
+            audit.get_db_key.return_value = ['uuid',None]
+            audit.get_db_updates.return_value = {'uuid':f"uuid{i}",'username':f"user{i % 2}",'message':'test','datetime':1704893712}
+            self._backend.save(audit)
+        version = self._backend.table_version('users')
+        counts = rebalance(TestShardedBackend.DB_FILENAMES,TestShardedBackend.REBALANCE_FILENAMES)
+        self.assertEqual(sum(counts),20)
+        target = ShardedBackend.from_paths(TestShardedBackend.REBALANCE_FILENAMES)
+        self.assertEqual(target.load_by_id('users',{'username':'user5'})['username'],'user5')
+        self.assertEqual(len(target.load_list('users')),10)
+        # Changes are on shard of their record
+        for shard in target.shards:
+            audit_keys = {a['uuid'] for a in shard.load_list('audit')}
+            self.assertEqual({c['record_key'] for c in shard.load_changes()},{u['username'] for u in shard.load_list('users')} | audit_keys)
+            # Rollups recounted from audits of shard
+            self.assertEqual(shard.connection.execute("SELECT COALESCE(SUM(count),0) FROM audit_rollup").fetchone()[0],len(audit_keys))
+        self.assertGreater(target.table_version('users')[1],version[1])
+        target.close()
@@ -3,7 +3,10 @@ import os
 import logging
 import contextlib
 import unittest
-from unittest.mock import MagicMock
+import threading
+import time
+import sqlite3
+from unittest.mock import MagicMock,patch
 
 
 sys.path.append("./lib")
@@ -12,7 +15,8 @@ sys.path.append("./lib")
 logger = logging.getLogger(__name__)
 
 from db import DatabaseManager,DbBackend,DbObject,BackendErrorNotFound
-from db.sqlite import SqLiteBackend
+from db.sqlite import SqLiteBackend, SqLiteMemoryReplica, _PendingWrite, _copy_database
+from db import BackendError
         
 
 class TestSqLiteBackend(unittest.TestCase):
@@ -103,3 +107,260 @@ class TestSqLiteBackend(unittest.TestCase):
         cur.execute("SELECT * from test_audit_archive ORDER BY datetime DESC")
         other_msg_ids = [p[0] for p in cur]
         self.assertEqual(other_msg_ids,[5,4,3,2,1])
+
+
+    def test_sqlite_backup_restore(self):
+        """ Test sqlite online backup and restore """
+        backup_filename = TestSqLiteBackend.DB_FILENAME + ".backup"
+        self.create_test_user('test1')
+        stats = self._backend.backup(backup_filename,pages=1)
+        self.assertGreater(stats['pages'],0)
+        self.assertIn('pages_per_sec',stats)
+        self.create_test_user('test2')
+        data_version = self._backend.data_version()
+
+        def copy_database(*args):
+            # Writes of this process wait for restore
+            self.assertTrue(self._backend._write_lock._is_owned())
+            return _copy_database(*args)
+
+        with patch('db.sqlite._copy_database',side_effect=copy_database):
+            self._backend.restore(backup_filename,pages=1)
+        os.remove(backup_filename)
+        self.assertNotEqual(self._backend.data_version(),data_version)
+        self.assertEqual(self._backend.load_changes(self._backend.changes_seq() - 1)[0]['operation'],'restore')
+        user_data = self._backend.load_list('test_table')
+        self.assertEqual([u['username'] for u in user_data],['test1'])
+
+
+    def test_sqlite_memory_replica(self):
+        """ Test in-memory replica refresh and read routing """
+        DatabaseManager.clear_sticky()
+        self.create_test_user('test1')
+        self._backend.connection.commit()
+        replica = SqLiteMemoryReplica(self._backend)
+        DatabaseManager.register_backend(self._backend,[replica])
+        max_staleness = DatabaseManager.max_staleness
+        try:
+            self.assertIs(DatabaseManager.get_read_backend(),replica)
+            self.assertEqual(replica.load_by_id('test_table',{'username':'test1'})['username'],'test1')
+            with self.assertRaises(BackendError):
+                replica.save(MagicMock())
+            # Stale replica is skipped
+            DatabaseManager.max_staleness = 0.5
+            replica.refreshed_at -= 1
+            self.assertIs(DatabaseManager.get_read_backend(),self._backend)
+            replica.refresh()
+            self.assertIs(DatabaseManager.get_read_backend(),replica)
+            DatabaseManager.max_staleness = None
+            # Read-your-writes : after write reads go to primary until replica is refreshed
+            DatabaseManager.get_write_backend()
+            self.assertIs(DatabaseManager.get_read_backend(),self._backend)
+            replica.refresh()
+            self.assertIs(DatabaseManager.get_read_backend(),replica)
+            # Client wrote later (e.g. in other worker)
+            DatabaseManager.clear_sticky(time.time() + 1)
+            self.assertIs(DatabaseManager.get_read_backend(),self._backend)
+            DatabaseManager.clear_sticky()
+            self.assertIs(DatabaseManager.get_read_backend(),replica)
+        finally:
+            DatabaseManager.max_staleness = max_staleness
+            DatabaseManager.clear_sticky()
+            DatabaseManager.register_backend(self._backend)
+
+    def test_sqlite_reconnect_after_fork(self):
+        """ Test connection reopened in another process """
+        self._backend.connection.commit()
+        connection = self._backend.connection
+        self._backend._pid = -1 # Emulate fork
+        self.assertIsNot(self._backend.connection,connection)
+        self.create_test_user('test')
+        self.assertEqual(self._backend.load_by_id('test_table',{'username':'test'})['username'],'test')
+        connection.close()
+
+    def test_sqlite_changes(self):
+        """ Test every write recorded in changes """
+        user = self.create_test_user('test')
+        user.get_db_key.return_value = ['username','test']
+        self._backend.save(user)
+        self._backend.delete(user)
+        changes = self._backend.load_changes(0)
+        self.assertEqual([(c['seq'],c['record_key'],c['operation']) for c in changes],[(1,'test','insert'),(2,'test','update'),(3,'test','delete')])
+        self.assertEqual(len(self._backend.load_changes(2)),1)
+
+    def test_sqlite_table_version(self):
+        """ Test table version is persisted and same for all connections """
+        other = SqLiteBackend(TestSqLiteBackend.DB_FILENAME)
+        self.assertEqual(self._backend.table_version('test_table'),(0,0))
+        self.create_test_user('test1')
+        version = self._backend.table_version('test_table')
+        self.assertEqual(version[0],1)
+        self.assertEqual(other.table_version('test_table'),version)
+        etag = DatabaseManager.table_version('test_table')
+        other.bulk_update('test_table',{'password':'1234'},'username',['test1'])
+        self.assertEqual(self._backend.table_version('test_table')[0],2)
+        version = DatabaseManager.table_version('test_table')
+        self.assertNotEqual(version,etag)
+        # Other worker
+        DatabaseManager.register_backend(other)
+        self.assertEqual(DatabaseManager.table_version('test_table'),version)
+        other.close()
+
+    def test_sqlite_transaction(self):
+        """ Test writes in transaction committed or rolled back together """
+        with self._backend.transaction():
+            self.create_test_user('test1')
+            self.create_test_user('test2')
+        self.assertEqual(len(self._backend.load_list('test_table')),2)
+        with self.assertRaises(RuntimeError):
+            with self._backend.transaction():
+                self.create_test_user('test3')
+                raise RuntimeError('fail')
+        self.assertEqual(len(self._backend.load_list('test_table')),2)
+        self.assertEqual(len(self._backend.load_changes(0)),2)
+
+    def test_sqlite_bulk_update(self):
+        """ Test set-based update and multi-row insert """
+        for username in ['test1','test2','test3']:
+            self.create_test_user(username)
+        updated = self._backend.bulk_update('test_table',{'password':'1234'},'username',['test1','test3','not_found'])
+        self.assertEqual(sorted(updated),['test1','test3'])
+        self.assertEqual(len(self._backend.load_list('test_table',{'password':'1234'})),2)
+        updated = self._backend.bulk_update('test_table',{'password':'4321'},'username',where_clause={'password':'1234'})
+        self.assertEqual(sorted(updated),['test1','test3'])
+        users = [self.create_test_user(u) for u in ['test4','test5']]
+        self._backend.save_many(users)
+        self.assertEqual(len(self._backend.load_list('test_table',{'username':'test5'})),2)
+
+    def test_sqlite_unit_of_work_bulk_write(self):
+        """ Test bulk write in unit of work is committed with other writes of unit, listeners notified after commit """
+        notified = []
+        listener = lambda table,operation,rows: notified.append((table,operation,rows))
+        DatabaseManager.add_listener(listener)
+        self.create_test_user('test1')
+        other = sqlite3.connect(TestSqLiteBackend.DB_FILENAME)
+        count = lambda where: other.execute(f"SELECT COUNT(*) FROM test_table WHERE {where}").fetchone()[0]
+        try:
+            with DatabaseManager.unit_of_work():
+                user = MagicMock(_db_table="test_table")
+                user.get_db_key.return_value = ['username',None]
+                user.get_db_updates.return_value = {'username':'test2','password':'12345678'}
+                DatabaseManager.write('save',user)
+                updated = DatabaseManager.bulk_write('bulk_update','test_table',{'password':'1234'},'username',None,{'username':'test1'})
+                DatabaseManager.changed('test_table','save',[{'username':k,'password':'1234'} for k in updated])
+                self.assertEqual(updated,['test1'])
+                self.assertEqual(notified,[])
+                self.assertEqual(count("password='1234' OR username='test2'"),0)
+            self.assertEqual(count("password='1234' OR username='test2'"),2)
+            self.assertEqual([(table,operation) for table,operation,_ in notified],[('test_table','save')] * 2)
+            # Bulk write is rolled back with unit
+            with self.assertRaises(ValueError):
+                with DatabaseManager.unit_of_work():
+                    DatabaseManager.bulk_write('bulk_update','test_table',{'password':'4321'},'username',['test1'],{})
+                    raise ValueError('rollback')
+            self.assertEqual(self._backend.load_by_id('test_table',{'username':'test1'})['password'],'1234')
+            self.assertEqual(len(notified),2)
+        finally:
+            DatabaseManager._listeners.remove(listener)
+            other.close()
+
+    def test_sqlite_bulk_write_lock(self):
+        """ Test bulk writes take database write lock before reading keys, errors are wrapped """
+        self.create_test_user('test1')
+        self._backend.retries = 1
+        self._backend.retry_delay = 0.01
+        other = sqlite3.connect(TestSqLiteBackend.DB_FILENAME,timeout=0)
+        other.execute("BEGIN IMMEDIATE")
+        self._backend.connection.execute("PRAGMA busy_timeout=10")
+        with self.assertRaisesRegex(BackendError,'locked'):
+            self._backend.bulk_update('test_table',{'password':'1234'},'username',['test1'])
+        other.rollback()
+        other.close()
+        self.assertEqual(self._backend.bulk_update('test_table',{'password':'1234'},'username',['test1']),['test1'])
+        with self.assertRaises(BackendError):
+            user = MagicMock(_db_table="not_existing_table")
+            user.get_db_key.return_value = ['username',None]
+            user.get_db_updates.return_value = {'username':'test2'}
+            self._backend.save_many([user])
+        with self.assertRaises(BackendError):
+            self._backend.archive_deleted('not_existing_table','username',0)
+
+    def test_sqlite_group_commit(self):
+        """ Test concurrent writes share commits, failed write does not affect others """
+        self._backend.group_commit = True
+        self._backend.group_delay = 0.05
+        errors = []
+
+        def create_user(username):
+            user = MagicMock(_db_table="test_table" if username != 'bad' else "not_existing_table")
+            user.get_db_key.return_value = ['username',None]
+            user.get_db_updates.return_value = {'username':username,'password':'12345678'}
+            try:
+                self._backend.save(user)
+            except BackendError as ex:
+                errors.append(str(ex))
+
+        threads = [threading.Thread(target=create_user,args=(f"user{i}",)) for i in range(20)]
+        threads.append(threading.Thread(target=create_user,args=('bad',)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self._backend.load_list('test_table')),20)
+        self.assertEqual(errors,['no such table: not_existing_table'])
+        self.assertEqual(self._backend.group_stats['writes'],21)
+        self.assertLess(self._backend.group_stats['commits'],21)
+
+    def test_sqlite_group_commit_one_transaction(self):
+        """ Test units of a group are committed once, other connections see none of them before commit """
+        other = sqlite3.connect(TestSqLiteBackend.DB_FILENAME)
+        data_version = lambda: other.execute("PRAGMA data_version").fetchone()[0]
+        execute_statements = SqLiteBackend._execute_statements
+        seen = []
+
+        def execute_and_check(cursor,*args):
+            seen.append((data_version(),other.execute("SELECT COUNT(*) FROM test_table").fetchone()[0]))
+            execute_statements(cursor,*args)
+
+        for group in range(3):
+            started = data_version()
+            batch = [_PendingWrite([("INSERT INTO test_table (username,password) VALUES (?,?)",(f"user{group}{i}",'1234'),
+                                     ('test_table',f"user{group}{i}",'insert'),())]) for i in range(4)]
+            with patch.object(SqLiteBackend,'_execute_statements',staticmethod(execute_and_check)):
+                self._backend._apply_group(batch)
+            self.assertEqual(data_version(),started + 1)
+            self.assertEqual(seen,[(started,group * 4)] * 4)
+            seen.clear()
+        self.assertEqual(self._backend.group_stats['commits'],3)
+        other.close()
+
+    def test_sqlite_audit_rollup(self):
+        """ Test audit counts maintained on insert and kept after rotate """
+        self._backend.connection.execute("CREATE TABLE audit (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+        self._backend.connection.execute("CREATE TABLE audit_archive (uuid TEXT, username TEXT, message TEXT,datetime NUMBER)")
+
+        def create_audit(uuid,username,datetime):
+            audit = MagicMock(_db_table="audit")
+            audit.get_db_key.return_value = ['uuid',None]
+            audit.get_db_updates.return_value = {'uuid':uuid,'username':username,'message':'test','datetime':datetime}
+            return audit
+
+        self._backend.save(create_audit('1','user1',7200))
+        self._backend.save(create_audit('2','user1',7300))
+        self._backend.save_many([create_audit('3','user2',7400),create_audit('4','user1',10800)])
+        self._backend.rotate('audit',1)
+        self.assertEqual(len(self._backend.load_list('audit_archive')),3)
+        expected = [
+            {'username':'user1','bucket':7200,'count':2},
+            {'username':'user2','bucket':7200,'count':1},
+            {'username':'user1','bucket':10800,'count':1},
+            ]
+        self.assertEqual(self._backend.audit_stats(),expected)
+        self.assertEqual(self._backend.audit_stats(start=7200,end=10800,username='user1'),expected[:1])
+        self.assertEqual(self._backend.audit_stats(bucket_size=86400),[{'username':'user1','bucket':0,'count':3},{'username':'user2','bucket':0,'count':1}])
+        with self.assertRaises(BackendError):
+            self._backend.audit_stats(start=7300)
+        with self.assertRaises(BackendError):
+            self._backend.audit_stats(end=7300)
+        self._backend.rebuild_audit_rollup()
+        self.assertEqual(self._backend.audit_stats(),expected)
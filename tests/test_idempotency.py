@@ -0,0 +1,75 @@
+import sys
+import os
+import logging
+import contextlib
+import threading
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from idempotency import IdempotencyStore, IdempotencyError
+
+
+class TestIdempotency(unittest.TestCase):
+
+    DB_FILENAME = "idempotency_unit_test.db"
+
+    def tearDown(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestIdempotency.DB_FILENAME)
+
+    def test_idempotency_replay(self):
+        """ Test completed response replayed, other body rejected """
+        store = IdempotencyStore()
+        self.assertIsNone(store.begin('key1','body1'))
+        store.complete('key1',{'status':'ok'})
+        self.assertEqual(store.begin('key1','body1'),{'status':'ok'})
+        with self.assertRaises(IdempotencyError):
+            store.begin('key1','body2')
+        # Aborted request is processed again
+        self.assertIsNone(store.begin('key2','body1'))
+        store.abort('key2')
+        self.assertIsNone(store.begin('key2','body1'))
+
+    def test_idempotency_concurrent_duplicate(self):
+        """ Test duplicate waits for in-flight request """
+        store = IdempotencyStore(wait_timeout=5)
+        self.assertIsNone(store.begin('key1'))
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(store.begin('key1')))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+        store.complete('key1',{'status':'ok'})
+        waiter.join()
+        self.assertEqual(results,[{'status':'ok'}])
+        # In progress longer than wait timeout
+        store.wait_timeout = 0.05
+        store.begin('key2')
+        with self.assertRaises(IdempotencyError):
+            store.begin('key2')
+
+    @patch('idempotency.time')
+    def test_idempotency_bounds(self,timefunc):
+        """ Test TTL and max size """
+        timefunc.time.return_value = 100
+        timefunc.monotonic.return_value = 100
+        store = IdempotencyStore(max_size=2,ttl=10)
+        for key in ['key1','key2','key3']:
+            store.begin(key)
+            store.complete(key,{'key':key})
+        self.assertIsNone(store.begin('key1'))
+        self.assertEqual(store.begin('key3'),{'key':'key3'})
+        timefunc.time.return_value = 111
+        self.assertIsNone(store.begin('key3'))
+
+    def test_idempotency_persisted(self):
+        """ Test response persisted to sqlite is seen by other store (worker) """
+        store = IdempotencyStore(path=TestIdempotency.DB_FILENAME)
+        store.begin('key1','body1')
+        store.complete('key1',{'status':'ok'})
+        other = IdempotencyStore(path=TestIdempotency.DB_FILENAME)
+        self.assertEqual(other.begin('key1','body1'),{'status':'ok'})
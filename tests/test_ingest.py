@@ -0,0 +1,115 @@
+import sys
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import tempfile
+import contextlib
+import sqlite3
+import unittest
+from unittest.mock import MagicMock
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from db import DatabaseManager
+from db.sqlite import SqLiteBackend, init_database
+from ingest import AuditIngestor
+
+
+class TestIngest(unittest.TestCase):
+
+    DB_FILENAME = "ingest_unit_test.db"
+
+    def setUp(self):
+        with contextlib.redirect_stdout(None):
+            init_database(TestIngest.DB_FILENAME)
+        self._backend = SqLiteBackend(TestIngest.DB_FILENAME)
+        DatabaseManager.register_backend(self._backend)
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._backend.close()
+        self._tmpdir.cleanup()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestIngest.DB_FILENAME)
+
+    def test_ingest_unix_socket(self):
+        """ Test stream records validated and written in batches under backpressure """
+        path = os.path.join(self._tmpdir.name,'audit.sock')
+        count = 5000
+
+        async def scenario():
+            ingestor = AuditIngestor(batch_size=1000,max_pending=100)
+            await ingestor.start()
+            await ingestor.serve_unix(path)
+            started = time.monotonic()
+            _, writer = await asyncio.open_unix_connection(path)
+            for i in range(count):
+                writer.write(json.dumps({'username':'test1','message':f'event {i}','datetime':1704893712 + i}).encode() + b'\n')
+            writer.write(b'not json\n{"username":"test1"}\n[1,2]\n{"message":"bad time","datetime":10}')
+            await writer.drain()
+            writer.close()
+            while ingestor.stats['received'] < count + 4:
+                await asyncio.sleep(0.01)
+            await ingestor.close()
+            logger.info("Ingested %s audits/sec",count / (time.monotonic() - started))
+            return ingestor.stats
+
+        stats = asyncio.run(scenario())
+        self.assertEqual(stats['accepted'],count)
+        self.assertEqual(stats['invalid'],4)
+        self.assertEqual(stats['written'],count)
+        self.assertLess(stats['batches'],count / 10)
+        self.assertEqual(len(self._backend.load_list('audit')),count)
+        self.assertEqual(sum(s['count'] for s in self._backend.audit_stats()),count)
+
+    def test_ingest_udp(self):
+        """ Test datagram with several records, dropped when queue is full """
+
+        async def scenario():
+            ingestor = AuditIngestor(max_pending=2)
+            await ingestor.start()
+            await ingestor.serve_udp('127.0.0.1',0)
+            port = ingestor._transports[0].get_extra_info('sockname')[1]
+            with socket.socket(socket.AF_INET,socket.SOCK_DGRAM) as sock:
+                lines = [json.dumps({'username':'test1','message':f'event {i}'}) for i in range(3)]
+                sock.sendto('\n'.join(lines).encode(),('127.0.0.1',port))
+            while ingestor.stats['received'] < 3:
+                await asyncio.sleep(0.01)
+            await ingestor.close()
+            return ingestor.stats
+
+        stats = asyncio.run(scenario())
+        self.assertEqual(stats['accepted'],3)
+        self.assertEqual(stats['dropped'],1)
+        self.assertEqual(stats['written'],2)
+
+    def test_ingest_write_error(self):
+        """ Test writer keeps running after driver error """
+        backend = MagicMock()
+        backend.save_many.side_effect = [sqlite3.OperationalError('disk I/O error'),None]
+        DatabaseManager.register_backend(backend)
+        path = os.path.join(self._tmpdir.name,'audit.sock')
+
+        async def scenario():
+            ingestor = AuditIngestor(flush_interval=0.01)
+            await ingestor.start()
+            await ingestor.serve_unix(path)
+            for i in range(2):
+                _, writer = await asyncio.open_unix_connection(path)
+                writer.write(json.dumps({'username':'test1','message':f'event {i}'}).encode() + b'\n')
+                await writer.drain()
+                writer.close()
+                while ingestor.stats['written'] + ingestor.stats['write_errors'] <= i:
+                    await asyncio.sleep(0.01)
+            await ingestor.close()
+            return ingestor.stats
+
+        stats = asyncio.run(scenario())
+        self.assertEqual(stats['write_errors'],1)
+        self.assertEqual(stats['written'],1)
+        self.assertEqual(backend.save_many.call_count,2)
@@ -0,0 +1,59 @@
+import sys
+import os
+import logging
+import contextlib
+import threading
+import unittest
+
+from werkzeug.serving import make_server
+
+sys.path.append("./lib")
+
+logger = logging.getLogger(__name__)
+
+from wsgi import app
+from db import DatabaseManager
+from db.sqlite import SqLiteBackend, init_database
+from loadtest import LoadTest, load_collection, percentile
+
+
+class TestLoadTest(unittest.TestCase):
+
+    DB_FILENAME = "loadtest_unit_test.db"
+
+    def setUp(self):
+        with contextlib.redirect_stdout(None):
+            init_database(TestLoadTest.DB_FILENAME)
+        self._backend = SqLiteBackend(TestLoadTest.DB_FILENAME)
+        DatabaseManager.register_backend(self._backend)
+        self._server = make_server('127.0.0.1',0,app,threaded=True)
+        threading.Thread(target=self._server.serve_forever,daemon=True).start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._backend.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(TestLoadTest.DB_FILENAME)
+
+    def test_load_collection(self):
+        operations = load_collection()
+        self.assertEqual(sorted(operations),['audit','audits','create','delete','get','list','update'])
+        method,path,body = operations['update'].request('user1')
+        self.assertEqual((method,path),('PUT','/api/v1/users/user1'))
+        self.assertEqual(operations['create'].request('user1')[2]['username'],'user1')
+
+    def test_percentile(self):
+        values = list(range(1,101))
+        self.assertEqual([percentile(values,p) for p in (50,95,99,100)],[50,95,99,100])
+        self.assertEqual(percentile([],50),0.0)
+
+    def test_load_run(self):
+        """ Test short run of full mix against local server """
+        test = LoadTest(f"http://127.0.0.1:{self._server.port}",load_collection(),rps=200,concurrency=4,seed_users=5)
+        report = test.run(0.5)
+        logger.info(report)
+        self.assertEqual(report['total']['requests'],100)
+        self.assertEqual(report['total']['errors'],0)
+        self.assertEqual(sum(r['requests'] for name,r in report.items() if name != 'total'),100)
+        self.assertLessEqual(report['create']['p50'],report['create']['p99'])
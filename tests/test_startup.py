@@ -0,0 +1,34 @@
+import os
+import sys
+import logging
+import subprocess
+import unittest
+
+logger = logging.getLogger(__name__)
+
+# Budget of `import wsgi` cumulative time, override with WSGI_IMPORT_BUDGET_MS
+IMPORT_BUDGET_MS = float(os.environ.get('WSGI_IMPORT_BUDGET_MS',500))
+
+LAZY_MODULES = ['sqlite3','db.sqlite','db.memory','db.sharded','feed','compression','admission','audit_export']
+
+
+class TestStartup(unittest.TestCase):
+
+    def run_python(self,*args):
+        return subprocess.run([sys.executable,*args],capture_output=True,text=True,check=True,
+            cwd=os.path.join(os.path.dirname(__file__),'..'))
+
+    def test_import_time_budget(self):
+        """ Test `import wsgi` cost stays within budget """
+        result = self.run_python('-X','importtime','-c','import wsgi')
+        cumulative = [int(line.split('|')[1]) for line in result.stderr.splitlines() if line.endswith('| wsgi')]
+        self.assertEqual(len(cumulative),1)
+        logger.info("import wsgi: %.1f ms",cumulative[0] / 1000)
+        self.assertLess(cumulative[0] / 1000,IMPORT_BUDGET_MS)
+
+    def test_lazy_initialization(self):
+        """ Test optional subsystems and database are not loaded on import """
+        result = self.run_python('-c',
+            'import sys, wsgi; from db import DatabaseManager; '
+            f'print([m for m in {LAZY_MODULES!r} if m in sys.modules], DatabaseManager.get_backend())')
+        self.assertEqual(result.stdout.strip(),'[] None')
@@ -3,6 +3,9 @@ import sys
 import logging
 import uuid
 import json
+import math
+import hashlib
+import threading
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "lib"))
 
@@ -13,55 +16,246 @@ from flask import (
     jsonify,
     abort,
     make_response,
+    Response,
+    stream_with_context,
+    current_app,
+    g,
 )
 
 import settings
 
-from db import ObjectManager, DatabaseManager
+from db import ObjectManager, DatabaseManager, BackendError
 from model.user import User
 from model.audit import Audit
-from db.sqlite import SqLiteBackend
-from service import request_context
+from model import ModelException, ValidateException
+from service import request_context, RequestContext, ApiError
 
-logging.basicConfig(
-    format="[API]%(asctime)-15s %(process)d %(levelname)s %(name)s %(message)s",
-    stream=sys.stdout,
-    level=logging.DEBUG,
-)
 logger = logging.getLogger()
 
-app = Flask("users-backend")
+# (rule, options, view) registered by create_app
+routes = []
+
+def route(rule,**options):
+    def decorator(view):
+        routes.append((rule,options,view))
+        return view
+    return decorator
 
 def get_next_request_id():
     return uuid.uuid4().hex
 
-backend = SqLiteBackend('users-audit.db')
-DatabaseManager.register_backend(backend)
+def idempotency_args() -> dict:
+    """ request_context arguments: Idempotency-Key header scoped by endpoint, request body hash and store of app """
+    key = request.headers.get('Idempotency-Key')
+    store = current_app.extensions.get('idempotency')
+    if not key or store is None:
+        return {}
+    return {'idempotency_key':f"{request.endpoint}:{key}",
+            'fingerprint':hashlib.sha1(request.get_data()).hexdigest(),
+            'idempotency_store':store}
+
+def make_api_response(conn):
+    response = jsonify(conn.response)
+    conn.cache_control = current_app.config['CACHE_CONTROL']
+    response.headers.update(conn.headers)
+    return response
+
+def make_not_modified_response(conn):
+    response = make_response('',304)
+    conn.cache_control = current_app.config['CACHE_CONTROL']
+    response.headers.update(conn.headers)
+    return response
+
+def init_backend(config=settings):
+    """ Create and register database backend (once per process, on first use) """
+    if DatabaseManager.get_backend() is not None:
+        return DatabaseManager.get_backend()
+    from db import create_backend
+
+    backend = create_backend(config)
+    if getattr(config,'DB_MEMORY_CACHE',False):
+        from db.memory import MemoryCacheBackend
+        backend = MemoryCacheBackend(backend)
+    replicas = []
+    if getattr(config,'DB_REPLICA_REFRESH',None) and getattr(config,'DB_DRIVER','sqlite') == 'sqlite':
+        from db.sqlite import SqLiteMemoryReplica
+        replicas.append(SqLiteMemoryReplica(backend,config.DB_REPLICA_REFRESH))
+    DatabaseManager.max_staleness = getattr(config,'DB_MAX_STALENESS',None)
+    DatabaseManager.register_backend(backend,replicas)
+    return backend
+
+def create_app(config=settings) -> Flask:
+    """Application factory. Database backend and optional subsystems are initialized lazily
+    """
+    logging.basicConfig(
+        format="[API]%(asctime)-15s %(process)d %(levelname)s %(name)s %(message)s",
+        stream=sys.stdout,
+        level=getattr(config,'LOG_LEVEL','INFO'),
+    )
+    app = Flask("users-backend")
+    app.config['COMPRESSION'] = getattr(config,'COMPRESSION',{'min_size':1024,'level':6})
+    app.extensions['admission'] = None
+    if getattr(config,'ADMISSION',None):
+        from admission import AdmissionController
+        app.extensions['admission'] = AdmissionController(**config.ADMISSION)
+    app.config['CACHE_CONTROL'] = getattr(config,'CACHE_CONTROL',RequestContext.cache_control)
+    app.config['BACKUP_PATH'] = getattr(config,'BACKUP_PATH','users-audit.backup.db')
+    app.config['COMPACTION'] = getattr(config,'COMPACTION',{'retention':30 * 86400})
+    # Long poll and stream subscribers of change feed hold server threads
+    app.extensions['feed_subscribers'] = threading.BoundedSemaphore(getattr(config,'FEED_MAX_SUBSCRIBERS',4))
+    app.extensions['idempotency'] = None
+    if getattr(config,'IDEMPOTENCY',None):
+        from idempotency import IdempotencyStore
+        app.extensions['idempotency'] = IdempotencyStore(**config.IDEMPOTENCY)
+
+    @app.before_request
+    def lazy_init_backend():
+        init_backend(config)
+
+    app.before_request(read_your_writes)
+    app.before_request(admission_control)
+    app.teardown_request(admission_release)
+    app.after_request(set_last_write_cookie)
+    app.after_request(compress_response)
+    for rule,options,view in routes:
+        app.add_url_rule(rule,view_func=view,**options)
+    return app
+
+# Time of last write of the client. Replicas of every worker serve its reads only after refresh past it
+LAST_WRITE_COOKIE = 'last_write'
+
+def read_your_writes():
+    """ Start read-your-writes context of request with client last write time """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE,''))
+    except ValueError:
+        last_write = None
+    DatabaseManager.clear_sticky(last_write)
+
+def set_last_write_cookie(response):
+    """ Pass time of write made by request to following requests of the client """
+    last_write = DatabaseManager.last_write()
+    if DatabaseManager.replicas and last_write is not None and request.cookies.get(LAST_WRITE_COOKIE) != repr(last_write):
+        response.set_cookie(LAST_WRITE_COOKIE,repr(last_write),httponly=True,samesite='Lax')
+    return response
+
+def admission_control():
+    """ Reject API request with 429 when client or endpoint is over its limits """
+    admission = current_app.extensions.get('admission')
+    if admission is None or not request.path.startswith('/api/v1/'):
+        return None
+    from admission import AdmissionRejected
+    try:
+        admission.acquire(request.remote_addr,request.endpoint)
+    except AdmissionRejected as ex:
+        response = jsonify(dict(ApiError(get_next_request_id(),str(ex),'rate_limit')))
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(ex.retry_after))
+        return response
+    g.admitted_endpoint = request.endpoint
+    return None
+
+def admission_release(exc):
+    endpoint = g.pop('admitted_endpoint',None)
+    if endpoint is not None:
+        current_app.extensions['admission'].release(endpoint)
+
+def compress_response(response):
+    """ Compress API responses using encoding negotiated by Accept-Encoding """
+    config = current_app.config['COMPRESSION']
+    if not config or not request.path.startswith('/api/v1/'):
+        return response
+    if response.status_code < 200 or response.status_code in (204,304) or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.headers.get('Accept-Encoding'):
+        return response
+    import compression
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    level = config.get('level',6)
+    if response.is_streamed:
+        response.response = compression.compress_stream(encoding,response.response,level)
+        response.headers.pop('Content-Length',None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get('min_size',1024):
+            return response
+        response.set_data(compression.compress(encoding,data,level))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
-@app.route("/api")
+_periodic_backup = None
+
+def start_periodic_backup(config=settings):
+    """ Start backup thread if settings.BACKUP_INTERVAL is set and backend supports backup """
+    global _periodic_backup
+    interval = getattr(config,'BACKUP_INTERVAL',None)
+    if not interval or _periodic_backup is not None:
+        return _periodic_backup
+    backend = init_backend(config)
+    if not hasattr(backend,'backup'):
+        logger.warning("BACKUP_INTERVAL is set, but backup is not supported by backend")
+        return None
+    from db.sqlite import PeriodicBackup
+    _periodic_backup = PeriodicBackup(backend,getattr(config,'BACKUP_PATH','users-audit.backup.db'),interval)
+    _periodic_backup.start()
+    logger.info("Periodic backup to %s every %ss",_periodic_backup.target_path,interval)
+    return _periodic_backup
+
+def stop_periodic_backup():
+    global _periodic_backup
+    if _periodic_backup is not None:
+        _periodic_backup.stop()
+        _periodic_backup = None
+
+def on_worker_start(backup:bool=False):
+    """ Called by server.py in every worker process after fork. Periodic backup runs in one worker """
+    init_backend()
+    from search import get_username_index
+    get_username_index()
+    if backup:
+        start_periodic_backup()
+    logger.info("Worker %s started",os.getpid())
+
+def on_worker_stop():
+    """ Called by server.py on worker shutdown """
+    stop_periodic_backup()
+    backend = DatabaseManager.get_backend()
+    if hasattr(backend,'close'):
+        backend.close()
+    logger.info("Worker %s stopped",os.getpid())
+
+@route("/api")
 def main():
     return "<h1>Users managment service</h1>"
 
-@app.route("/api")
+@route("/api")
 def api():
     return render_template("api.html", devices=[request.hostname])
 
 
-@app.route("/api/v1/users/",methods=['GET'])
+@route("/api/v1/users/",methods=['GET'])
 def api_users_get():
     # Get all users except deleted
     request_id = get_next_request_id()
     logger.debug("[%s]Get users list",request_id)
     with request_context(request_id) as conn:
+        conn.set_cache_key(User._db_table)
+        if conn.is_not_modified(request.headers.get('If-None-Match')):
+            return make_not_modified_response(conn)
         ret = ObjectManager.get_many(User,{'deleted':0})
         conn.create_response(ret)
-    return jsonify(conn.response)
+    return make_api_response(conn)
 
-@app.route("/api/v1/users/",methods=['POST'])
+@route("/api/v1/users/",methods=['POST'])
 def api_user_create():
     request_id = get_next_request_id()
     logger.debug("[%s]User create",request_id)
-    with request_context(request_id) as conn:
+    with request_context(request_id,**idempotency_args()) as conn:
+        if conn.replayed:
+            return jsonify(conn.response)
         data = request.json
         if not data or not isinstance(data,dict):
             abort(400)
@@ -71,16 +265,64 @@ def api_user_create():
     return jsonify(conn.response)
 
 
-@app.route("/api/v1/users/<username>",methods=['GET'])
+@route("/api/v1/users/",methods=['PATCH'])
+def api_users_bulk_update():
+    """ Update users by list of usernames or filter: {"usernames":[...],"filter":{...},"update":{...}} """
+    request_id = get_next_request_id()
+    logger.debug("[%s]Users bulk update",request_id)
+    with request_context(request_id) as conn:
+        data = request.json
+        if not data or not isinstance(data,dict) or not isinstance(data.get('update'),dict) or not isinstance(data.get('filter',{}),dict):
+            abort(400)
+        if 'usernames' not in data and not data.get('filter'):
+            raise ModelException("List of usernames or filter required")
+        where = {**data.get('filter',{}),'deleted':0}
+        updated = User.bulk_update(data['update'],data.get('usernames'),where)
+        conn.create_response([{'username':u} for u in updated])
+    return jsonify(conn.response)
+
+@route("/api/v1/users/",methods=['DELETE'])
+def api_users_bulk_delete():
+    """ Delete users by list of usernames or filter: {"usernames":[...],"filter":{...}} """
+    request_id = get_next_request_id()
+    logger.debug("[%s]Users bulk delete",request_id)
+    with request_context(request_id) as conn:
+        data = request.json
+        if not data or not isinstance(data,dict):
+            abort(400)
+        deleted = User.bulk_delete(data.get('usernames'),data.get('filter'))
+        conn.create_response([{'username':u} for u in deleted])
+    return jsonify(conn.response)
+
+SEARCH_MAX_LIMIT = 100
+
+@route("/api/v1/users/search",methods=['GET'])
+def api_users_search():
+    """ Active usernames starting with prefix (typeahead): ?prefix=&limit= """
+    request_id = get_next_request_id()
+    logger.debug("[%s]Users search : %s",request_id,request.args.get('prefix'))
+    with request_context(request_id) as conn:
+        prefix = request.args.get('prefix','')
+        limit = int(request.args.get('limit',10))
+        if not 0 < limit <= SEARCH_MAX_LIMIT:
+            raise ValidateException(f"limit should be between 1 and {SEARCH_MAX_LIMIT}")
+        from search import search_usernames
+        conn.create_response([{'username':u} for u in search_usernames(prefix,limit)])
+    return jsonify(conn.response)
+
+@route("/api/v1/users/<username>",methods=['GET'])
 def api_user_get(username):
     request_id = get_next_request_id()
     logger.debug("[%s]User get : %s",request_id,username)
     with request_context(request_id) as conn:
+        conn.set_cache_key(User._db_table,username)
+        if conn.is_not_modified(request.headers.get('If-None-Match')):
+            return make_not_modified_response(conn)
         ret = ObjectManager.get_one(User,{'deleted':0,'username':username})
         conn.create_response(ret)
-    return jsonify(conn.response)
+    return make_api_response(conn)
 
-@app.route("/api/v1/users/<username>",methods=['PUT'])
+@route("/api/v1/users/<username>",methods=['PUT'])
 def api_users_update(username):
     request_id = get_next_request_id()
     logger.debug("[%s]User update : %s",request_id,username)
@@ -93,7 +335,7 @@ def api_users_update(username):
         conn.create_response(user)
     return jsonify(conn.response)
 
-@app.route("/api/v1/users/<username>",methods=['DELETE'])
+@route("/api/v1/users/<username>",methods=['DELETE'])
 def api_users_delete(username):
     request_id = get_next_request_id()
     logger.debug("[%s]User delete : %s",request_id,username)
@@ -103,36 +345,148 @@ def api_users_delete(username):
         conn.create_response(user)
     return jsonify(conn.response)
 
-@app.route("/api/v1/audits/",methods=['POST'])
+@route("/api/v1/audits/",methods=['POST'])
 def api_audit_create():
     request_id = get_next_request_id()
     logger.debug("[%s]Audit create",request_id)
-    with request_context(request_id) as conn:
+    with request_context(request_id,**idempotency_args()) as conn:
+        if conn.replayed:
+            return jsonify(conn.response)
         data = request.json
         audit = Audit.create(**data)
         audit.save()
         conn.create_response(audit)
     return jsonify(conn.response)
 
-@app.route("/api/v1/audits/",methods=['GET'])
+@route("/api/v1/audits/",methods=['GET'])
 def api_audit_get():
     request_id = get_next_request_id()
     logger.debug("[%s]Audit list",request_id)
     with request_context(request_id) as conn:
-        ret = ObjectManager.get_many(Audit,order={'datetime'})
+        conn.set_cache_key(Audit._db_table)
+        if conn.is_not_modified(request.headers.get('If-None-Match')):
+            return make_not_modified_response(conn)
+        ret = ObjectManager.get_many(Audit,order='datetime')
         conn.create_response(ret)
+    return make_api_response(conn)
+
+def make_feed_busy_response():
+    """ All long poll/stream slots of worker are taken, client should retry later """
+    response = jsonify(dict(ApiError(get_next_request_id(),"Too many change feed subscribers",'feed_busy')))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+@route("/api/v1/changes",methods=['GET'])
+def api_changes_get():
+    """ Users changed and audits created since change sequence number. wait=N enables long poll """
+    request_id = get_next_request_id()
+    logger.debug("[%s]Changes since %s",request_id,request.args.get('since'))
+    subscribers = current_app.extensions['feed_subscribers']
+    long_poll = bool(request.args.get('wait'))
+    if long_poll and not subscribers.acquire(blocking=False):
+        return make_feed_busy_response()
+    try:
+        with request_context(request_id) as conn:
+            since = int(request.args.get('since',0))
+            limit = min(int(request.args.get('limit',100)),1000)
+            wait = min(float(request.args.get('wait',0)),60)
+            from feed import get_changes, wait_changes
+            ret = wait_changes(since,wait,limit) if wait else get_changes(since,limit)
+            conn.create_response(ret)
+    finally:
+        if long_poll:
+            subscribers.release()
     return jsonify(conn.response)
 
-@app.route("/api/v1/audits/rotate",methods=['GET'])
+@route("/api/v1/changes/stream",methods=['GET'])
+def api_changes_stream():
+    """ Server-sent events stream of changes. Last-Event-ID header or since resumes stream """
+    from feed import wait_changes
+    try:
+        since = int(request.headers.get('Last-Event-ID',request.args.get('since',0)))
+    except ValueError:
+        abort(400)
+    subscribers = current_app.extensions['feed_subscribers']
+    if not subscribers.acquire(blocking=False):
+        return make_feed_busy_response()
+
+    def events(since):
+        while True:
+            try:
+                changeset = wait_changes(since,15)
+            except Exception as ex:
+                logger.exception(str(ex))
+                yield f"event: error\ndata: {json.dumps(str(ex))}\n\n"
+                return
+            if changeset.last_seq == since:
+                yield ": keepalive\n\n"
+                continue
+            since = changeset.last_seq
+            yield f"id: {since}\ndata: {json.dumps(dict(changeset))}\n\n"
+
+    response = Response(stream_with_context(events(since)),mimetype='text/event-stream')
+    response.call_on_close(subscribers.release)
+    return response
+
+STATS_BUCKETS = {'hour':3600,'day':86400}
+
+@route("/api/v1/audits/stats",methods=['GET'])
+def api_audit_stats():
+    """ Audit counts per username and time bucket: ?start=&end=&bucket=hour|day&username= """
+    request_id = get_next_request_id()
+    logger.debug("[%s]Audit stats",request_id)
+    with request_context(request_id) as conn:
+        if not hasattr(DatabaseManager.get_read_backend(),'audit_stats'):
+            raise BackendError("Audit stats not supported by backend")
+        args = request.args
+        conn.set_cache_key(Audit._db_table,'stats',*sorted(args.items()))
+        if conn.is_not_modified(request.headers.get('If-None-Match')):
+            return make_not_modified_response(conn)
+        if args.get('bucket','hour') not in STATS_BUCKETS:
+            raise ValidateException(f"bucket should be an one of {list(STATS_BUCKETS)}")
+        if any(int(args[bound]) % STATS_BUCKETS['hour'] for bound in ('start','end') if bound in args):
+            raise ValidateException("start and end should be aligned to hour")
+        ret = DatabaseManager.get_read_backend().audit_stats(
+            int(args['start']) if 'start' in args else None,
+            int(args['end']) if 'end' in args else None,
+            STATS_BUCKETS[args.get('bucket','hour')],
+            args.get('username'))
+        conn.create_response(ret)
+    return make_api_response(conn)
+
+@route("/api/v1/audits/rotate",methods=['GET'])
 def api_audit_rotate():
     """ Special API endpoint to rotate audit records. Called from cronjob """
+    backend = DatabaseManager.get_backend()
     if not hasattr(backend,'rotate'):
         return "Rotate not supported by backend"
     backend.rotate('audit',max_size=100)
+    DatabaseManager.touch('audit')
     return "OK"
 
+@route("/api/v1/admin/backup",methods=['GET'])
+def api_admin_backup():
+    """ Online database backup. Called from cronjob """
+    backend = DatabaseManager.get_backend()
+    if not hasattr(backend,'backup'):
+        return "Backup not supported by backend"
+    stats = backend.backup(current_app.config['BACKUP_PATH'])
+    return jsonify(stats)
 
-if __name__ == "__main__":
-    app.run(debug=True)
+
+@route("/api/v1/admin/compact",methods=['GET'])
+def api_admin_compact():
+    """ Move users deleted before retention window to users_deleted. Called from cronjob """
+    backend = DatabaseManager.get_backend()
+    if not hasattr(backend,'archive_deleted'):
+        return "Compaction not supported by backend"
+    from compaction import compact_deleted_users
+    stats = compact_deleted_users(**current_app.config['COMPACTION'])
+    return jsonify(stats)
 
 
+app = create_app()
+
+if __name__ == "__main__":
+    app.run(debug=True)